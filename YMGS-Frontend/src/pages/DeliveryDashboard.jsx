@@ -8,18 +8,25 @@ const DeliveryDashboard = () => {
   const [orders, setOrders] = useState([]);
   const [loading, setLoading] = useState(false);
   const [updating, setUpdating] = useState(null); // order id being updated
+  const [nextCursor, setNextCursor] = useState(null);
 
-  // Simuler un livreur connecté (plus tard: via auth context)
-  const deliveryManId = 1;
+  // Le livreur est identifié par son token
+  const authHeaders = {
+    headers: { Authorization: `Token ${localStorage.getItem("token")}` },
+  };
 
-  const fetchOrders = async () => {
+  const fetchOrders = async (cursor = null) => {
     try {
       setLoading(true);
-      const response = await axios.get(
-        `${backendUrl}/api/delivery/orders?delivery_man_id=${deliveryManId}`
-      );
+      const response = await axios.get(`${backendUrl}/api/delivery/orders`, {
+        ...authHeaders,
+        params: cursor ? { cursor } : {},
+      });
       if (response.data.success) {
-        setOrders(response.data.orders);
+        setOrders((prev) =>
+          cursor ? [...prev, ...response.data.orders] : response.data.orders
+        );
+        setNextCursor(response.data.pagination.next_cursor);
       }
     } catch (error) {
       console.error("Erreur lors du chargement des commandes :", error);
@@ -31,9 +38,11 @@ const DeliveryDashboard = () => {
   const updateOrderStatus = async (orderId, newStatus) => {
     try {
       setUpdating(orderId);
-      await axios.put(`${backendUrl}/api/delivery/orders/${orderId}/status/`, {
-        status: newStatus,
-      });
+      await axios.put(
+        `${backendUrl}/api/delivery/orders/${orderId}/status/`,
+        { status: newStatus },
+        authHeaders
+      );
       // mettre à jour localement
       setOrders((prev) =>
         prev.map((o) =>
@@ -51,7 +60,7 @@ const DeliveryDashboard = () => {
     fetchOrders();
   }, []);
 
-  if (loading) {
+  if (loading && orders.length === 0) {
     return (
       <div className="flex justify-center items-center h-60">
         <Loader2 className="w-10 h-10 animate-spin text-gray-500" />
@@ -61,12 +70,16 @@ const DeliveryDashboard = () => {
 
   const renderStatusBadge = (status) => {
     switch (status) {
-      case "received":
-        return <span className="px-2 py-1 text-xs rounded-full bg-yellow-100 text-yellow-700">Reçue</span>;
+      case "assigned":
+        return <span className="px-2 py-1 text-xs rounded-full bg-yellow-100 text-yellow-700">Assignée</span>;
+      case "picked_up":
+      case "in_progress":
+        return <span className="px-2 py-1 text-xs rounded-full bg-blue-100 text-blue-700">En cours</span>;
       case "delivered":
         return <span className="px-2 py-1 text-xs rounded-full bg-green-100 text-green-700">Livrée</span>;
-      case "cancelled":
-        return <span className="px-2 py-1 text-xs rounded-full bg-red-100 text-red-700">Annulée</span>;
+      case "failed":
+      case "returned":
+        return <span className="px-2 py-1 text-xs rounded-full bg-red-100 text-red-700">Échouée</span>;
       default:
         return <span className="px-2 py-1 text-xs rounded-full bg-gray-200 text-gray-600">Inconnue</span>;
     }
@@ -78,7 +91,7 @@ const DeliveryDashboard = () => {
         Tableau de bord du livreur
       </h1>
 
-      {orders.length === 0 ? (
+      {orders.length === 0 && !loading ? (
         <p className="text-gray-500">Aucune commande assignée pour le moment.</p>
       ) : (
         <div className="overflow-x-auto bg-white dark:bg-gray-800 shadow rounded-xl">
@@ -105,7 +118,17 @@ const DeliveryDashboard = () => {
                   <td className="px-4 py-3 font-semibold">{order.total_price} €</td>
                   <td className="px-4 py-3">{renderStatusBadge(order.status)}</td>
                   <td className="px-4 py-3 flex items-center gap-2">
-                    {order.status === "received" && (
+                    {order.status === "assigned" && (
+                      <button
+                        onClick={() => updateOrderStatus(order.id, "picked_up")}
+                        disabled={updating === order.id}
+                        className="bg-blue-500 hover:bg-blue-600 text-white px-3 py-1 rounded-md flex items-center gap-1 text-xs"
+                      >
+                        <Truck size={14} />
+                        {updating === order.id ? "..." : "Récupérée"}
+                      </button>
+                    )}
+                    {(order.status === "picked_up" || order.status === "in_progress") && (
                       <>
                         <button
                           onClick={() => updateOrderStatus(order.id, "delivered")}
@@ -116,12 +139,12 @@ const DeliveryDashboard = () => {
                           {updating === order.id ? "..." : "Marquer Livrée"}
                         </button>
                         <button
-                          onClick={() => updateOrderStatus(order.id, "cancelled")}
+                          onClick={() => updateOrderStatus(order.id, "failed")}
                           disabled={updating === order.id}
                           className="bg-red-500 hover:bg-red-600 text-white px-3 py-1 rounded-md flex items-center gap-1 text-xs"
                         >
                           <XCircle size={14} />
-                          Annuler
+                          Échec
                         </button>
                       </>
                     )}
@@ -130,9 +153,9 @@ const DeliveryDashboard = () => {
                         <Truck size={14} /> Livrée
                       </span>
                     )}
-                    {order.status === "cancelled" && (
+                    {(order.status === "failed" || order.status === "returned") && (
                       <span className="text-red-500 flex items-center gap-1">
-                        <XCircle size={14} /> Annulée
+                        <XCircle size={14} /> Échouée
                       </span>
                     )}
                   </td>
@@ -140,6 +163,17 @@ const DeliveryDashboard = () => {
               ))}
             </tbody>
           </table>
+          {nextCursor && (
+            <div className="flex justify-center p-4">
+              <button
+                onClick={() => fetchOrders(nextCursor)}
+                disabled={loading}
+                className="px-4 py-2 text-sm rounded-md bg-gray-200 dark:bg-gray-700 hover:bg-gray-300"
+              >
+                {loading ? "..." : "Voir plus"}
+              </button>
+            </div>
+          )}
         </div>
       )}
     </div>
@@ -114,7 +114,8 @@ const Login = () => {
               );
 
               if (otpResponse.data.success) {
-                toast.success("Verification code sent to your email!");
+                // method "totp" : code de l'application d'authentification, sinon code reçu par email
+                toast.success(otpResponse.data.message);
                 setShowOtpVerification(true);
                 // Ne pas définir le token maintenant, attendre la vérification OTP
               } else {
@@ -187,6 +188,7 @@ const Login = () => {
         {
           email: formData.email,
           password: formData.password,
+          method: "email",
         }
       );
 
@@ -137,6 +137,59 @@ const PharmacyDashboard = () => {
     }
   }, [activeSection]);
 
+  // Flux temps réel des commandes (Server-Sent Events)
+  useEffect(() => {
+    const token = localStorage.getItem("token");
+    if (!token) return;
+
+    let source = null;
+    let retryTimer = null;
+    let lastEventId = null;
+    let stopped = false;
+
+    // EventSource n'envoie pas d'en-têtes : le flux s'ouvre avec un ticket de courte durée
+    const openStream = async () => {
+      try {
+        const response = await axios.post(
+          backendUrl + "/api/stream-ticket",
+          {},
+          {
+            headers: {
+              Authorization: `Token ${token}`,
+            },
+          }
+        );
+        if (stopped) return;
+
+        const params = new URLSearchParams({ ticket: response.data.ticket });
+        if (lastEventId) params.set("after", lastEventId);
+        source = new EventSource(`${backendUrl}/api/pharmacy/orders/stream?${params}`);
+        source.addEventListener("order", (e) => {
+          lastEventId = e.lastEventId;
+          const event = JSON.parse(e.data);
+          if (!event.from_status) {
+            toast.info(`Nouvelle commande ${event.order_number}`);
+          }
+        });
+        source.onerror = () => {
+          // Ticket expiré lors de la reconnexion : rouvrir avec un nouveau ticket
+          if (source.readyState === EventSource.CLOSED) {
+            retryTimer = setTimeout(openStream, 3000);
+          }
+        };
+      } catch (error) {
+        if (!stopped) retryTimer = setTimeout(openStream, 10000);
+      }
+    };
+    openStream();
+
+    return () => {
+      stopped = true;
+      clearTimeout(retryTimer);
+      if (source) source.close();
+    };
+  }, [backendUrl]);
+
   // Handle add product avec images
   const handleAddProduct = async (e) => {
     e.preventDefault();
@@ -52,7 +52,7 @@ const Product = () => {
         setProductData(product);
 
         if (product.image && product.image.length > 0) {
-          setImage(product.image[0]);
+          setImage((product.image_detail || product.image)[0]);
         }
 
         if (product.quantity_price_list) {
@@ -273,11 +273,11 @@ const Product = () => {
             {productData.image && productData.image.length > 0 ? (
               productData.image.map((item, index) => (
                 <img
-                  onClick={() => setImage(item)}
+                  onClick={() => setImage(productData.image_detail?.[index] || item)}
                   src={item}
                   key={index}
                   className={`w-[24%] sm:w-full sm:mb-3 flex-shrink-0 cursor-pointer border-2 rounded ${
-                    image === item
+                    image === (productData.image_detail?.[index] || item)
                       ? "border-[#02ADEE] dark:border-yellow-400"
                       : "border-gray-200 dark:border-gray-700"
                   }`}
@@ -4,7 +4,7 @@ from medex_app.models import*
 # Register your models here.
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import AppUser, Pharmacy, Medicine, Category, SubCategory, Cart, CartItem
+from .models import AppUser, Pharmacy, Medicine, Category, SubCategory, Cart, CartItem, DeliveryZone, DeliveryFeeBand
 
 class AppUserAdmin(UserAdmin):
     """Configuration admin pour AppUser avec AbstractUser"""
@@ -54,6 +54,8 @@ admin.site.register(Category)
 admin.site.register(SubCategory)
 admin.site.register(Cart)
 admin.site.register(CartItem)
+admin.site.register(DeliveryZone)
+admin.site.register(DeliveryFeeBand)
 
 
 """admin.site.register(AppUser)
@@ -1,23 +1,48 @@
-from django.core.mail import send_mail
 from django.conf import settings
+from django.core import signing
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from django.utils import timezone
-from .models import AppUser, OTPVerification, Pharmacy, Medicine, Order, Payment
+from .models import AppUser, OTPVerification, OutboundEmail, Pharmacy, Medicine
 from .serializers import AppUserSerializer
-from django.db.models import Sum, Count, Q
-from datetime import timedelta
+from . import dashboard_stats, totp
+from .ratelimit import rate_limit
 
 
 # ===========================
 # ADMIN AUTHENTICATION WITH 2FA
 # ===========================
+#
+# L'étape 1 (mot de passe) remet un ticket signé de courte durée ; l'étape 2
+# l'exige, quel que soit le second facteur : un code seul ne connecte personne.
+
+PRE_AUTH_SALT = 'medex_app.admin-pre-auth'
+PRE_AUTH_MAX_AGE = getattr(settings, 'ADMIN_PRE_AUTH_MAX_AGE', 300)
+
+
+def issue_pre_auth_token(user):
+    return signing.dumps({'uid': user.pk, 'stage': 'password_ok'}, salt=PRE_AUTH_SALT)
+
+
+def pre_auth_user_id(ticket):
+    """Identifiant de l'admin dont le mot de passe vient d'être vérifié, ou None"""
+    if not ticket:
+        return None
+    try:
+        data = signing.loads(ticket, salt=PRE_AUTH_SALT, max_age=PRE_AUTH_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    if not isinstance(data, dict) or data.get('stage') != 'password_ok':
+        return None
+    return data.get('uid')
+
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@rate_limit('admin_otp_request')
 def admin_login_request_otp(request):
     """
     Étape 1: L'admin demande un OTP
@@ -56,14 +81,23 @@ def admin_login_request_otp(request):
                 'message': 'Access denied. Admin privileges required.'
             }, status=status.HTTP_403_FORBIDDEN)
         
+        # Application d'authentification configurée : pas d'OTP par email (sauf repli demandé)
+        if user.totp_enabled and request.data.get('method') != 'email':
+            return Response({
+                'success': True,
+                'method': 'totp',
+                'message': 'Enter the code from your authenticator app.',
+                'email': user.email,
+                'pre_auth_token': issue_pre_auth_token(user)
+            }, status=status.HTTP_200_OK)
+        
         # Créer un code OTP
         otp = OTPVerification.create_otp(user)
         
-        # Envoyer l'email avec le code OTP
-        try:
-            send_mail(
-                subject='MedEx Admin - Verification Code',
-                message=f'''
+        # Mettre l'email en file : il est envoyé par le worker outbox, pas pendant la requête
+        OutboundEmail.enqueue(
+            subject='MedEx Admin - Verification Code',
+            body=f'''
 Hello {user.first_name},
 
 Your verification code is: {otp.otp_code}
@@ -75,24 +109,18 @@ If you didn't request this code, please ignore this email.
 Best regards,
 MedEx Team
                 ''',
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[user.email],
-                fail_silently=False,
-            )
-            
-            return Response({
-                'success': True,
-                'message': 'Verification code sent to your email.',
-                'email': user.email,
-                'expires_in': '10 minutes'
-            }, status=status.HTTP_200_OK)
-            
-        except Exception as email_error:
-            print(f"Email sending error: {email_error}")
-            return Response({
-                'success': False,
-                'message': 'Failed to send verification code. Please try again.'
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            to=[user.email],
+            from_email=settings.DEFAULT_FROM_EMAIL,
+        )
+        
+        return Response({
+            'success': True,
+            'method': 'email',
+            'message': 'Verification code sent to your email.',
+            'email': user.email,
+            'expires_in': '10 minutes',
+            'pre_auth_token': issue_pre_auth_token(user)
+        }, status=status.HTTP_200_OK)
     
     except Exception as e:
         print(f"Admin login OTP request error: {e}")
@@ -104,9 +132,11 @@ MedEx Team
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@rate_limit('admin_otp_verify')
 def admin_verify_otp(request):
     """
     Étape 2: Vérifier le code OTP et connecter l'admin
+    Body: {"email", "otp_code", "pre_auth_token" (reçu à l'étape 1)}
     """
     try:
         email = request.data.get('email')
@@ -118,39 +148,51 @@ def admin_verify_otp(request):
                 'message': 'Email and OTP code are required.'
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Récupérer l'utilisateur
-        try:
-            user = AppUser.objects.get(email=email, role='admin')
-        except AppUser.DoesNotExist:
+        # Le mot de passe doit avoir été vérifié à l'étape 1, pour ce même compte
+        user_id = pre_auth_user_id(request.data.get('pre_auth_token'))
+        if user_id is None:
             return Response({
                 'success': False,
-                'message': 'Invalid verification.'
+                'message': 'Login session expired. Please enter your password again.'
             }, status=status.HTTP_401_UNAUTHORIZED)
         
-        # Récupérer le dernier code OTP valide
+        # Récupérer l'utilisateur
         try:
-            otp = OTPVerification.objects.filter(
-                user=user,
-                otp_code=otp_code,
-                is_used=False
-            ).latest('created_at')
-        except OTPVerification.DoesNotExist:
-            return Response({
-                'success': False,
-                'message': 'Invalid or expired verification code.'
-            }, status=status.HTTP_401_UNAUTHORIZED)
-        
-        # Vérifier si le code est expiré
-        if otp.is_expired():
+            user = AppUser.objects.get(pk=user_id, email=email, role='admin')
+        except AppUser.DoesNotExist:
             return Response({
                 'success': False,
-                'message': 'Verification code has expired. Please request a new one.'
+                'message': 'Invalid verification.'
             }, status=status.HTTP_401_UNAUTHORIZED)
         
-        # Marquer le code comme utilisé
-        otp.is_used = True
-        otp.is_verified = True
-        otp.save()
+        # Code de l'application d'authentification : vérifié localement, sans écriture
+        verified_by_app = user.totp_enabled and totp.verify(user.totp_secret, otp_code, user.id)
+        
+        if not verified_by_app:
+            # Repli : code OTP reçu par email
+            try:
+                otp = OTPVerification.objects.filter(
+                    user=user,
+                    otp_code=otp_code,
+                    is_used=False
+                ).latest('created_at')
+            except OTPVerification.DoesNotExist:
+                return Response({
+                    'success': False,
+                    'message': 'Invalid or expired verification code.'
+                }, status=status.HTTP_401_UNAUTHORIZED)
+            
+            # Vérifier si le code est expiré
+            if otp.is_expired():
+                return Response({
+                    'success': False,
+                    'message': 'Verification code has expired. Please request a new one.'
+                }, status=status.HTTP_401_UNAUTHORIZED)
+            
+            # Marquer le code comme utilisé
+            otp.is_used = True
+            otp.is_verified = True
+            otp.save()
         
         # Créer ou récupérer le token
         token, created = Token.objects.get_or_create(user=user)
@@ -183,6 +225,135 @@ def admin_verify_otp(request):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+# ===========================
+# ADMIN 2FA : APPLICATION D'AUTHENTIFICATION (TOTP)
+# ===========================
+
+def _admin_only(user):
+    if user.role != 'admin':
+        return Response({
+            'success': False,
+            'message': 'Access denied. Admin privileges required.'
+        }, status=status.HTTP_403_FORBIDDEN)
+    return None
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def admin_totp_setup(request):
+    """
+    Étape 1 de l'enrôlement : générer un secret et le QR code à scanner.
+    Le secret n'est actif qu'après confirmation d'un premier code.
+    """
+    try:
+        user = request.user
+        denied = _admin_only(user)
+        if denied:
+            return denied
+        
+        if user.totp_enabled:
+            return Response({
+                'success': False,
+                'message': 'Authenticator app is already enabled. Disable it first.'
+            }, status=status.HTTP_409_CONFLICT)
+        
+        user.totp_secret = totp.new_secret()
+        user.totp_confirmed_at = None
+        user.save(update_fields=['totp_secret', 'totp_confirmed_at'])
+        
+        uri = totp.provisioning_uri(user.totp_secret, user.email)
+        return Response({
+            'success': True,
+            'secret': user.totp_secret,
+            'otpauth_uri': uri,
+            'qr_code': totp.qr_code_data_uri(uri)
+        }, status=status.HTTP_200_OK)
+    
+    except Exception as e:
+        print(f"Admin TOTP setup error: {e}")
+        return Response({
+            'success': False,
+            'message': 'An error occurred. Please try again.'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def admin_totp_confirm(request):
+    """Étape 2 de l'enrôlement : confirmer avec un code de l'application"""
+    try:
+        user = request.user
+        denied = _admin_only(user)
+        if denied:
+            return denied
+        
+        if not user.totp_secret:
+            return Response({
+                'success': False,
+                'message': 'Start the authenticator setup first.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        if not totp.verify(user.totp_secret, request.data.get('code'), user.id):
+            return Response({
+                'success': False,
+                'message': 'Invalid verification code.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        user.totp_confirmed_at = timezone.now()
+        user.save(update_fields=['totp_confirmed_at'])
+        
+        return Response({
+            'success': True,
+            'message': 'Authenticator app enabled.'
+        }, status=status.HTTP_200_OK)
+    
+    except Exception as e:
+        print(f"Admin TOTP confirm error: {e}")
+        return Response({
+            'success': False,
+            'message': 'An error occurred. Please try again.'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def admin_totp_disable(request):
+    """Désactiver l'application d'authentification (code actuel requis) ; retour à l'OTP email"""
+    try:
+        user = request.user
+        denied = _admin_only(user)
+        if denied:
+            return denied
+        
+        if not user.totp_enabled:
+            return Response({
+                'success': False,
+                'message': 'Authenticator app is not enabled.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        if not totp.verify(user.totp_secret, request.data.get('code'), user.id):
+            return Response({
+                'success': False,
+                'message': 'Invalid verification code.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        user.totp_secret = None
+        user.totp_confirmed_at = None
+        user.save(update_fields=['totp_secret', 'totp_confirmed_at'])
+        
+        return Response({
+            'success': True,
+            'message': 'Authenticator app disabled. Verification codes will be sent by email.'
+        }, status=status.HTTP_200_OK)
+    
+    except Exception as e:
+        print(f"Admin TOTP disable error: {e}")
+        return Response({
+            'success': False,
+            'message': 'An error occurred. Please try again.'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 # ===========================
 # ADMIN DASHBOARD STATISTICS
 # ===========================
@@ -190,7 +361,11 @@ def admin_verify_otp(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def admin_dashboard_stats(request):
-    """Statistiques complètes du dashboard admin"""
+    """
+    Statistiques complètes du dashboard admin, servies depuis un snapshot
+    recalculé en arrière-plan (voir dashboard_stats.py).
+    ?refresh=1 force un recalcul immédiat.
+    """
     try:
         user = request.user
         
@@ -201,107 +376,12 @@ def admin_dashboard_stats(request):
                 'message': 'Access denied. Admin privileges required.'
             }, status=status.HTTP_403_FORBIDDEN)
         
-        # Statistiques des utilisateurs
-        total_users = AppUser.objects.count()
-        total_clients = AppUser.objects.filter(role='client').count()
-        total_pharmacists = AppUser.objects.filter(role='pharmacist').count()
-        total_delivery = AppUser.objects.filter(role='delivery').count()
-        total_admins = AppUser.objects.filter(role='admin').count()
-        
-        # Nouveaux utilisateurs (derniers 30 jours)
-        thirty_days_ago = timezone.now() - timedelta(days=30)
-        new_users_last_month = AppUser.objects.filter(
-            date_joined__gte=thirty_days_ago
-        ).count()
-        
-        # Statistiques des pharmacies
-        total_pharmacies = Pharmacy.objects.count()
-        verified_pharmacies = Pharmacy.objects.filter(is_verified=True).count()
-        pending_pharmacies = Pharmacy.objects.filter(is_verified=False).count()
-        
-        # Statistiques des produits
-        total_products = Medicine.objects.count()
-        approved_products = Medicine.objects.filter(is_approved=True).count()
-        pending_products = Medicine.objects.filter(is_approved=False).count()
-        active_products = Medicine.objects.filter(is_active=True, is_approved=True).count()
-        
-        # Statistiques des commandes
-        total_orders = Order.objects.count()
-        pending_orders = Order.objects.filter(status='pending').count()
-        delivered_orders = Order.objects.filter(status='delivered').count()
-        
-        # Revenus (delivery fees)
-        total_delivery_fees = Payment.objects.filter(
-            payment_status='success'
-        ).aggregate(
-            total=Sum('order__delivery_fee')
-        )['total'] or 0
-        
-        # Revenus totaux
-        total_revenue = Payment.objects.filter(
-            payment_status='success'
-        ).aggregate(
-            total=Sum('amount')
-        )['total'] or 0
-        
-        # Statistiques par mois (3 derniers mois)
-        three_months_ago = timezone.now() - timedelta(days=90)
-        monthly_orders = Order.objects.filter(
-            order_date__gte=three_months_ago
-        ).extra(
-            select={'month': 'EXTRACT(month FROM order_date)'}
-        ).values('month').annotate(
-            count=Count('id'),
-            revenue=Sum('final_amount')
-        ).order_by('month')
-        
-        # Top pharmacies (par nombre de commandes)
-        top_pharmacies = Pharmacy.objects.annotate(
-            order_count=Count('orders')
-        ).order_by('-order_count')[:5]
-        
-        top_pharmacies_data = [{
-            'id': p.id,
-            'name': p.name,
-            'order_count': p.order_count,
-            'is_verified': p.is_verified,
-            'rating': float(p.rating)
-        } for p in top_pharmacies]
+        snapshot = dashboard_stats.get_snapshot(force=request.query_params.get('refresh') == '1')
         
         return Response({
             'success': True,
-            'stats': {
-                'users': {
-                    'total': total_users,
-                    'clients': total_clients,
-                    'pharmacists': total_pharmacists,
-                    'delivery_persons': total_delivery,
-                    'admins': total_admins,
-                    'new_last_month': new_users_last_month
-                },
-                'pharmacies': {
-                    'total': total_pharmacies,
-                    'verified': verified_pharmacies,
-                    'pending': pending_pharmacies
-                },
-                'products': {
-                    'total': total_products,
-                    'approved': approved_products,
-                    'pending': pending_products,
-                    'active': active_products
-                },
-                'orders': {
-                    'total': total_orders,
-                    'pending': pending_orders,
-                    'delivered': delivered_orders
-                },
-                'revenue': {
-                    'total': float(total_revenue),
-                    'delivery_fees': float(total_delivery_fees)
-                },
-                'top_pharmacies': top_pharmacies_data,
-                'monthly_stats': list(monthly_orders)
-            }
+            'stats': snapshot['stats'],
+            'generated_at': snapshot['generated_at']
         }, status=status.HTTP_200_OK)
     
     except Exception as e:
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class MedexAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'medex_app'
+
+    def ready(self):
+        # Signaux d'invalidation du cache d'authentification et des tarifs de livraison,
+        # libération des logos de pharmacie dans le stockage partagé ; vérification du cache partagé
+        from . import authentication, checks, media_store, pricing  # noqa: F401
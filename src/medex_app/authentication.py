@@ -0,0 +1,292 @@
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import FilteredRelation, OuterRef, Q, Subquery
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.authtoken.models import Token
+
+from .models import AppUser, Pharmacy
+
+
+# ===========================
+# CONTEXTE D'IDENTITÉ : UTILISATEUR + TOKEN + PHARMACIE
+# ===========================
+
+class IdentityContext:
+    """Utilisateur authentifié, son token et (pour un pharmacien) sa pharmacie"""
+    __slots__ = ('user', 'token', 'pharmacy')
+
+    def __init__(self, user, token=None, pharmacy=None):
+        self.user = user
+        self.token = token
+        self.pharmacy = pharmacy
+
+    @property
+    def has_pharmacy(self):
+        return self.pharmacy is not None
+
+    def copy(self):
+        # Copies : chaque requête peut modifier ses objets sans toucher au cache
+        user = copy.copy(self.user)
+        token = copy.copy(self.token) if self.token is not None else None
+        if token is not None:
+            token.user = user
+            token.__dict__.pop('identity', None)
+        pharmacy = copy.copy(self.pharmacy) if self.pharmacy is not None else None
+        return IdentityContext(user, token, pharmacy)
+
+
+def load_identity(token):
+    """Compléter un token (utilisateur déjà chargé) avec la pharmacie du pharmacien"""
+    user = token.user
+    pharmacy = None
+    if user.role == 'pharmacist':
+        pharmacy = Pharmacy.objects.filter(owner_id=user.pk).order_by('id').first()
+    return IdentityContext(user, token, pharmacy)
+
+
+def fetch_identity(key):
+    """
+    Token + utilisateur + pharmacie du pharmacien en une seule requête : la
+    pharmacie la plus ancienne est jointe (LEFT JOIN) comme dans load_identity.
+    """
+    first_pharmacy = Pharmacy.objects.filter(owner_id=OuterRef('user_id')).order_by('id').values('id')[:1]
+    token = Token.objects.annotate(
+        owned_pharmacy=FilteredRelation(
+            'user__pharmacies', condition=Q(user__pharmacies__id=Subquery(first_pharmacy))
+        )
+    ).select_related('user', 'owned_pharmacy').get(key=key)
+    # Attribut absent quand la jointure ne trouve aucune pharmacie
+    pharmacy = token.__dict__.pop('owned_pharmacy', None)
+    if token.user.role != 'pharmacist':
+        pharmacy = None
+    return IdentityContext(token.user, token, pharmacy)
+
+
+def get_identity(request):
+    """
+    Contexte d'identité de la requête courante. Avec CachedTokenAuthentication il
+    est déjà chargé (et en cache) ; sinon il est construit une fois par requête.
+    """
+    identity = getattr(request.auth, 'identity', None)
+    if identity is not None:
+        return identity
+    identity = getattr(request, '_identity', None)
+    if identity is None:
+        user = request.user
+        pharmacy = None
+        if getattr(user, 'role', None) == 'pharmacist':
+            pharmacy = Pharmacy.objects.filter(owner_id=user.pk).order_by('id').first()
+        identity = IdentityContext(user, request.auth, pharmacy)
+        request._identity = identity
+    return identity
+
+
+def remember_identity(identity):
+    """Mettre en cache le contexte d'un utilisateur qui vient de se connecter"""
+    if identity.token is not None:
+        token_cache.set(identity)
+
+
+# ===========================
+# TICKETS DE FLUX (EventSource)
+# ===========================
+#
+# EventSource ne permet pas d'envoyer d'en-têtes : plutôt que le token d'API
+# en ?token= (qui finirait dans les journaux d'accès et des proxys), le client
+# demande un ticket signé valable STREAM_TICKET_MAX_AGE secondes, qui n'ouvre
+# que les flux, et le passe en ?ticket=.
+
+STREAM_TICKET_SALT = 'medex_app.stream-ticket'
+STREAM_TICKET_MAX_AGE = getattr(settings, 'STREAM_TICKET_MAX_AGE', 60)
+
+
+def issue_stream_ticket(user):
+    return signing.dumps({'user': user.pk}, salt=STREAM_TICKET_SALT, compress=True)
+
+
+async def stream_user(request):
+    """Utilisateur d'une requête de flux : en-tête Authorization: Token ..., ou ?ticket= signé"""
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Token '):
+        try:
+            token = await Token.objects.select_related('user').aget(key=header[6:].strip())
+        except Token.DoesNotExist:
+            return None
+        user = token.user
+    else:
+        ticket = request.GET.get('ticket')
+        if not ticket:
+            return None
+        try:
+            user_id = signing.loads(ticket, salt=STREAM_TICKET_SALT, max_age=STREAM_TICKET_MAX_AGE)['user']
+        except (signing.BadSignature, KeyError, TypeError):
+            return None
+        user = await AppUser.objects.filter(pk=user_id).afirst()
+        if user is None:
+            return None
+    return user if user.is_active else None
+
+
+# ===========================
+# CACHE TOKEN → CONTEXTE D'IDENTITÉ (EN MÉMOIRE, PAR PROCESSUS)
+# ===========================
+#
+# Chaque processus garde ses propres entrées. Pour que les autres workers voient
+# une révocation (déconnexion, désactivation, pharmacie modifiée), les signaux
+# changent aussi une génération par utilisateur dans le cache partagé, après le
+# commit ; une entrée n'est servie que si sa génération est toujours la même
+# (une lecture du cache partagé par requête, aucune requête SQL).
+
+GENERATION_KEY = 'auth-generation:{}'
+
+
+def user_generation(user_id):
+    return cache.get(GENERATION_KEY.format(user_id))
+
+
+def bump_user_generation(user_id):
+    """Révoquer les entrées de cet utilisateur dans tous les processus"""
+    cache.set(GENERATION_KEY.format(user_id), uuid.uuid4().hex, None)
+
+class TokenCache:
+    """Cache LRU borné avec expiration (TTL)"""
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, generation, identity)
+        self._keys_by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, generation, identity = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+        if user_generation(identity.user.pk) != generation:
+            # Révoqué depuis un autre processus
+            self.invalidate(key)
+            return None
+        return identity.copy()
+
+    def set(self, identity):
+        identity = identity.copy()
+        key = identity.token.key
+        generation = user_generation(identity.user.pk)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, generation, identity)
+            self._keys_by_user.setdefault(identity.user.pk, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in list(self._keys_by_user.get(user_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        user_id = entry[2].user.pk
+        keys = self._keys_by_user.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[user_id]
+
+
+token_cache = TokenCache(
+    max_size=getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 60)
+)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication sans requête token + utilisateur (+ pharmacie) à chaque
+    appel : le contexte est gardé en mémoire jusqu'à expiration ou invalidation.
+    """
+
+    def authenticate_credentials(self, key):
+        identity = token_cache.get(key)
+        if identity is None:
+            # Mêmes contrôles que TokenAuthentication, pharmacie comprise dans la même requête
+            try:
+                identity = fetch_identity(key)
+            except Token.DoesNotExist:
+                raise AuthenticationFailed(_('Invalid token.'))
+            if not identity.user.is_active:
+                raise AuthenticationFailed(_('User inactive or deleted.'))
+            token_cache.set(identity)
+        # Le contexte complet (pharmacie comprise) reste accessible via get_identity(request)
+        identity.token.identity = identity
+        return (identity.user, identity.token)
+
+
+# ===========================
+# INVALIDATION
+# ===========================
+
+def _revoke_everywhere(user_id):
+    # Après le commit : un autre worker qui recharge ensuite lit les nouvelles données
+    transaction.on_commit(lambda: bump_user_generation(user_id))
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    """Déconnexion (logout_user) ou suppression du token"""
+    token_cache.invalidate(instance.key)
+    _revoke_everywhere(instance.user_id)
+
+
+@receiver(post_save, sender=AppUser)
+def invalidate_saved_user(sender, instance, created, **kwargs):
+    """Désactivation, changement de rôle ou de profil : recharger l'utilisateur"""
+    if not created:
+        token_cache.invalidate_user(instance.pk)
+        _revoke_everywhere(instance.pk)
+
+
+@receiver(post_delete, sender=AppUser)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    token_cache.invalidate_user(instance.pk)
+    _revoke_everywhere(instance.pk)
+
+
+@receiver(post_save, sender=Pharmacy)
+@receiver(post_delete, sender=Pharmacy)
+def invalidate_pharmacy_owner(sender, instance, **kwargs):
+    """Pharmacie créée, modifiée (vérification, nom) ou supprimée : recharger le contexte du pharmacien"""
+    token_cache.invalidate_user(instance.owner_id)
+    _revoke_everywhere(instance.owner_id)
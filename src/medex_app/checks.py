@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+
+# Caches dont le contenu n'est visible que du processus qui l'a écrit
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+# ===========================
+# VÉRIFICATIONS AU DÉMARRAGE
+# ===========================
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Limiteur de débit, anti-rejeu TOTP, verrou du snapshot admin et positions des
+    livreurs reposent sur un cache vu par tous les workers : avec un cache par
+    processus, chaque worker aurait son propre budget et ses propres codes déjà
+    utilisés, et la commande dispatch_deliveries ne verrait aucun livreur.
+    """
+    aliases = {
+        'default',
+        getattr(settings, 'RATE_LIMIT_CACHE', 'default'),
+        getattr(settings, 'DELIVERY_TRACKING_CACHE', 'default'),
+    }
+    errors = []
+    for alias in sorted(aliases):
+        backend = settings.CACHES.get(alias, {}).get('BACKEND')
+        if backend in PROCESS_LOCAL_CACHES:
+            errors.append(Error(
+                f"The '{alias}' cache ({backend}) is local to each process.",
+                hint="Configure a cache shared by all workers, e.g. "
+                     "django.core.cache.backends.redis.RedisCache (REDIS_URL).",
+                obj='settings.CACHES',
+                id='medex_app.E001',
+            ))
+    return errors
@@ -0,0 +1,145 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .models import AppUser, Medicine, Order, Payment, Pharmacy
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_KEY = 'admin-dashboard:stats'
+REFRESH_LOCK_KEY = 'admin-dashboard:refreshing'
+# Âge au-delà duquel le snapshot est recalculé en arrière-plan (il reste servi entre-temps)
+REFRESH_INTERVAL = getattr(settings, 'ADMIN_STATS_REFRESH_INTERVAL', 60)
+SNAPSHOT_TTL = 24 * 3600
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='admin-stats')
+
+
+# ===========================
+# STATISTIQUES DU DASHBOARD ADMIN
+# ===========================
+#
+# Une requête d'agrégation conditionnelle par modèle (Count(filter=Q(...))),
+# plus l'historique mensuel et le classement des pharmacies : 7 requêtes au
+# total, exécutées hors requête HTTP. Le dashboard lit le dernier snapshot
+# dans le cache ; un snapshot trop ancien est servi tel quel pendant qu'un
+# seul worker le recalcule. Snapshot et verrou (cache.add) doivent être vus de
+# tous les workers : un cache propre à chaque processus est refusé au
+# démarrage (vérification medex_app.E001).
+
+def compute_stats():
+    now = timezone.now()
+
+    users = AppUser.objects.aggregate(
+        total=Count('id'),
+        clients=Count('id', filter=Q(role='client')),
+        pharmacists=Count('id', filter=Q(role='pharmacist')),
+        delivery_persons=Count('id', filter=Q(role='delivery')),
+        admins=Count('id', filter=Q(role='admin')),
+        new_last_month=Count('id', filter=Q(date_joined__gte=now - timedelta(days=30))),
+    )
+    pharmacies = Pharmacy.objects.aggregate(
+        total=Count('id'),
+        verified=Count('id', filter=Q(is_verified=True)),
+        pending=Count('id', filter=Q(is_verified=False)),
+    )
+    products = Medicine.objects.aggregate(
+        total=Count('id'),
+        approved=Count('id', filter=Q(is_approved=True)),
+        pending=Count('id', filter=Q(is_approved=False)),
+        active=Count('id', filter=Q(is_active=True, is_approved=True)),
+    )
+    orders = Order.objects.aggregate(
+        total=Count('id'),
+        pending=Count('id', filter=Q(status='pending')),
+        delivered=Count('id', filter=Q(status='delivered')),
+    )
+    revenue = Payment.objects.filter(payment_status='success').aggregate(
+        total=Sum('amount'),
+        delivery_fees=Sum('order__delivery_fee'),
+    )
+
+    # Statistiques par mois (3 derniers mois)
+    monthly_orders = Order.objects.filter(
+        order_date__gte=now - timedelta(days=90)
+    ).annotate(
+        period=TruncMonth('order_date')
+    ).values('period').annotate(
+        count=Count('id'),
+        revenue=Sum('final_amount')
+    ).order_by('period')
+
+    # Top pharmacies (par nombre de commandes)
+    top_pharmacies = Pharmacy.objects.annotate(
+        order_count=Count('orders')
+    ).order_by('-order_count').values('id', 'name', 'order_count', 'is_verified', 'rating')[:5]
+
+    return {
+        'users': users,
+        'pharmacies': pharmacies,
+        'products': products,
+        'orders': orders,
+        'revenue': {
+            'total': float(revenue['total'] or 0),
+            'delivery_fees': float(revenue['delivery_fees'] or 0)
+        },
+        'top_pharmacies': [
+            dict(pharmacy, rating=float(pharmacy['rating'])) for pharmacy in top_pharmacies
+        ],
+        'monthly_stats': [
+            {
+                'month': row['period'].month,
+                'year': row['period'].year,
+                'count': row['count'],
+                'revenue': float(row['revenue'] or 0)
+            }
+            for row in monthly_orders
+        ],
+    }
+
+
+def refresh_snapshot():
+    """Recalculer et publier le snapshot ; retourne-le"""
+    snapshot = {
+        'stats': compute_stats(),
+        'generated_at': timezone.now().isoformat(),
+        'generated_ts': time.time(),
+    }
+    cache.set(SNAPSHOT_KEY, snapshot, timeout=SNAPSHOT_TTL)
+    return snapshot
+
+
+def _refresh_in_background():
+    close_old_connections()
+    try:
+        refresh_snapshot()
+    except Exception:
+        logger.exception("Admin dashboard stats refresh failed")
+    finally:
+        cache.delete(REFRESH_LOCK_KEY)
+        close_old_connections()
+
+
+def get_snapshot(force=False):
+    """
+    Dernier snapshot des statistiques. Calculé sur place s'il n'existe pas
+    (ou si force) ; sinon servi depuis le cache, et relancé en arrière-plan
+    s'il a plus de REFRESH_INTERVAL secondes.
+    """
+    snapshot = None if force else cache.get(SNAPSHOT_KEY)
+    if snapshot is None:
+        return refresh_snapshot()
+    if time.time() - snapshot['generated_ts'] > REFRESH_INTERVAL:
+        # Un seul recalcul à la fois, tous processus confondus
+        if cache.add(REFRESH_LOCK_KEY, True, timeout=300):
+            _executor.submit(_refresh_in_background)
+    return snapshot
@@ -0,0 +1,446 @@
+import asyncio
+import json
+
+from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework import status
+from .models import Delivery, DeliveryTrail
+from .order_state import can_transition, transition
+from .pagination import paginate_keyset, InvalidCursor
+from .serializers import DeliveryDashboardOrderSerializer, GPSBatchSerializer, GPSUpdateSerializer
+from .authentication import stream_user
+from .live_tracking import hub
+from .routes import ready_order_batches, ROUTE_WINDOW_MINUTES
+from . import eta, tracking, trails
+
+
+LIVE_HEARTBEAT_INTERVAL = 15
+LIVE_MAX_STREAM_SECONDS = 600
+
+# Statuts que le livreur peut donner à une livraison, depuis chaque statut
+DELIVERY_TRANSITIONS = {
+    'assigned': {'picked_up', 'failed'},
+    'picked_up': {'in_progress', 'delivered', 'failed'},
+    'in_progress': {'delivered', 'failed', 'returned'},
+    'failed': {'returned'},
+}
+# Statut de la commande qui suit celui de la livraison. Quand les produits sont
+# de nouveau à la pharmacie (échec avant l'enlèvement, ou retour après un échec
+# en cours de route), la commande redevient prête et la livraison repart en
+# attente, sans livreur, pour être reprise par le dispatch.
+ORDER_STATUS_FOR_DELIVERY = {
+    'picked_up': 'in_delivery',
+    'delivered': 'delivered',
+    'returned': 'ready_for_pickup',
+}
+
+
+def goods_at_pharmacy(previous_status, new_status):
+    """Échec avant l'enlèvement, ou retour : rien n'est resté chez le livreur"""
+    return new_status == 'returned' or (new_status == 'failed' and previous_status == 'assigned')
+
+
+def release_delivery(delivery):
+    """Remettre la livraison en attente de dispatch (même transaction que le changement de statut)"""
+    delivery.delivery_status = 'pending'
+    delivery.delivery_person = None
+    delivery.assigned_date = None
+    delivery.pickup_date = None
+    delivery.save(update_fields=['delivery_status', 'delivery_person', 'assigned_date', 'pickup_date', 'updated_at'])
+    delivery_id = delivery.id
+    transaction.on_commit(lambda: tracking.forget_courier(delivery_id))
+
+
+# ===========================
+# COMMANDES DU LIVREUR (Tableau de bord)
+# ===========================
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def delivery_orders(request):
+    """
+    Livraisons assignées au livreur connecté, les plus récentes d'abord.
+    Query params: status, limit, cursor ; delivery_man_id (admin uniquement).
+    Une seule requête SQL par page, quel que soit le nombre de livraisons.
+    """
+    try:
+        user = request.user
+        courier_id = user.id
+        if user.role == 'admin' and request.query_params.get('delivery_man_id'):
+            try:
+                courier_id = int(request.query_params['delivery_man_id'])
+            except ValueError:
+                return Response({
+                    'success': False,
+                    'message': 'Invalid delivery_man_id.'
+                }, status=status.HTTP_400_BAD_REQUEST)
+        elif user.role != 'delivery':
+            return Response({
+                'success': False,
+                'message': 'Only delivery persons can view their orders.'
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        queryset = Delivery.objects.filter(delivery_person_id=courier_id).select_related(
+            'order__user'
+        ).only(
+            'id', 'order_id', 'delivery_status', 'tracking_number', 'estimated_delivery_time',
+            'order__order_number', 'order__delivery_phone', 'order__delivery_address', 'order__final_amount',
+            'order__user__first_name', 'order__user__last_name',
+        )
+        status_filter = request.query_params.get('status')
+        if status_filter:
+            if status_filter not in dict(Delivery.STATUS_CHOICES):
+                return Response({
+                    'success': False,
+                    'message': 'Invalid status.'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(delivery_status=status_filter)
+
+        try:
+            deliveries, pagination = paginate_keyset(queryset, request.query_params, fields=('id',))
+        except InvalidCursor:
+            return Response({
+                'success': False,
+                'message': 'Invalid cursor.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'success': True,
+            'orders': DeliveryDashboardOrderSerializer(deliveries, many=True).data,
+            'pagination': pagination
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['PUT'])
+@permission_classes([IsAuthenticated])
+def update_delivery_status(request, order_id):
+    """
+    Changer le statut de la livraison d'une commande (livreur assigné uniquement).
+    Body: {"status": "picked_up" | "in_progress" | "delivered" | "failed" | "returned",
+           "reason": "..." (échec), "notes": "..."}
+    """
+    try:
+        new_status = request.data.get('status')
+        if new_status not in dict(Delivery.STATUS_CHOICES):
+            return Response({
+                'success': False,
+                'message': 'Invalid status.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            delivery = Delivery.objects.select_for_update().filter(
+                order_id=order_id, delivery_person_id=request.user.id
+            ).first()
+            if delivery is None:
+                return Response({
+                    'success': False,
+                    'message': 'Delivery not found.'
+                }, status=status.HTTP_404_NOT_FOUND)
+
+            current = delivery.delivery_status
+            if new_status not in DELIVERY_TRANSITIONS.get(current, ()):
+                return Response({
+                    'success': False,
+                    'message': f"Cannot change delivery status from '{current}' to '{new_status}'.",
+                    'allowed_statuses': sorted(DELIVERY_TRANSITIONS.get(current, ()))
+                }, status=status.HTTP_409_CONFLICT)
+
+            now = timezone.now()
+            delivery.delivery_status = new_status
+            update_fields = ['delivery_status', 'updated_at']
+            if new_status == 'picked_up':
+                delivery.pickup_date = now
+                update_fields.append('pickup_date')
+            elif new_status == 'delivered':
+                delivery.delivery_date = delivery.actual_delivery_time = now
+                update_fields += ['delivery_date', 'actual_delivery_time']
+            elif new_status == 'failed':
+                delivery.failure_reason = request.data.get('reason') or delivery.failure_reason
+                update_fields.append('failure_reason')
+            if request.data.get('notes'):
+                delivery.delivery_notes = request.data['notes']
+                update_fields.append('delivery_notes')
+            delivery.save(update_fields=update_fields)
+
+            order_status = ORDER_STATUS_FOR_DELIVERY.get(new_status)
+            if goods_at_pharmacy(current, new_status):
+                # Après un échec en cours de route, on attend le retour des produits ('returned')
+                order_status = 'ready_for_pickup'
+                release_delivery(delivery)
+            order = delivery.order
+            if order_status and can_transition(order.status, order_status):
+                transition(order, order_status, changed_by=request.user)
+
+        return Response({
+            'success': True,
+            'message': 'Status updated successfully',
+            'new_status': new_status,
+            'order_status': order.status
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# ===========================
+# POSITIONS GPS (Livreur)
+# ===========================
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def ingest_delivery_locations(request, delivery_id):
+    """
+    Recevoir un lot de positions du livreur.
+    Body: {"points": [{"latitude", "longitude", "recorded_at"}, ...]}
+    (un point seul {"latitude", "longitude"} est aussi accepté).
+    Aucune écriture SQL ici : les points (et l'heure d'arrivée estimée, recalculée
+    à chaque lot) sont écrits par lots en arrière-plan.
+    """
+    try:
+        user = request.user
+
+        if user.role != 'delivery':
+            return Response({
+                'success': False,
+                'message': 'Only delivery persons can send locations.'
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        if not tracking.is_assigned_courier(user.id, delivery_id):
+            return Response({
+                'success': False,
+                'message': 'Delivery not found.'
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        data = request.data
+        if 'points' not in data:
+            data = {'points': [data]}
+        serializer = GPSBatchSerializer(data=data)
+        if not serializer.is_valid():
+            return Response({
+                'success': False,
+                'errors': serializer.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        now = timezone.now()
+        points = [
+            (point['latitude'], point['longitude'], min(point.get('recorded_at') or now, now))
+            for point in serializer.validated_data['points']
+        ]
+        try:
+            position = tracking.buffer.add(
+                delivery_id, points,
+                estimate=lambda lat, lng, at: eta.estimate_arrival(delivery_id, lat, lng, at)
+            )
+            tracking.publish_courier_position(user.id, position)
+        except OverflowError:
+            return Response({
+                'success': False,
+                'message': 'Too many pending locations. Please retry shortly.'
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        return Response({
+            'success': True,
+            'accepted': len(points),
+            'position': position
+        }, status=status.HTTP_202_ACCEPTED)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def report_courier_position(request):
+    """
+    Position d'un livreur disponible (sans livraison en cours).
+    Body: {"latitude", "longitude"}. Le livreur reste proposé à l'assignation
+    tant qu'il envoie sa position ; aucune écriture SQL.
+    """
+    try:
+        user = request.user
+
+        if user.role != 'delivery':
+            return Response({
+                'success': False,
+                'message': 'Only delivery persons can send locations.'
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        serializer = GPSUpdateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({
+                'success': False,
+                'errors': serializer.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        now = timezone.now()
+        position = {
+            'latitude': float(serializer.validated_data['latitude']),
+            'longitude': float(serializer.validated_data['longitude']),
+            'recorded_at': min(serializer.validated_data.get('recorded_at') or now, now).isoformat(),
+        }
+        tracking.publish_courier_position(user.id, position)
+
+        return Response({
+            'success': True,
+            'position': position
+        }, status=status.HTTP_202_ACCEPTED)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def delivery_trail(request, delivery_id):
+    """
+    Trace parcourue par le livreur, en polyligne encodée (précision 5,
+    directement utilisable par Google Maps / Leaflet). Réservée au client,
+    à la pharmacie, au livreur de la commande et aux admins.
+    """
+    try:
+        user = request.user
+        delivery = Delivery.objects.filter(id=delivery_id).values(
+            'delivery_person_id', 'order__user_id', 'order__pharmacy__owner_id'
+        ).first()
+        allowed = delivery and (user.role == 'admin' or user.id in (
+            delivery['delivery_person_id'], delivery['order__user_id'], delivery['order__pharmacy__owner_id']
+        ))
+        if not allowed:
+            return Response({
+                'success': False,
+                'message': 'Delivery not found.'
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        trail = DeliveryTrail.objects.filter(delivery_id=delivery_id).first()
+        if trail is None:
+            latitudes = longitudes = timestamps = ()
+        else:
+            latitudes, longitudes, timestamps = trails.points(trail)
+
+        return Response({
+            'success': True,
+            'polyline': trails.encode_polyline(latitudes, longitudes),
+            'point_count': len(timestamps),
+            'started_at': trails.from_timestamp(timestamps[0]) if timestamps else None,
+            'ended_at': trails.from_timestamp(timestamps[-1]) if timestamps else None
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# ===========================
+# TOURNÉES (Tableau de bord livreur)
+# ===========================
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def delivery_routes(request):
+    """
+    Tournées proposées : commandes prêtes regroupées par pharmacie et fenêtre de temps,
+    arrêts dans l'ordre de passage.
+    Query params: pharmacy_id (optionnel), window (minutes, défaut 30)
+    """
+    try:
+        if request.user.role not in ('delivery', 'admin'):
+            return Response({
+                'success': False,
+                'message': 'Only delivery persons can view routes.'
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            pharmacy_id = request.query_params.get('pharmacy_id')
+            pharmacy_ids = [int(pharmacy_id)] if pharmacy_id else None
+            window = min(max(int(request.query_params.get('window', ROUTE_WINDOW_MINUTES)), 1), 24 * 60)
+        except ValueError:
+            return Response({
+                'success': False,
+                'message': 'Invalid pharmacy_id or window.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'success': True,
+            'routes': ready_order_batches(pharmacy_ids, window)
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# ===========================
+# SUIVI EN DIRECT (Client)
+# ===========================
+
+async def order_tracking_stream(request, order_id):
+    """
+    Flux Server-Sent Events de la livraison d'une commande : événements
+    "position" et "status". Réservé au client, à la pharmacie et au livreur
+    de la commande. Tous les abonnés d'une livraison partagent un seul publieur ;
+    un abonné inactif ne coûte qu'une coroutine en attente.
+    """
+    user = await stream_user(request)
+    if user is None:
+        return JsonResponse({'success': False, 'message': 'Authentication required.'}, status=401)
+
+    delivery = await Delivery.objects.filter(order_id=order_id).values(
+        'id', 'delivery_person_id', 'order__user_id', 'order__pharmacy__owner_id'
+    ).afirst()
+    allowed = delivery and user.id in (
+        delivery['order__user_id'], delivery['delivery_person_id'], delivery['order__pharmacy__owner_id']
+    )
+    if not allowed:
+        return JsonResponse({'success': False, 'message': 'Delivery not found.'}, status=404)
+
+    async def stream():
+        publisher, queue = await hub.subscribe(delivery['id'])
+        try:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + LIVE_MAX_STREAM_SECONDS
+            yield 'retry: 3000\n\n'
+            while loop.time() < deadline:
+                try:
+                    event = await asyncio.wait_for(queue.get(), LIVE_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                if event is None:
+                    # Livraison terminée (ou publieur arrêté) : le client ne se reconnecte pas
+                    yield 'event: end\ndata: {}\n\n'
+                    return
+                if isinstance(event, Exception):
+                    # Publieur qui n'a pas pu démarrer : couper le flux, EventSource se reconnecte
+                    raise event
+                name, data = event
+                yield f"event: {name}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            hub.unsubscribe(publisher, queue)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,191 @@
+import logging
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import AppUser, Delivery
+from . import tracking
+
+
+logger = logging.getLogger(__name__)
+
+COURIER_CAPACITY = getattr(settings, 'DELIVERY_COURIER_CAPACITY', 3)
+MAX_PICKUP_DISTANCE_KM = getattr(settings, 'DELIVERY_MAX_PICKUP_DISTANCE_KM', 15)
+BATCH_SIZE = 500
+CANDIDATES_PER_DELIVERY = 5
+ACTIVE_STATUSES = ('assigned', 'picked_up', 'in_progress')
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+CELL_DEGREES = 0.02  # ~2,2 km à l'équateur
+
+
+# ===========================
+# ASSIGNATION DES LIVREURS
+# ===========================
+#
+# Une passe de dispatch :
+# 1. indexe dans une grille les livreurs actifs ayant une position récente
+#    (cache de suivi) et une capacité restante ;
+# 2. cherche pour chaque livraison en attente ses livreurs les plus proches
+#    de la pharmacie (recherche par anneaux de cellules, pas de balayage complet) ;
+# 3. attribue globalement les paires par distance croissante (glouton), en
+#    respectant la capacité de chaque livreur.
+# Les écritures sont conditionnelles : une livraison assignée entre-temps
+# (à la main ou par un autre worker) n'est pas écrasée.
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+
+class CourierIndex:
+    """Grille régulière de livreurs disponibles, avec leur capacité restante"""
+
+    def __init__(self, couriers, cell=CELL_DEGREES):
+        """couriers : itérable de (courier_id, latitude, longitude, capacité restante)"""
+        self.cell = cell
+        self.cells = defaultdict(list)
+        self.positions = {}
+        self.remaining = {}
+        for courier_id, latitude, longitude, remaining in couriers:
+            if remaining <= 0:
+                continue
+            self.positions[courier_id] = (float(latitude), float(longitude))
+            self.remaining[courier_id] = remaining
+            self.cells[self._cell(latitude, longitude)].append(courier_id)
+
+    def __len__(self):
+        return len(self.remaining)
+
+    def _cell(self, latitude, longitude):
+        return int(math.floor(float(latitude) / self.cell)), int(math.floor(float(longitude) / self.cell))
+
+    def nearest(self, latitude, longitude, k=1, max_km=MAX_PICKUP_DISTANCE_KM):
+        """Les k livreurs disponibles les plus proches : [(distance_km, courier_id), ...]"""
+        if not self.remaining:
+            return []
+        row, col = self._cell(latitude, longitude)
+        # Largeur minimale d'une cellule en km à cette latitude (borne de distance des anneaux)
+        cell_km = self.cell * KM_PER_DEGREE * max(math.cos(math.radians(abs(latitude) + self.cell)), 0.01)
+        max_ring = int(max_km / cell_km) + 1
+
+        found = []
+        for ring in range(max_ring + 1):
+            for r in range(row - ring, row + ring + 1):
+                for c in range(col - ring, col + ring + 1):
+                    if ring and abs(r - row) != ring and abs(c - col) != ring:
+                        continue  # intérieur de l'anneau, déjà visité
+                    for courier_id in self.cells.get((r, c), ()):
+                        distance = haversine_km(latitude, longitude, *self.positions[courier_id])
+                        if distance <= max_km:
+                            found.append((distance, courier_id))
+            # Tout livreur hors des anneaux visités est à plus de ring * cell_km
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= ring * cell_km:
+                    break
+        found.sort()
+        return found[:k]
+
+    def take(self, courier_id):
+        """Consommer une place du livreur ; il sort de l'index une fois plein"""
+        self.remaining[courier_id] -= 1
+        if self.remaining[courier_id] > 0:
+            return
+        del self.remaining[courier_id]
+        latitude, longitude = self.positions.pop(courier_id)
+        self.cells[self._cell(latitude, longitude)].remove(courier_id)
+
+
+def match(deliveries, index, candidates=CANDIDATES_PER_DELIVERY):
+    """
+    Appariement glouton global : deliveries est une liste de
+    (delivery_id, latitude, longitude). Retourne [(delivery_id, courier_id, distance_km)].
+    Les livraisons dont tous les candidats ont été pris sont recherchées à nouveau
+    tant qu'il reste des livreurs.
+    """
+    assigned = []
+    waiting = list(deliveries)
+    while waiting and len(index):
+        pairs = []
+        for delivery_id, latitude, longitude in waiting:
+            for distance, courier_id in index.nearest(latitude, longitude, k=candidates):
+                pairs.append((distance, delivery_id, courier_id))
+        if not pairs:
+            break
+        pairs.sort()
+
+        done = set()
+        for distance, delivery_id, courier_id in pairs:
+            if delivery_id in done or courier_id not in index.remaining:
+                continue
+            index.take(courier_id)
+            done.add(delivery_id)
+            assigned.append((delivery_id, courier_id, distance))
+        waiting = [delivery for delivery in waiting if delivery[0] not in done]
+    return assigned
+
+
+def available_couriers():
+    """Index des livreurs actifs, localisés récemment et non saturés"""
+    courier_ids = AppUser.objects.filter(role='delivery', is_active=True).values_list('id', flat=True)
+    positions = tracking.courier_positions(list(courier_ids))
+    load = dict(
+        Delivery.objects.filter(
+            delivery_person_id__in=list(positions), delivery_status__in=ACTIVE_STATUSES
+        ).values('delivery_person_id').annotate(count=Count('id')).values_list('delivery_person_id', 'count')
+    )
+    return CourierIndex(
+        (courier_id, position['latitude'], position['longitude'], COURIER_CAPACITY - load.get(courier_id, 0))
+        for courier_id, position in positions.items()
+    )
+
+
+def pending_deliveries(limit=BATCH_SIZE, delivery_ids=None):
+    """Livraisons en attente (les plus anciennes d'abord), positionnées sur leur pharmacie"""
+    queryset = Delivery.objects.filter(
+        delivery_status='pending',
+        delivery_person__isnull=True,
+        order__pharmacy__latitude__isnull=False,
+        order__pharmacy__longitude__isnull=False,
+    )
+    if delivery_ids is not None:
+        queryset = queryset.filter(id__in=delivery_ids)
+    rows = queryset.order_by('id').values_list(
+        'id', 'order__pharmacy__latitude', 'order__pharmacy__longitude'
+    )[:limit]
+    return [(delivery_id, float(latitude), float(longitude)) for delivery_id, latitude, longitude in rows]
+
+
+def assign_pending(limit=BATCH_SIZE, delivery_ids=None):
+    """Une passe de dispatch ; retourne [(delivery_id, courier_id, distance_km)] réellement écrits"""
+    deliveries = pending_deliveries(limit, delivery_ids)
+    if not deliveries:
+        return []
+    index = available_couriers()
+    if not len(index):
+        return []
+
+    now = timezone.now()
+    written = []
+    for delivery_id, courier_id, distance in match(deliveries, index):
+        updated = Delivery.objects.filter(
+            id=delivery_id, delivery_status='pending', delivery_person__isnull=True
+        ).update(
+            delivery_person_id=courier_id,
+            delivery_status='assigned',
+            assigned_date=now,
+            updated_at=now,
+        )
+        if updated:
+            tracking.forget_courier(delivery_id)
+            written.append((delivery_id, courier_id, distance))
+    logger.info("Dispatch: %s/%s pending deliveries assigned", len(written), len(deliveries))
+    return written
+
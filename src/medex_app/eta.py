@@ -0,0 +1,148 @@
+import math
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .dispatch import haversine_km
+from .models import Delivery, TravelSpeedGrid
+from . import tracking
+
+
+CELL_DEGREES = getattr(settings, 'ETA_CELL_DEGREES', 0.05)  # ~5,5 km
+DEFAULT_SPEED_KMH = getattr(settings, 'ETA_DEFAULT_SPEED_KMH', 15.0)
+HISTORY_DAYS = 90
+MIN_SAMPLES = 5
+MIN_TRIP_MINUTES = 2
+MAX_TRIP_HOURS = 4
+MIN_SPEED_KMH, MAX_SPEED_KMH = 2.0, 80.0
+RELOAD_INTERVAL = 600  # secondes entre deux vérifications d'une grille plus récente
+
+
+# ===========================
+# ESTIMATION DES HEURES D'ARRIVÉE
+# ===========================
+#
+# Apprentissage (nuit, commande build_eta_model) : pour chaque livraison
+# terminée, distance à vol d'oiseau pharmacie -> client et durée
+# pickup_date -> delivery_date, agrégées par zone d'arrivée et heure de départ.
+# La vitesse obtenue est une vitesse "à vol d'oiseau" : détours et arrêts
+# sont inclus, aucune correction routière n'est nécessaire.
+#
+# Estimation (chaque ping GPS) : une lecture dans la grille en mémoire,
+# avec repli sur la moyenne de l'heure puis sur la moyenne globale.
+
+def zone(latitude, longitude, cell=CELL_DEGREES):
+    return f'{math.floor(float(latitude) / cell)}:{math.floor(float(longitude) / cell)}'
+
+
+class SpeedGrid:
+
+    def __init__(self, cell_degrees, speeds, hourly_speeds, default_speed, built_at=None):
+        self.cell_degrees = cell_degrees
+        self.speeds = speeds
+        self.hourly_speeds = hourly_speeds or [None] * 24
+        self.default_speed = default_speed
+        self.built_at = built_at
+
+    @classmethod
+    def from_model(cls, grid):
+        return cls(grid.cell_degrees, grid.speeds, grid.hourly_speeds, grid.default_speed, grid.built_at)
+
+    def speed(self, latitude, longitude, hour):
+        """Vitesse moyenne en km/h pour une arrivée dans cette zone à cette heure"""
+        by_hour = self.speeds.get(zone(latitude, longitude, self.cell_degrees))
+        return (
+            (by_hour and by_hour[hour])
+            or self.hourly_speeds[hour]
+            or self.default_speed
+        )
+
+
+def _mean_speed(total_km, total_hours, samples):
+    if samples < MIN_SAMPLES or total_hours <= 0:
+        return None
+    return round(min(max(total_km / total_hours, MIN_SPEED_KMH), MAX_SPEED_KMH), 2)
+
+
+def build_grid(days=HISTORY_DAYS, cell=CELL_DEGREES):
+    """Recalculer la grille à partir des livraisons des `days` derniers jours"""
+    trips = Delivery.objects.filter(
+        delivery_status='delivered',
+        pickup_date__gte=timezone.now() - timedelta(days=days),
+        delivery_date__gt=F('pickup_date'),
+        order__delivery_latitude__isnull=False,
+        order__delivery_longitude__isnull=False,
+        order__pharmacy__latitude__isnull=False,
+        order__pharmacy__longitude__isnull=False,
+    ).values_list(
+        'pickup_date', 'delivery_date',
+        'order__pharmacy__latitude', 'order__pharmacy__longitude',
+        'order__delivery_latitude', 'order__delivery_longitude',
+    )
+
+    # [km, heures, trajets] par (zone, heure) et par heure
+    cells = defaultdict(lambda: [0.0, 0.0, 0])
+    hours = defaultdict(lambda: [0.0, 0.0, 0])
+    totals = [0.0, 0.0, 0]
+    for pickup, delivered, from_lat, from_lng, to_lat, to_lng in trips.iterator(chunk_size=2000):
+        duration = (delivered - pickup).total_seconds() / 3600
+        if not MIN_TRIP_MINUTES / 60 <= duration <= MAX_TRIP_HOURS:
+            continue
+        km = haversine_km(float(from_lat), float(from_lng), float(to_lat), float(to_lng))
+        hour = timezone.localtime(pickup).hour
+        for bucket in (cells[(zone(to_lat, to_lng, cell), hour)], hours[hour], totals):
+            bucket[0] += km
+            bucket[1] += duration
+            bucket[2] += 1
+
+    speeds = {}
+    for (key, hour), bucket in cells.items():
+        speed = _mean_speed(*bucket)
+        if speed is not None:
+            speeds.setdefault(key, [None] * 24)[hour] = speed
+
+    grid = TravelSpeedGrid.objects.create(
+        cell_degrees=cell,
+        speeds=speeds,
+        hourly_speeds=[_mean_speed(*hours[hour]) if hour in hours else None for hour in range(24)],
+        default_speed=_mean_speed(*totals) or DEFAULT_SPEED_KMH,
+        sample_count=totals[2],
+    )
+    TravelSpeedGrid.objects.exclude(id=grid.id).delete()
+    _loaded.clear()
+    return grid
+
+
+_lock = threading.Lock()
+_loaded = {}
+
+
+def current_grid():
+    """Dernière grille, gardée en mémoire ; la base n'est relue que toutes les RELOAD_INTERVAL secondes"""
+    now = time.monotonic()
+    if _loaded and now < _loaded['checked_at'] + RELOAD_INTERVAL:
+        return _loaded['grid']
+    with _lock:
+        if not _loaded or now >= _loaded['checked_at'] + RELOAD_INTERVAL:
+            grid = TravelSpeedGrid.objects.order_by('-built_at').first()
+            _loaded['grid'] = (
+                SpeedGrid.from_model(grid) if grid
+                else SpeedGrid(CELL_DEGREES, {}, None, DEFAULT_SPEED_KMH)
+            )
+            _loaded['checked_at'] = now
+        return _loaded['grid']
+
+
+def estimate_arrival(delivery_id, latitude, longitude, at):
+    """Heure d'arrivée estimée depuis la position (latitude, longitude) relevée à `at`, ou None"""
+    destination = tracking.delivery_destination(delivery_id)
+    if destination is None:
+        return None
+    km = haversine_km(float(latitude), float(longitude), *destination)
+    speed = current_grid().speed(*destination, timezone.localtime(at).hour)
+    return at + timedelta(hours=km / speed)
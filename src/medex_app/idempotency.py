@@ -0,0 +1,129 @@
+import hashlib
+import json
+from functools import wraps
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 64
+
+
+# ===========================
+# IDEMPOTENCY-KEY SUPPORT
+# ===========================
+
+def _request_fingerprint(request):
+    """Empreinte de la requête (méthode, chemin, corps) pour détecter la réutilisation d'une clé"""
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = {key: values for key, values in data.lists()}
+    payload = json.dumps(
+        [request.method, request.path, data],
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _replay(record):
+    response = Response(record.response_body, status=record.status_code)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view_func):
+    """
+    Décorateur pour les vues d'écriture (panier, checkout).
+    À placer sous @api_view / @permission_classes.
+
+    Si le client envoie un en-tête Idempotency-Key, la première réponse
+    est enregistrée et rejouée telle quelle pour les retries, sans
+    ré-exécuter la logique métier. Les réponses 5xx ne sont pas mémorisées.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key or not request.user.is_authenticated:
+            return view_func(request, *args, **kwargs)
+
+        if len(key) > MAX_KEY_LENGTH:
+            return Response({
+                "success": False,
+                "error": f"{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        fingerprint = _request_fingerprint(request)
+        endpoint = view_func.__name__
+        now = timezone.now()
+
+        # Réserver la clé avant d'exécuter la vue (protège contre les retries concurrents)
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    user=request.user,
+                    key=key,
+                    endpoint=endpoint,
+                    request_hash=fingerprint,
+                    expires_at=now + IdempotencyKey.TTL
+                )
+        except IntegrityError:
+            record = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+            if record is None:
+                return Response({
+                    "success": False,
+                    "error": "Request with this Idempotency-Key is being processed"
+                }, status=status.HTTP_409_CONFLICT)
+
+            if record.is_expired():
+                # Clé expirée : on la recycle pour cette nouvelle requête
+                updated = IdempotencyKey.objects.filter(
+                    pk=record.pk, expires_at=record.expires_at
+                ).update(
+                    endpoint=endpoint,
+                    request_hash=fingerprint,
+                    status_code=None,
+                    response_body=None,
+                    expires_at=now + IdempotencyKey.TTL
+                )
+                if not updated:
+                    return Response({
+                        "success": False,
+                        "error": "Request with this Idempotency-Key is being processed"
+                    }, status=status.HTTP_409_CONFLICT)
+                record.refresh_from_db()
+            elif record.endpoint != endpoint or record.request_hash != fingerprint:
+                return Response({
+                    "success": False,
+                    "error": f"{IDEMPOTENCY_HEADER} was already used for a different request"
+                }, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+            elif not record.is_completed():
+                return Response({
+                    "success": False,
+                    "error": "Request with this Idempotency-Key is being processed"
+                }, status=status.HTTP_409_CONFLICT)
+            else:
+                return _replay(record)
+
+        try:
+            response = view_func(request, *args, **kwargs)
+        except Exception:
+            record.delete()
+            raise
+
+        if response.status_code >= 500 or not hasattr(response, 'data'):
+            # Échec serveur : libérer la clé pour permettre un nouvel essai
+            record.delete()
+            return response
+
+        record.status_code = response.status_code
+        record.response_body = json.loads(json.dumps(response.data, default=str))
+        record.save(update_fields=['status_code', 'response_body'])
+        return response
+
+    return wrapper
@@ -0,0 +1,194 @@
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from .models import Medicine
+from . import media_store
+
+
+logger = logging.getLogger(__name__)
+
+# Tailles des dérivés (côté le plus long, en pixels)
+DERIVATIVE_SIZES = {
+    'thumbnail': 150,
+    'card': 400,
+    'detail': 1000,
+}
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+EXIF_ORIENTATION = 0x0112
+
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'IMAGE_PIPELINE_WORKERS', 2),
+    thread_name_prefix='image-derivatives'
+)
+
+
+# ===========================
+# FORMAT STRUCTURÉ DE Medicine.image
+# ===========================
+#
+# Chaque entrée de Medicine.image est un dict :
+#   {"original": url, "path": chemin de stockage, "status": "pending" | "ready" | "failed",
+#    "width": w, "height": h,
+#    "variants": {"card": {"jpeg": url, "webp": url, "width": w, "height": h}, ...}}
+# Les anciennes entrées (simples URL ou chemins relatifs, parfois une chaîne seule au lieu
+# d'une liste) restent acceptées partout : voir media_store.image_entries / storage_key.
+
+def image_entry(url, path):
+    return {'original': url, 'path': path, 'status': 'pending', 'variants': {}}
+
+
+def original_url(entry):
+    if isinstance(entry, dict):
+        return entry.get('original')
+    return entry
+
+
+def variant_url(entry, size, fmt='webp'):
+    """URL du dérivé demandé, ou de l'original s'il n'est pas (encore) disponible"""
+    if isinstance(entry, dict):
+        variant = entry.get('variants', {}).get(size)
+        if variant and variant.get(fmt):
+            return variant[fmt]
+    return original_url(entry)
+
+
+def release_entry(entry, media_base_url=None):
+    """Libérer les fichiers d'une entrée (partagés : compteur de références ; anciens : suppression)"""
+    paths = entry_storage_paths(entry, media_base_url)
+    if not paths:
+        return
+    if media_store.is_content_addressed(paths[0]):
+        # Les dérivés partagés ont des noms stables : les inclure même si l'entrée est encore "pending"
+        extra_paths = set(paths[1:]) | set(derivative_paths(paths[0]))
+        media_store.release(paths[0], extra_paths=sorted(extra_paths))
+        return
+    for path in paths:
+        try:
+            if default_storage.exists(path):
+                default_storage.delete(path)
+        except Exception:
+            logger.warning("Could not delete media file %s", path)
+
+
+def entry_storage_paths(entry, media_base_url=None):
+    """Tous les chemins de stockage d'une entrée (original + dérivés)"""
+    if isinstance(entry, dict):
+        paths = [entry.get('path')]
+        for variant in entry.get('variants', {}).values():
+            paths.extend(variant.get('paths', []))
+        return [path for path in paths if path]
+    path = media_store.storage_key(entry, media_base_url)
+    return [path] if path else []
+
+
+# ===========================
+# GÉNÉRATION DES DÉRIVÉS
+# ===========================
+
+DERIVATIVE_FORMATS = (
+    ('JPEG', 'jpeg', 'jpg', JPEG_QUALITY),
+    ('WEBP', 'webp', 'webp', WEBP_QUALITY),
+)
+
+
+def derivative_path(path, name, ext):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(os.path.dirname(path), 'derivatives', f"{stem}_{name}.{ext}")
+
+
+def derivative_paths(path):
+    return [
+        derivative_path(path, name, ext)
+        for name in DERIVATIVE_SIZES
+        for _, _, ext, _ in DERIVATIVE_FORMATS
+    ]
+
+
+def _encode(image, fmt, quality):
+    buffer = io.BytesIO()
+    if fmt == 'JPEG':
+        image.save(buffer, fmt, quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, fmt, quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def generate_derivatives(path, media_base_url):
+    """Créer les tailles thumbnail/card/detail en JPEG et WebP pour une image stockée"""
+    with default_storage.open(path, 'rb') as source:
+        image = Image.open(source)
+        width, height = image.size
+        if image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            width, height = height, width
+        # Décodage JPEG à échelle réduite : beaucoup plus rapide pour les photos de téléphone
+        image.draft('RGB', (max(DERIVATIVE_SIZES.values()),) * 2)
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        shared = media_store.is_content_addressed(path)
+        variants = {}
+        for name, size in DERIVATIVE_SIZES.items():
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+            variant = {'width': resized.width, 'height': resized.height, 'paths': []}
+            for fmt, key, ext, quality in DERIVATIVE_FORMATS:
+                target = derivative_path(path, name, ext)
+                # Les dérivés d'un fichier adressé par contenu ont des noms stables : un seul exemplaire
+                if shared and default_storage.exists(target):
+                    saved = target
+                else:
+                    saved = default_storage.save(target, ContentFile(_encode(resized, fmt, quality)))
+                    if shared and saved != target:
+                        default_storage.delete(saved)
+                        saved = target
+                variant[key] = media_base_url + saved
+                variant['paths'].append(saved)
+            variants[name] = variant
+
+    return {'width': width, 'height': height, 'variants': variants}
+
+
+def _process_medicine_images(medicine_id, paths, media_base_url):
+    close_old_connections()
+    try:
+        results = {}
+        for path in paths:
+            try:
+                results[path] = generate_derivatives(path, media_base_url)
+            except Exception:
+                logger.exception("Image derivative generation failed for %s", path)
+                results[path] = None
+
+        with transaction.atomic():
+            medicine = Medicine.objects.select_for_update().filter(id=medicine_id).first()
+            if medicine is None:
+                return
+            entries = []
+            for entry in media_store.image_entries(medicine.image):
+                if isinstance(entry, dict) and entry.get('path') in results:
+                    result = results[entry['path']]
+                    entry = dict(entry, status='ready', **result) if result else dict(entry, status='failed')
+                entries.append(entry)
+            medicine.image = entries
+            medicine.save(update_fields=['image'])
+    finally:
+        close_old_connections()
+
+
+def schedule_derivatives(medicine_id, paths, media_base_url):
+    """Lancer la génération en arrière-plan une fois la transaction courante validée"""
+    if not paths:
+        return
+    transaction.on_commit(
+        lambda: _executor.submit(_process_medicine_images, medicine_id, list(paths), media_base_url)
+    )
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .models import Delivery
+from . import tracking
+
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = getattr(settings, 'DELIVERY_LIVE_POLL_INTERVAL', 1.0)
+STATUS_POLL_EVERY = 5  # relire le statut en base une itération sur N
+SUBSCRIBER_QUEUE_SIZE = 20
+TERMINAL_STATUSES = {'delivered', 'failed', 'returned'}
+
+
+# ===========================
+# SUIVI EN DIRECT : UN PUBLIEUR PAR LIVRAISON
+# ===========================
+#
+# Quel que soit le nombre d'abonnés à une livraison, une seule tâche asyncio
+# lit la position (cache partagé) et le statut (base) ; chaque abonné n'est
+# qu'une file d'attente. La tâche s'arrête quand le dernier abonné part.
+
+class DeliveryPublisher:
+
+    def __init__(self, hub, delivery_id):
+        self.hub = hub
+        self.delivery_id = delivery_id
+        self.subscribers = set()
+        self.position = None
+        self.status = None
+        self.task = None
+
+    def snapshot(self):
+        events = []
+        if self.status is not None:
+            events.append(('status', {'delivery_status': self.status}))
+        if self.position is not None:
+            events.append(('position', self.position))
+        return events
+
+    def broadcast(self, event):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Abonné trop lent : on jette son plus vieil événement, les positions se remplacent
+                queue.get_nowait()
+                queue.put_nowait(event)
+
+    async def refresh(self, read_status):
+        position = await sync_to_async(tracking.latest_position)(self.delivery_id)
+        if position is not None and position != self.position:
+            self.position = position
+            self.broadcast(('position', position))
+
+        if read_status:
+            current = await Delivery.objects.filter(id=self.delivery_id).values_list(
+                'delivery_status', flat=True
+            ).afirst()
+            if current is not None and current != self.status:
+                self.status = current
+                self.broadcast(('status', {'delivery_status': current}))
+
+    async def run(self):
+        tick = 0
+        try:
+            while self.subscribers:
+                await self.refresh(read_status=tick % STATUS_POLL_EVERY == 0)
+                if self.status in TERMINAL_STATUSES:
+                    self.broadcast(None)
+                    break
+                tick += 1
+                await asyncio.sleep(POLL_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Live tracking publisher for delivery %s failed", self.delivery_id)
+            self.broadcast(None)
+        finally:
+            self.hub.discard(self)
+
+
+class TrackingHub:
+    """Publieurs actifs de ce processus (boucle d'événements ASGI)"""
+
+    def __init__(self):
+        self.publishers = {}
+
+    async def subscribe(self, delivery_id):
+        publisher = self.publishers.get(delivery_id)
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        if publisher is None:
+            publisher = self.publishers[delivery_id] = DeliveryPublisher(self, delivery_id)
+            publisher.subscribers.add(queue)
+            try:
+                await publisher.refresh(read_status=True)
+                # L'état initial est déjà dans la file de ce premier abonné
+                publisher.task = asyncio.create_task(publisher.run())
+            except BaseException as exc:
+                # Les abonnés arrivés pendant la lecture attendent ce publieur sans tâche :
+                # le retirer et leur transmettre l'erreur (le flux se coupe, le client se reconnecte)
+                self.discard(publisher)
+                publisher.subscribers.discard(queue)
+                if not isinstance(exc, Exception):
+                    exc = RuntimeError(f"Live tracking for delivery {delivery_id} was cancelled while starting")
+                publisher.broadcast(exc)
+                publisher.subscribers.clear()
+                raise
+        else:
+            publisher.subscribers.add(queue)
+            for event in publisher.snapshot():
+                queue.put_nowait(event)
+        return publisher, queue
+
+    def unsubscribe(self, publisher, queue):
+        publisher.subscribers.discard(queue)
+
+    def discard(self, publisher):
+        if self.publishers.get(publisher.delivery_id) is publisher:
+            del self.publishers[publisher.delivery_id]
+
+
+hub = TrackingHub()
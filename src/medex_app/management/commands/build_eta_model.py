@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from medex_app.eta import build_grid, CELL_DEGREES, HISTORY_DAYS
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalculer la grille des vitesses moyennes (zone x heure) utilisée pour "
+        "estimer les heures d'arrivée. À lancer chaque nuit (cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=HISTORY_DAYS,
+                            help=f"Historique de livraisons pris en compte, en jours (défaut : {HISTORY_DAYS})")
+        parser.add_argument('--cell', type=float, default=CELL_DEGREES,
+                            help=f"Taille d'une zone en degrés (défaut : {CELL_DEGREES})")
+
+    def handle(self, *args, **options):
+        grid = build_grid(days=options['days'], cell=options['cell'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Speed grid built from {grid.sample_count} trips: {len(grid.speeds)} zones, "
+            f"default {grid.default_speed} km/h"
+        ))
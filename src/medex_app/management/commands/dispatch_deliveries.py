@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from medex_app.dispatch import assign_pending, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Assigner les livraisons en attente aux livreurs disponibles les plus proches (une passe, ou en continu avec --loop)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help="Tourner en continu (worker dédié)")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Pause entre deux passes, en secondes (défaut : 5)")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help=f"Livraisons en attente traitées par passe (défaut : {BATCH_SIZE})")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            assigned = assign_pending(limit=options['batch_size'])
+            total += len(assigned)
+            if assigned:
+                self.stdout.write(f"{len(assigned)} deliveries assigned")
+            # Lot plein : il reste probablement des livraisons en attente
+            if len(assigned) == options['batch_size']:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f"Dispatch done: {total} deliveries assigned"))
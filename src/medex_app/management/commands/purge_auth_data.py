@@ -0,0 +1,64 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from medex_app.models import IdempotencyKey, OTPVerification
+
+
+class Command(BaseCommand):
+    help = (
+        "Supprimer les codes OTP utilisés ou expirés et les clés d'idempotence "
+        "expirées, révoquer les tokens d'authentification trop anciens (par lots)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Compter sans rien supprimer")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Lignes supprimées par requête (défaut : 1000)")
+        # Âge depuis la création du token : DRF ne garde pas la date de dernière
+        # utilisation, un utilisateur actif doit donc se reconnecter après N jours
+        parser.add_argument('--token-max-age-days', type=int,
+                            default=getattr(settings, 'AUTH_TOKEN_MAX_AGE_DAYS', 90),
+                            help="Révoquer les tokens créés il y a plus de N jours (défaut : 90)")
+
+    def handle(self, *args, **options):
+        self.batch_size = max(options['batch_size'], 1)
+        self.dry_run = options['dry_run']
+        now = timezone.now()
+
+        otps = OTPVerification.objects.filter(Q(is_used=True) | Q(expires_at__lt=now))
+        otp_count = self.purge(otps)
+
+        idempotency_keys = IdempotencyKey.objects.filter(expires_at__lt=now)
+        key_count = idempotency_keys.count() if self.dry_run else IdempotencyKey.purge_expired()
+
+        created_before = now - timedelta(days=options['token_max_age_days'])
+        stale_tokens = Token.objects.filter(Q(user__is_active=False) | Q(created__lt=created_before))
+        token_count = self.purge(stale_tokens)
+
+        summary = f"{otp_count} OTP codes, {key_count} idempotency keys, {token_count} tokens"
+        if self.dry_run:
+            self.stdout.write(self.style.WARNING(f"Would delete {summary} (dry run)"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Deleted {summary}"))
+
+    def purge(self, queryset):
+        """Supprimer par lots de clés primaires : transactions courtes, verrous brefs"""
+        if self.dry_run:
+            return queryset.count()
+
+        model = queryset.model
+        total = 0
+        while True:
+            pks = list(queryset.order_by().values_list('pk', flat=True)[:self.batch_size])
+            if not pks:
+                return total
+            # delete() envoie post_delete pour chaque token : après le commit, la génération partagée
+            # de l'utilisateur change et tous les workers (pas seulement celui-ci) oublient le token
+            model.objects.filter(pk__in=pks).delete()
+            total += len(pks)
@@ -0,0 +1,142 @@
+import os
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from medex_app import media_store
+from medex_app.images import entry_storage_paths, derivative_paths
+from medex_app.models import Medicine, Pharmacy, Prescription, PrescriptionUpload, MediaBlob
+
+
+class Command(BaseCommand):
+    help = (
+        "Supprimer les fichiers média qui ne sont plus référencés par "
+        "Medicine.image, Pharmacy.logo, Prescription.file_path ou un MediaBlob. "
+        "Chaque lot de fichiers est comparé à la base par requêtes indexées."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Lister les fichiers orphelins sans les supprimer")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Taille des lots de lecture et de suppression (défaut : 500)")
+        parser.add_argument('--min-age', type=float, default=24,
+                            help="Ignorer les fichiers modifiés depuis moins de N heures (défaut : 24)")
+        parser.add_argument('--prefix', default='',
+                            help="Ne parcourir que ce sous-répertoire du stockage")
+
+    def handle(self, *args, **options):
+        self.batch_size = max(options['batch_size'], 1)
+        dry_run = options['dry_run']
+        cutoff = timezone.now() - timedelta(hours=options['min_age'])
+
+        # Blobs restés à 0 référence : suppression verrouillée (un upload concurrent les reprend)
+        if dry_run:
+            unreferenced = MediaBlob.objects.filter(ref_count=0).count()
+            self.stdout.write(f"[dry-run] {unreferenced} unreferenced blobs")
+        else:
+            self.stdout.write(f"{media_store.purge_unreferenced()} unreferenced blobs deleted")
+
+        legacy_keys = self.legacy_image_keys()
+        active_prefixes = self.active_upload_prefixes()
+        self.stdout.write(f"{len(legacy_keys)} legacy product image keys")
+
+        scanned = orphans = deleted = 0
+        for batch in self.batches(self.storage_keys(options['prefix'].strip('/'))):
+            scanned += len(batch)
+            candidates = set(batch) - legacy_keys - self.referenced_in(batch)
+            batch_orphans = sorted(
+                key for key in candidates
+                if not key.startswith(active_prefixes) and self.older_than(key, cutoff)
+            )
+            orphans += len(batch_orphans)
+            for key in batch_orphans:
+                if dry_run:
+                    self.stdout.write(f"[dry-run] {key}")
+                    continue
+                try:
+                    default_storage.delete(key)
+                    deleted += 1
+                except OSError as e:
+                    self.stderr.write(f"Could not delete {key}: {e}")
+
+        summary = f"{scanned} files scanned, {orphans} orphaned"
+        if dry_run:
+            self.stdout.write(self.style.WARNING(f"{summary} (dry run, nothing deleted)"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"{summary}, {deleted} deleted"))
+
+    # ===========================
+    # CLÉS RÉFÉRENCÉES
+    # ===========================
+
+    def referenced_in(self, batch):
+        """Clés du lot encore référencées : quelques requêtes indexées par lot, rien n'est chargé en entier"""
+        hashes = {self.blob_hash(key) for key in batch if media_store.is_content_addressed(key)}
+        hashes.discard(None)
+        referenced = set()
+        for path in MediaBlob.objects.filter(hash__in=hashes).values_list('path', flat=True):
+            referenced.add(path)
+            referenced.update(derivative_paths(path))
+        referenced.update(Pharmacy.objects.filter(logo__in=batch).values_list('logo', flat=True))
+        referenced.update(Prescription.objects.filter(file_path__in=batch).values_list('file_path', flat=True))
+        return referenced
+
+    def blob_hash(self, key):
+        """cas/ab/<hash>.jpg et cas/ab/derivatives/<hash>_card.webp -> <hash>"""
+        stem = os.path.splitext(os.path.basename(key))[0].split('_', 1)[0]
+        return stem if len(stem) == 64 else None
+
+    def legacy_image_keys(self):
+        """
+        Chemins des images produits hors stockage partagé (anciennes entrées).
+        Medicine.image est du JSON et ne se filtre pas par clé : ces chemins sont
+        lus une fois. Les images partagées (cas/) sont comptées par MediaBlob.
+        """
+        keys = set()
+        for images in Medicine.objects.values_list('image', flat=True).iterator(chunk_size=self.batch_size):
+            # Anciennes lignes : une chaîne seule, URL ou chemin relatif (voir media_store.storage_key)
+            for entry in media_store.image_entries(images):
+                keys.update(key for key in entry_storage_paths(entry) if not media_store.is_content_addressed(key))
+        return keys
+
+    def active_upload_prefixes(self):
+        """Les morceaux des uploads d'ordonnance en cours ne sont jamais orphelins"""
+        uploads = PrescriptionUpload.objects.filter(
+            status='uploading', expires_at__gt=timezone.now()
+        ).values_list('id', flat=True)
+        return tuple(f"prescription_uploads/{upload_id}/" for upload_id in uploads.iterator())
+
+    # ===========================
+    # PARCOURS DU STOCKAGE
+    # ===========================
+
+    def storage_keys(self, prefix=''):
+        """Parcours en profondeur du stockage, une clé à la fois"""
+        try:
+            directories, files = default_storage.listdir(prefix)
+        except FileNotFoundError:
+            return
+        for name in files:
+            yield f"{prefix}/{name}" if prefix else name
+        for name in directories:
+            yield from self.storage_keys(f"{prefix}/{name}" if prefix else name)
+
+    def batches(self, keys):
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def older_than(self, key, cutoff):
+        """Ne pas toucher aux fichiers tout juste écrits (transaction pas encore validée)"""
+        try:
+            return default_storage.get_modified_time(key) < cutoff
+        except (NotImplementedError, OSError):
+            return True
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from medex_app.outbox import send_pending, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Envoyer les emails en attente dans l'outbox (une passe, ou en continu avec --loop)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help="Tourner en continu (worker dédié)")
+        parser.add_argument('--interval', type=float, default=5,
+                            help="Pause entre deux passes sans message, en secondes (défaut : 5)")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help=f"Messages envoyés par connexion SMTP (défaut : {BATCH_SIZE})")
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+        while True:
+            try:
+                sent, failed = send_pending(limit=options['batch_size'])
+            except Exception as e:
+                # Base indisponible, etc. : le worker continue, les messages réservés
+                # seront repris à l'expiration de leur réservation
+                if not options['loop']:
+                    raise
+                self.stderr.write(f"Outbox pass failed: {e}")
+                time.sleep(options['interval'])
+                continue
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.stdout.write(f"{sent} sent, {failed} failed")
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f"Outbox drained: {total_sent} sent, {total_failed} failed"))
@@ -0,0 +1,301 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from urllib.parse import unquote, urlparse
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import MediaBlob, Pharmacy
+
+
+logger = logging.getLogger(__name__)
+
+CAS_ROOT = 'cas'
+EXTENSION_ALIASES = {'.jpeg': '.jpg', '.jpe': '.jpg', '.tif': '.tiff'}
+
+# Les écritures ne touchent pas la base : pas de connexion à gérer dans ces threads
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'MEDIA_UPLOAD_WORKERS', 4),
+    thread_name_prefix='media-upload'
+)
+
+
+# ===========================
+# STOCKAGE ADRESSÉ PAR CONTENU
+# ===========================
+
+def content_hash(file):
+    """SHA-256 du fichier, lu par morceaux"""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return digest.hexdigest()
+
+
+def content_path(digest, filename):
+    """cas/ab/abcdef...123.jpg : répartition sur 256 répertoires"""
+    ext = os.path.splitext(filename or '')[1].lower()
+    ext = EXTENSION_ALIASES.get(ext, ext)
+    return f"{CAS_ROOT}/{digest[:2]}/{digest}{ext}"
+
+
+def is_content_addressed(path):
+    return bool(path) and path.startswith(f"{CAS_ROOT}/")
+
+
+def _write(file):
+    """
+    Écrire le fichier sous son empreinte (I/O uniquement, aucun accès base).
+    Retourne (digest, path, size, written) ; written indique si ce fichier a été créé ici.
+    """
+    digest = content_hash(file)
+    path = content_path(digest, getattr(file, 'name', ''))
+    written = False
+    if not default_storage.exists(path):
+        saved = default_storage.save(path, file)
+        if saved != path:
+            # Écriture concurrente du même contenu : garder un seul exemplaire
+            default_storage.delete(saved)
+        else:
+            written = True
+    return digest, path, file.size, written
+
+
+def _register(digest, path, size):
+    """
+    Créer le MediaBlob ou incrémenter son compteur de références.
+    Retourne (chemin, created) : created indique que le blob n'existait plus.
+    """
+    with transaction.atomic():
+        # Verrou partagé avec _delete_unreferenced : un blob en cours de suppression attend ici
+        blob = MediaBlob.objects.select_for_update().filter(hash=digest).first()
+        if blob is not None:
+            MediaBlob.objects.filter(hash=digest).update(ref_count=F('ref_count') + 1)
+            return blob.path, False
+
+        try:
+            with transaction.atomic():
+                MediaBlob.objects.create(hash=digest, path=path, size=size, ref_count=1)
+        except IntegrityError:
+            MediaBlob.objects.filter(hash=digest).update(ref_count=F('ref_count') + 1)
+            return MediaBlob.objects.values_list('path', flat=True).get(hash=digest), False
+    return path, True
+
+
+def _ensure_written(file, path):
+    """
+    Le blob vient d'être (re)créé alors que _write a trouvé le fichier déjà présent :
+    une libération concurrente a pu le supprimer entre-temps, on le réécrit.
+    """
+    if default_storage.exists(path):
+        return
+    file.seek(0)
+    saved = default_storage.save(path, file)
+    if saved != path:
+        default_storage.delete(saved)
+
+
+def _discard(results):
+    """Supprimer les fichiers écrits par un appel qui a échoué (sauf s'ils sont déjà référencés)"""
+    for digest, path, _, written in results:
+        if written and not MediaBlob.objects.filter(hash=digest).exists():
+            try:
+                default_storage.delete(path)
+            except OSError:
+                logger.warning("Could not delete media file %s", path)
+
+
+def store(file):
+    """
+    Enregistrer un fichier uploadé sous son empreinte.
+    Si les mêmes octets existent déjà, rien n'est écrit : on incrémente
+    simplement le compteur de références. Retourne le chemin de stockage.
+    """
+    return store_many([file])[0]
+
+
+def store_many(files):
+    """
+    Enregistrer plusieurs fichiers : les écritures partent en parallèle dans
+    un pool borné, puis les références sont enregistrées dans le thread appelant
+    (même transaction que la vue). Si un fichier échoue, les fichiers écrits
+    par cet appel sont supprimés et l'exception est relancée ; pour un échec
+    plus loin dans la transaction de la vue, utiliser media_store.atomic().
+    Les chemins sont retournés dans l'ordre des fichiers reçus.
+    """
+    files = list(files)
+    if len(files) <= 1:
+        results = [_write(file) for file in files]
+    else:
+        futures = [_executor.submit(_write, file) for file in files]
+        wait(futures)
+        errors = [future.exception() for future in futures if future.exception()]
+        results = [future.result() for future in futures if not future.exception()]
+        if errors:
+            _discard(results)
+            raise errors[0]
+
+    try:
+        with transaction.atomic():
+            paths = []
+            for file, (digest, path, size, written) in zip(files, results):
+                path, created = _register(digest, path, size)
+                if created and not written:
+                    _ensure_written(file, path)
+                paths.append(path)
+    except Exception:
+        _discard(results)
+        raise
+
+    scopes = getattr(_scopes, 'stack', None)
+    if scopes:
+        scopes[-1].extend(results)
+    return paths
+
+
+_scopes = threading.local()
+
+
+@contextmanager
+def atomic():
+    """
+    transaction.atomic() pour les vues qui appellent store_many() : si le bloc
+    échoue plus loin (ex. product.save()), la transaction annule les MediaBlob
+    et les fichiers écrits dans ce bloc sont supprimés à leur tour.
+    """
+    written = []
+    stack = _scopes.__dict__.setdefault('stack', [])
+    stack.append(written)
+    try:
+        with transaction.atomic():
+            yield
+    except BaseException:
+        # Après l'annulation : _discard ne supprime que les fichiers sans MediaBlob
+        try:
+            _discard(written)
+        except Exception:
+            logger.exception("Could not clean up media files after a rolled back transaction")
+        raise
+    finally:
+        stack.pop()
+
+
+def release(path, extra_paths=()):
+    """
+    Libérer une référence. Le fichier (et ses fichiers dérivés extra_paths)
+    n'est supprimé que lorsque plus aucune référence n'existe.
+    Retourne True si la dernière référence a été libérée.
+    """
+    if not is_content_addressed(path):
+        return False
+
+    with transaction.atomic():
+        blob = MediaBlob.objects.select_for_update().filter(path=path).first()
+        if blob is None or blob.ref_count == 0:
+            return False
+        MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+        if blob.ref_count > 1:
+            return False
+
+        # Le blob reste à 0 référence jusqu'à la suppression des fichiers, après le commit
+        paths = (path, *extra_paths)
+        transaction.on_commit(lambda: _delete_unreferenced(blob.hash, paths))
+    return True
+
+
+def _delete_unreferenced(digest, paths):
+    """
+    Supprimer les fichiers d'un blob sans référence, sous le verrou de sa ligne :
+    un store() concurrent du même contenu attend la fin de la suppression puis
+    recrée le blob et réécrit le fichier (voir _register / _ensure_written).
+    """
+    with transaction.atomic():
+        blob = MediaBlob.objects.select_for_update().filter(hash=digest).first()
+        if blob is None or blob.ref_count > 0:
+            # Déjà supprimé, ou référencé à nouveau entre-temps
+            return False
+        for name in paths:
+            try:
+                if default_storage.exists(name):
+                    default_storage.delete(name)
+            except OSError:
+                logger.warning("Could not delete media file %s", name)
+        blob.delete()
+    return True
+
+
+def purge_unreferenced():
+    """Supprimer les blobs restés sans référence (suppression après commit interrompue)"""
+    from .images import derivative_paths
+
+    deleted = 0
+    for digest, path in MediaBlob.objects.filter(ref_count=0).values_list('hash', 'path').iterator():
+        if _delete_unreferenced(digest, (path, *derivative_paths(path))):
+            deleted += 1
+    return deleted
+
+
+# ===========================
+# RÉFÉRENCES DE Medicine.image
+# ===========================
+
+def image_entries(value):
+    """
+    Medicine.image sous forme de liste d'entrées.
+    Les anciennes lignes contiennent une seule chaîne (ex. 'meds/paracetamol__AB.jpeg').
+    """
+    if not value:
+        return []
+    if isinstance(value, (str, dict)):
+        return [value]
+    return list(value)
+
+
+def storage_key(value, media_base_url=None):
+    """
+    Chemin de stockage d'une ancienne entrée : URL absolue sous media_base_url,
+    URL ou chemin sous MEDIA_URL, ou chemin relatif tel quel.
+    Retourne None pour une URL externe.
+    """
+    if not value or not isinstance(value, str):
+        return None
+    if media_base_url and value.startswith(media_base_url):
+        return value[len(media_base_url):] or None
+    parsed = urlparse(value)
+    media_url = settings.MEDIA_URL or '/'
+    if parsed.path.startswith(media_url) and (parsed.scheme or value.startswith('/')):
+        return unquote(parsed.path[len(media_url):]) or None
+    if parsed.scheme or parsed.netloc or value.startswith('/'):
+        return None
+    return unquote(parsed.path) or None
+
+
+# ===========================
+# LOGOS DES PHARMACIES
+# ===========================
+
+@receiver(post_save, sender=Pharmacy)
+def release_replaced_logo(sender, instance, **kwargs):
+    previous = getattr(instance, '_loaded_logo', None)
+    current = getattr(instance.__dict__.get('logo'), 'name', instance.__dict__.get('logo'))
+    if 'logo' in instance.__dict__:
+        instance._loaded_logo = current
+    if previous and previous != current:
+        release(previous)
+
+
+@receiver(post_delete, sender=Pharmacy)
+def release_deleted_logo(sender, instance, **kwargs):
+    logo = getattr(instance.__dict__.get('logo'), 'name', instance.__dict__.get('logo'))
+    if logo:
+        release(logo)
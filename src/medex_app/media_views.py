@@ -0,0 +1,210 @@
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import Http404, HttpResponse, FileResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags
+from django.views.decorators.http import require_safe
+from rest_framework.exceptions import AuthenticationFailed
+
+from .authentication import CachedTokenAuthentication
+from .media_store import is_content_addressed
+from .models import Prescription
+
+
+# ===========================
+# SERVICE DES FICHIERS MÉDIA
+# ===========================
+#
+# Remplace static(settings.MEDIA_URL, ...) : fonctionne aussi hors DEBUG, gère
+# les requêtes Range, les ETags forts et le cache long des fichiers adressés par
+# contenu. Les ordonnances (prescriptions/) ne sont servies qu'au client, à la
+# pharmacie de la commande et aux admins. Avec MEDIA_SENDFILE_BACKEND = 'nginx', la réponse ne contient que les
+# en-têtes et X-Accel-Redirect ; Nginx envoie le fichier lui-même :
+#
+#   location /protected-media/ {
+#       internal;
+#       alias /chemin/vers/media/;
+#   }
+#
+# Avec 'apache' (mod_xsendfile) ou 'lighttpd', l'en-tête X-Sendfile est utilisé.
+
+SENDFILE_BACKEND = getattr(settings, 'MEDIA_SENDFILE_BACKEND', None)
+ACCEL_REDIRECT_PREFIX = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+MEDIA_MAX_AGE = getattr(settings, 'MEDIA_CACHE_MAX_AGE', 3600)
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Fichiers jamais servis (morceaux d'upload en cours)
+HIDDEN_PREFIXES = ('prescription_uploads/',)
+# Fichiers réservés au client, à la pharmacie de la commande et aux admins,
+# jamais mis en cache partagé
+PRIVATE_PREFIXES = ('prescriptions/',)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CAS_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def _etag(path, stat):
+    """ETag fort : l'empreinte pour un original adressé par contenu, sinon mtime + taille"""
+    stem = posixpath.splitext(posixpath.basename(path))[0]
+    if is_content_addressed(path) and CAS_DIGEST_RE.match(stem):
+        return f'"{stem}"'
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def _cache_control(path):
+    if path.startswith(PRIVATE_PREFIXES):
+        return 'private, no-cache'
+    if is_content_addressed(path):
+        # Le contenu d'une URL adressée par contenu ne change jamais
+        return f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return f'public, max-age={MEDIA_MAX_AGE}'
+
+
+def _parse_range(header, size):
+    """
+    (start, end) inclus pour un intervalle unique, None si l'en-tête est absent
+    ou non géré (la réponse complète est alors envoyée), 'invalid' s'il est insatisfiable.
+    """
+    match = RANGE_RE.match(header.replace(' ', '')) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first != '' and last != '' and int(last) < int(first):
+        # Intervalle mal formé : l'en-tête est ignoré (RFC 9110, 14.2)
+        return None
+    if first == '':
+        # Suffixe : les N derniers octets
+        length = int(last)
+        if length == 0:
+            return 'invalid'
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size:
+        return 'invalid'
+    return start, end
+
+
+def _read_range(full_path, start, length):
+    with open(full_path, 'rb') as handle:
+        handle.seek(start)
+        while length > 0:
+            data = handle.read(min(STREAM_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def _media_user(request):
+    """Utilisateur de la requête : en-tête Authorization: Token ..., sinon session (admin Django)"""
+    try:
+        authenticated = CachedTokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    if authenticated is not None:
+        return authenticated[0]
+    user = getattr(request, 'user', None)
+    return user if user is not None and user.is_authenticated else None
+
+
+def _can_read_private(user, path):
+    """Ordonnance : le client de la commande, le propriétaire de la pharmacie ou un admin"""
+    if user.role == 'admin' or user.is_staff:
+        return True
+    return Prescription.objects.filter(file_path=path).filter(
+        Q(order__user=user) | Q(order__pharmacy__owner=user)
+    ).exists()
+
+
+@require_safe
+def serve_media(request, path):
+    """Servir un fichier de MEDIA_ROOT (GET/HEAD)"""
+    path = posixpath.normpath(path).lstrip('/')
+    if path.startswith(HIDDEN_PREFIXES) or path.startswith('..'):
+        raise Http404
+    if path.startswith(PRIVATE_PREFIXES):
+        user = _media_user(request)
+        if user is None:
+            response = HttpResponse(status=401)
+            response['WWW-Authenticate'] = 'Token'
+            return response
+        if not _can_read_private(user, path):
+            # Même réponse qu'un fichier absent : rien n'est révélé sur l'existence du fichier
+            raise Http404
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (OSError, ValueError):
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    etag = _etag(path, stat)
+    last_modified = int(stat.st_mtime)
+
+    # 304 / 412 sans ouvrir le fichier
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        not_modified['Cache-Control'] = _cache_control(path)
+        return not_modified
+
+    content_type, encoding = mimetypes.guess_type(full_path)
+    headers = {
+        'Content-Type': content_type or 'application/octet-stream',
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': _cache_control(path),
+        'Accept-Ranges': 'bytes',
+        'X-Content-Type-Options': 'nosniff',
+    }
+    if encoding:
+        headers['Content-Encoding'] = encoding
+
+    # Délégation au serveur web frontal : il gère lui-même Range et l'envoi des octets
+    if SENDFILE_BACKEND == 'nginx':
+        response = HttpResponse(headers=headers)
+        response['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(path)
+        return response
+    if SENDFILE_BACKEND in ('apache', 'lighttpd'):
+        response = HttpResponse(headers=headers)
+        response['X-Sendfile'] = full_path
+        return response
+
+    # If-Range : n'envoyer une partie que si le fichier n'a pas changé
+    byte_range = _parse_range(request.headers.get('Range'), stat.st_size)
+    if_range = request.headers.get('If-Range')
+    if byte_range is not None and if_range and etag not in parse_etags(if_range):
+        if if_range.strip() != http_date(last_modified):
+            byte_range = None
+
+    if byte_range == 'invalid':
+        response = HttpResponse(status=416, headers=headers)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+
+    if byte_range is not None:
+        start, end = byte_range
+        length = end - start + 1
+        body = _read_range(full_path, start, length) if request.method == 'GET' else ()
+        response = StreamingHttpResponse(body, status=206, headers=headers)
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Length'] = str(length)
+        return response
+
+    if request.method == 'HEAD':
+        response = HttpResponse(headers=headers)
+        response['Content-Length'] = str(stat.st_size)
+        return response
+
+    response = FileResponse(open(full_path, 'rb'), headers=headers)
+    response['Content-Length'] = str(stat.st_size)
+    return response
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:14
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_counters(apps, schema_editor):
+    Order = apps.get_model('medex_app', 'Order')
+    OrderStatusCounter = apps.get_model('medex_app', 'OrderStatusCounter')
+    counters = []
+    for scope, field in (('user', 'user_id'), ('pharmacy', 'pharmacy_id')):
+        rows = Order.objects.order_by().values(field, 'status').annotate(total=Count('id'))
+        counters.extend(
+            OrderStatusCounter(scope=scope, owner_id=row[field], status=row['status'], count=row['total'])
+            for row in rows
+        )
+    OrderStatusCounter.objects.bulk_create(counters, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0004_ordernumbersequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderStatusCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(choices=[('user', 'User'), ('pharmacy', 'Pharmacy')], max_length=10)),
+                ('owner_id', models.PositiveBigIntegerField()),
+                ('status', models.CharField(max_length=30)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('scope', 'owner_id', 'status')},
+            },
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
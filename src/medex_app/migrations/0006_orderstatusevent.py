@@ -0,0 +1,32 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0005_orderstatuscounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderStatusEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_status', models.CharField(blank=True, max_length=30, null=True)),
+                ('to_status', models.CharField(max_length=30)),
+                ('note', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('changed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='order_status_changes', to=settings.AUTH_USER_MODEL)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_events', to='medex_app.order')),
+                ('pharmacy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='order_events', to='medex_app.pharmacy')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['pharmacy', 'id'], name='medex_app_o_pharmac_804e25_idx'), models.Index(fields=['order', 'id'], name='medex_app_o_order_i_fba80a_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0009_outboundemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appuser',
+            name='totp_confirmed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='appuser',
+            name='totp_secret',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0010_appuser_totp'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='otpverification',
+            index=models.Index(fields=['user', 'is_used', 'created_at'], name='otp_user_used_created_idx'),
+        ),
+    ]
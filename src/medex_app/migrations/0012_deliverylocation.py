@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0011_otpverification_user_used_created_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryLocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('latitude', models.DecimalField(decimal_places=6, max_digits=10)),
+                ('longitude', models.DecimalField(decimal_places=6, max_digits=10)),
+                ('recorded_at', models.DateTimeField()),
+                ('delivery', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='locations', to='medex_app.delivery')),
+            ],
+            options={
+                'ordering': ['recorded_at'],
+                'indexes': [models.Index(fields=['delivery', 'recorded_at'], name='medex_app_d_deliver_bbb92f_idx')],
+            },
+        ),
+    ]
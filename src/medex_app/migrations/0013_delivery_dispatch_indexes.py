@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0012_deliverylocation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='delivery',
+            index=models.Index(fields=['delivery_status', 'delivery_person'], name='medex_app_d_deliver_c2788b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='delivery',
+            index=models.Index(fields=['delivery_person', 'delivery_status'], name='medex_app_d_deliver_33a5d5_idx'),
+        ),
+    ]
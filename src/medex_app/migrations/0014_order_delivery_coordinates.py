@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0013_delivery_dispatch_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='delivery_latitude',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='delivery_longitude',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=10, null=True),
+        ),
+    ]
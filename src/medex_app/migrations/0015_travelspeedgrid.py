@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0014_order_delivery_coordinates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TravelSpeedGrid',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cell_degrees', models.FloatField()),
+                ('speeds', models.JSONField(default=dict)),
+                ('hourly_speeds', models.JSONField(default=list)),
+                ('default_speed', models.FloatField()),
+                ('sample_count', models.PositiveIntegerField(default=0)),
+                ('built_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'get_latest_by': 'built_at',
+            },
+        ),
+    ]
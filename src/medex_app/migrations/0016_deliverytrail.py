@@ -0,0 +1,80 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:49
+
+import zlib
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Copie figée de l'encodeur de medex_app.trails au moment de cette migration :
+# une évolution future du module ne doit pas changer ce que la migration écrit.
+
+def to_micro(value):
+    return int((Decimal(str(value)) * 1_000_000).to_integral_value())
+
+
+def write_varint(out, value):
+    value = (value << 1) ^ (value >> 63)
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def copy_locations_to_trails(apps, schema_editor):
+    """Convertir l'historique ligne par ping en une trace compacte par livraison"""
+    DeliveryLocation = apps.get_model('medex_app', 'DeliveryLocation')
+    DeliveryTrail = apps.get_model('medex_app', 'DeliveryTrail')
+    delivery_ids = DeliveryLocation.objects.values_list('delivery_id', flat=True).distinct()
+    for delivery_id in delivery_ids.iterator():
+        points = DeliveryLocation.objects.filter(delivery_id=delivery_id).order_by(
+            'recorded_at', 'id'
+        ).values_list('latitude', 'longitude', 'recorded_at')
+        out = bytearray()
+        last = (0, 0, 0)
+        count = 0
+        started_at = None
+        for latitude, longitude, recorded_at in points:
+            point = (to_micro(latitude), to_micro(longitude), int(recorded_at.timestamp()))
+            for value, previous in zip(point, last):
+                write_varint(out, value - previous)
+            last = point
+            count += 1
+            started_at = started_at or recorded_at
+        DeliveryTrail.objects.create(
+            delivery_id=delivery_id,
+            data=zlib.compress(bytes(out), 6),
+            point_count=count,
+            last_latitude=last[0],
+            last_longitude=last[1],
+            last_timestamp=last[2],
+            started_at=started_at,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0015_travelspeedgrid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryTrail',
+            fields=[
+                ('delivery', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='trail', serialize=False, to='medex_app.delivery')),
+                ('data', models.BinaryField(default=bytes)),
+                ('point_count', models.PositiveIntegerField(default=0)),
+                ('last_latitude', models.IntegerField(default=0)),
+                ('last_longitude', models.IntegerField(default=0)),
+                ('last_timestamp', models.BigIntegerField(default=0)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(copy_locations_to_trails, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='DeliveryLocation',
+        ),
+    ]
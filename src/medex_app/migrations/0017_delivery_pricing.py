@@ -0,0 +1,45 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0016_deliverytrail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryFeeBand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('max_distance_km', models.FloatField()),
+                ('fee', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('min_order_amount', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('pharmacy', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='delivery_fee_bands', to='medex_app.pharmacy')),
+            ],
+            options={
+                'ordering': ['pharmacy', 'max_distance_km'],
+            },
+        ),
+        migrations.CreateModel(
+            name='DeliveryZone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('polygon', models.JSONField(help_text='Sommets [[latitude, longitude], ...]')),
+                ('fee', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('min_order_amount', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('priority', models.IntegerField(default=0, help_text="La zone de priorité la plus haute l'emporte en cas de chevauchement")),
+                ('is_active', models.BooleanField(default=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('pharmacy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='delivery_zones', to='medex_app.pharmacy')),
+            ],
+            options={
+                'ordering': ['pharmacy', '-priority', 'id'],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medex_app', '0017_delivery_pricing'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pharmacy',
+            name='logo',
+            field=models.ImageField(blank=True, db_index=True, null=True, upload_to='pharmacy_logos/'),
+        ),
+        migrations.AlterField(
+            model_name='prescription',
+            name='file_path',
+            field=models.FileField(db_index=True, upload_to='prescriptions/'),
+        ),
+    ]
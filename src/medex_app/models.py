@@ -3,7 +3,11 @@ from django.utils import timezone
 
 
 
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Count
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.hashers import make_password
@@ -11,6 +15,7 @@ from django.contrib.auth.hashers import make_password
 
 import random
 import string
+import uuid
 from datetime import timedelta
 from django.utils import timezone
 
@@ -41,7 +46,9 @@ class AppUser(AbstractUser):
     address = models.TextField(blank=True, null=True)
     role = models.CharField(max_length=20, choices=ROLE_CHOICES, default='client')
     
-    
+    # 2FA par application d'authentification (TOTP) : actif une fois confirmé
+    totp_secret = models.CharField(max_length=32, blank=True, null=True)
+    totp_confirmed_at = models.DateTimeField(blank=True, null=True)
     
 
     class Meta:
@@ -51,6 +58,10 @@ class AppUser(AbstractUser):
     def __str__(self):
         return f"{self.first_name} {self.last_name} ({self.role})"
 
+    @property
+    def totp_enabled(self):
+        return bool(self.totp_secret and self.totp_confirmed_at)
+
 
 
 
@@ -66,6 +77,10 @@ class OTPVerification(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # admin_verify_otp / create_otp : recherche par utilisateur, codes non utilisés, le plus récent
+            models.Index(fields=['user', 'is_used', 'created_at'], name='otp_user_used_created_idx'),
+        ]
     
     def __str__(self):
         return f"OTP for {self.user.email} - {self.otp_code}"
@@ -115,7 +130,7 @@ class Pharmacy(models.Model):
     is_open = models.BooleanField(default=True)
     owner = models.ForeignKey(AppUser, on_delete=models.CASCADE, related_name='pharmacies')
     
-    logo = models.ImageField(upload_to='pharmacy_logos/', blank=True, null=True)
+    logo = models.ImageField(upload_to='pharmacy_logos/', blank=True, null=True, db_index=True)
     description = models.TextField(blank=True, null=True)
     opening_hours = models.JSONField(default=dict, blank=True)
     is_verified = models.BooleanField(default=False)
@@ -129,6 +144,14 @@ class Pharmacy(models.Model):
         verbose_name_plural = "Pharmacies"
         ordering = ['-is_verified', '-rating', 'name']
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Logo chargé : libéré dans le stockage partagé s'il est remplacé (media_store)
+        logo = instance.__dict__.get('logo')
+        instance._loaded_logo = getattr(logo, 'name', logo)
+        return instance
+
     def __str__(self):
         return self.name
 
@@ -294,6 +317,9 @@ class Order(models.Model):
     
     delivery_address = models.TextField(blank=True, null=True)
     delivery_phone = models.CharField(max_length=20, blank=True, null=True)
+    # Adresse géocodée (planification des tournées)
+    delivery_latitude = models.DecimalField(max_digits=10, decimal_places=6, blank=True, null=True)
+    delivery_longitude = models.DecimalField(max_digits=10, decimal_places=6, blank=True, null=True)
     
     customer_notes = models.TextField(blank=True, null=True)
     pharmacy_notes = models.TextField(blank=True, null=True)
@@ -309,16 +335,148 @@ class Order(models.Model):
             models.Index(fields=['-order_date']),
         ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Statut chargé, pour maintenir les compteurs par statut lors du save()
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
     def save(self, *args, **kwargs):
         if not self.order_number:
-            import uuid
-            self.order_number = f"ORD-{uuid.uuid4().hex[:8].upper()}"
-        super().save(*args, **kwargs)
+            from .order_numbers import next_order_number
+            self.order_number = next_order_number()
+
+        adding = self._state.adding
+        previous_status = getattr(self, '_loaded_status', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                OrderStatusCounter.adjust(self, self.status, 1)
+                OrderStatusEvent.objects.create(
+                    order=self,
+                    pharmacy_id=self.pharmacy_id,
+                    from_status=None,
+                    to_status=self.status
+                )
+            elif previous_status and previous_status != self.status:
+                OrderStatusCounter.adjust(self, previous_status, -1)
+                OrderStatusCounter.adjust(self, self.status, 1)
+        self._loaded_status = self.status
 
     def __str__(self):
         return f"Order {self.order_number} - {self.user.first_name} from {self.pharmacy.name}"
 
 
+class OrderStatusCounter(models.Model):
+    """
+    Nombre de commandes par statut, par client et par pharmacie.
+    Maintenu par Order.save() / post_delete (les QuerySet.update() ne sont pas suivis,
+    utiliser OrderStatusCounter.rebuild() après une mise à jour de masse).
+    """
+    SCOPE_CHOICES = [
+        ('user', 'User'),
+        ('pharmacy', 'Pharmacy'),
+    ]
+
+    scope = models.CharField(max_length=10, choices=SCOPE_CHOICES)
+    owner_id = models.PositiveBigIntegerField()
+    status = models.CharField(max_length=30)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('scope', 'owner_id', 'status')
+
+    def __str__(self):
+        return f"{self.scope} {self.owner_id} - {self.status}: {self.count}"
+
+    @classmethod
+    def adjust(cls, order, status, delta):
+        """Ajouter delta aux compteurs du client et de la pharmacie de la commande"""
+        for scope, owner_id in (('user', order.user_id), ('pharmacy', order.pharmacy_id)):
+            lookup = {'scope': scope, 'owner_id': owner_id, 'status': status}
+            if cls.objects.filter(**lookup).update(count=F('count') + delta):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(count=delta, **lookup)
+            except IntegrityError:
+                cls.objects.filter(**lookup).update(count=F('count') + delta)
+
+    @classmethod
+    def counts_for(cls, scope, owner_id):
+        """Compteurs {statut: nombre} pour un client ou une pharmacie (une seule requête)"""
+        counts = {code: 0 for code, _ in Order.STATUS_CHOICES}
+        for status, count in cls.objects.filter(
+            scope=scope, owner_id=owner_id
+        ).values_list('status', 'count'):
+            counts[status] = count
+        counts['all'] = sum(counts.values())
+        return counts
+
+    @classmethod
+    def rebuild(cls):
+        """Recalculer tous les compteurs à partir de la table Order"""
+        counters = []
+        for scope, field in (('user', 'user_id'), ('pharmacy', 'pharmacy_id')):
+            rows = Order.objects.order_by().values(field, 'status').annotate(total=Count('id'))
+            counters.extend(
+                cls(scope=scope, owner_id=row[field], status=row['status'], count=row['total'])
+                for row in rows
+            )
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(counters, batch_size=1000)
+        return len(counters)
+
+
+@receiver(post_delete, sender=Order)
+def decrement_order_status_counter(sender, instance, **kwargs):
+    OrderStatusCounter.adjust(instance, instance.status, -1)
+
+
+class OrderStatusEvent(models.Model):
+    """Journal des changements de statut (alimente le flux temps réel des pharmacies)"""
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='status_events')
+    pharmacy = models.ForeignKey(Pharmacy, on_delete=models.CASCADE, related_name='order_events')
+    from_status = models.CharField(max_length=30, blank=True, null=True)
+    to_status = models.CharField(max_length=30)
+    changed_by = models.ForeignKey(AppUser, on_delete=models.SET_NULL, null=True, blank=True, related_name='order_status_changes')
+    note = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['pharmacy', 'id']),
+            models.Index(fields=['order', 'id']),
+        ]
+
+    def __str__(self):
+        return f"Order {self.order_id}: {self.from_status or '-'} -> {self.to_status}"
+
+    def to_payload(self):
+        return {
+            'id': self.id,
+            'order_id': self.order_id,
+            'order_number': self.order.order_number,
+            'from_status': self.from_status,
+            'to_status': self.to_status,
+            'note': self.note,
+            'created_at': self.created_at.isoformat(),
+        }
+
+
+class OrderNumberSequence(models.Model):
+    """Compteur global des numéros de commande, réservé par blocs par chaque worker"""
+    name = models.CharField(max_length=50, primary_key=True)
+    next_value = models.PositiveBigIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Sequence {self.name} (next: {self.next_value})"
+
+
 # ===============================
 # 10. OrderItem Model
 # ===============================
@@ -341,7 +499,7 @@ class OrderItem(models.Model):
 # ===============================
 class Prescription(models.Model):
     order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='prescription')
-    file_path = models.FileField(upload_to='prescriptions/')
+    file_path = models.FileField(upload_to='prescriptions/', db_index=True)
     upload_date = models.DateTimeField(auto_now_add=True)
     is_validated = models.BooleanField(default=False)
     validated_by = models.ForeignKey(AppUser, on_delete=models.SET_NULL, null=True, blank=True, related_name='validated_prescriptions')
@@ -352,6 +510,45 @@ class Prescription(models.Model):
         return f"Prescription for Order {self.order.order_number}"
 
 
+class PrescriptionUpload(models.Model):
+    """Session d'upload d'ordonnance par morceaux (reprise possible après coupure)"""
+    STATUS_CHOICES = [
+        ('uploading', 'Uploading'),
+        ('completed', 'Completed'),
+        ('aborted', 'Aborted'),
+    ]
+    TTL = timedelta(hours=24)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='prescription_uploads')
+    user = models.ForeignKey(AppUser, on_delete=models.CASCADE, related_name='prescription_uploads')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True, null=True)
+    total_size = models.PositiveBigIntegerField()
+    checksum = models.CharField(max_length=64)
+    received_size = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploading')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Upload {self.id} ({self.received_size}/{self.total_size})"
+
+    @property
+    def storage_prefix(self):
+        return f"prescription_uploads/{self.id}"
+
+    def part_name(self, offset):
+        return f"{self.storage_prefix}/{offset:012d}.part"
+
+    def is_expired(self):
+        return timezone.now() > self.expires_at
+
+
 # ===============================
 # 12. Payment Model
 # ===============================
@@ -413,6 +610,13 @@ class Delivery(models.Model):
     
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # File d'attente du dispatch et charge courante de chaque livreur
+            models.Index(fields=['delivery_status', 'delivery_person']),
+            models.Index(fields=['delivery_person', 'delivery_status']),
+        ]
+
     def __str__(self):
         return f"Delivery for Order {self.order.order_number} - {self.delivery_status}"
 
@@ -481,6 +685,207 @@ class PharmacyReview(models.Model):
     def __str__(self):
         return f"{self.user.first_name} - {self.pharmacy.name} ({self.rating}★)"
 
+
+# ===============================
+# 16. MediaBlob Model
+# ===============================
+class MediaBlob(models.Model):
+    """Fichier média stocké sous son empreinte SHA-256 (écrit une seule fois, compté par référence)"""
+    hash = models.CharField(max_length=64, primary_key=True)
+    path = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.path} ({self.ref_count} refs)"
+
+
+# ===============================
+# 17. IdempotencyKey Model
+# ===============================
+class IdempotencyKey(models.Model):
+    """Réponse mémorisée pour un en-tête Idempotency-Key (rejouée lors des retries)"""
+    TTL = timedelta(hours=24)
+
+    user = models.ForeignKey(AppUser, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=64)
+    endpoint = models.CharField(max_length=100)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(blank=True, null=True)
+    response_body = models.JSONField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('user', 'key')
+
+    def __str__(self):
+        return f"Idempotency key {self.key} ({self.endpoint})"
+
+    def is_expired(self):
+        return timezone.now() > self.expires_at
+
+    def is_completed(self):
+        return self.status_code is not None
+
+    @classmethod
+    def purge_expired(cls):
+        """Supprimer les clés expirées"""
+        deleted, _ = cls.objects.filter(expires_at__lt=timezone.now()).delete()
+        return deleted
+
+
+# ===============================
+# 18. OutboundEmail Model
+# ===============================
+class OutboundEmail(models.Model):
+    """Email en file d'attente, envoyé par le worker (outbox) et non pendant la requête"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+    MAX_ATTEMPTS = 5
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True, null=True)
+    to = models.JSONField(default=list)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {', '.join(self.to)} ({self.status})"
+
+    @classmethod
+    def enqueue(cls, subject, body, to, from_email=None):
+        """Mettre un email en file ; le worker est réveillé une fois la transaction validée"""
+        message = cls.objects.create(subject=subject, body=body, to=list(to), from_email=from_email)
+        from .outbox import wake_worker
+        transaction.on_commit(wake_worker)
+        return message
+
+
+# ===============================
+# 19. DeliveryTrail Model
+# ===============================
+class DeliveryTrail(models.Model):
+    """
+    Trace GPS d'une livraison en un seul blob (voir trails.py) : écarts en
+    micro-degrés encodés en varint puis compressés. Le dernier point absolu
+    est gardé en colonnes pour ajouter des points sans décoder la trace.
+    """
+    delivery = models.OneToOneField(Delivery, on_delete=models.CASCADE, primary_key=True, related_name='trail')
+    data = models.BinaryField(default=bytes)
+    point_count = models.PositiveIntegerField(default=0)
+    last_latitude = models.IntegerField(default=0)  # micro-degrés
+    last_longitude = models.IntegerField(default=0)  # micro-degrés
+    last_timestamp = models.BigIntegerField(default=0)  # secondes (epoch)
+    started_at = models.DateTimeField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Trail of delivery {self.delivery_id} ({self.point_count} points)"
+
+
+# ===============================
+# 20. TravelSpeedGrid Model
+# ===============================
+class TravelSpeedGrid(models.Model):
+    """Vitesses moyennes apprises par zone et par heure (reconstruite chaque nuit, seule la dernière est lue)"""
+    cell_degrees = models.FloatField()
+    speeds = models.JSONField(default=dict)  # {"ligne:colonne": [24 vitesses km/h ou null]}
+    hourly_speeds = models.JSONField(default=list)  # 24 vitesses, toutes zones confondues
+    default_speed = models.FloatField()
+    sample_count = models.PositiveIntegerField(default=0)
+    built_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        get_latest_by = 'built_at'
+
+    def __str__(self):
+        return f"Speed grid {self.built_at:%Y-%m-%d %H:%M} ({self.sample_count} trips)"
+
+
+class PricingQuerySet(models.QuerySet):
+    """
+    update() de masse qui met aussi updated_at à jour : la signature relue par
+    pricing.table_version() change, comme après save() (auto_now ne couvre pas update()).
+    """
+
+    def update(self, **kwargs):
+        kwargs.setdefault('updated_at', timezone.now())
+        return super().update(**kwargs)
+
+
+# ===============================
+# 21. DeliveryZone Model
+# ===============================
+class DeliveryZone(models.Model):
+    """Zone de livraison (polygone) d'une pharmacie, avec son tarif"""
+    pharmacy = models.ForeignKey(Pharmacy, on_delete=models.CASCADE, related_name='delivery_zones')
+    name = models.CharField(max_length=100)
+    polygon = models.JSONField(help_text="Sommets [[latitude, longitude], ...]")
+    fee = models.DecimalField(max_digits=10, decimal_places=2)
+    min_order_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    priority = models.IntegerField(default=0, help_text="La zone de priorité la plus haute l'emporte en cas de chevauchement")
+    is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = PricingQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['pharmacy', '-priority', 'id']
+
+    def __str__(self):
+        return f"{self.pharmacy.name} - {self.name}"
+
+    def clean(self):
+        """Au moins 3 sommets [latitude, longitude] numériques et dans les bornes"""
+        polygon = self.polygon
+        if not isinstance(polygon, list) or len(polygon) < 3:
+            raise ValidationError({'polygon': "A zone needs at least 3 [latitude, longitude] points."})
+        for point in polygon:
+            valid = (
+                isinstance(point, (list, tuple)) and len(point) == 2
+                and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in point)
+                and -90 <= point[0] <= 90 and -180 <= point[1] <= 180
+            )
+            if not valid:
+                raise ValidationError({'polygon': f"Invalid point {point!r}: expected [latitude, longitude]."})
+
+
+# ===============================
+# 22. DeliveryFeeBand Model
+# ===============================
+class DeliveryFeeBand(models.Model):
+    """Tarif par tranche de distance ; sans pharmacie, la tranche s'applique à toutes celles sans tranches propres"""
+    pharmacy = models.ForeignKey(Pharmacy, on_delete=models.CASCADE, null=True, blank=True, related_name='delivery_fee_bands')
+    max_distance_km = models.FloatField()
+    fee = models.DecimalField(max_digits=10, decimal_places=2)
+    min_order_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = PricingQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['pharmacy', 'max_distance_km']
+
+    def __str__(self):
+        scope = self.pharmacy.name if self.pharmacy_id else 'All pharmacies'
+        return f"{scope} - up to {self.max_distance_km} km: {self.fee}"
+
 """
 # ===============================
 # 1. User Model
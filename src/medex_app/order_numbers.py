@@ -0,0 +1,139 @@
+import os
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OrderNumberSequence
+
+
+SEQUENCE_NAME = 'order_number'
+DEFAULT_BLOCK_SIZE = 100
+
+
+# ===========================
+# ALLOCATION DES NUMÉROS DE COMMANDE
+# ===========================
+
+class OrderNumberAllocator:
+    """
+    Distribue les numéros de commande depuis un bloc réservé en mémoire.
+
+    Chaque worker réserve BLOCK_SIZE numéros d'un coup dans la table
+    OrderNumberSequence (une seule écriture par bloc), puis les distribue
+    sans accès base. Les numéros sont uniques entre workers et croissants
+    au sein d'un worker. Les numéros non distribués d'un bloc sont perdus
+    au redémarrage, ce qui laisse des trous mais jamais de doublons.
+
+    Le bloc est réservé sur une connexion dédiée, validée aussitôt, hors de
+    la transaction de l'appelant : l'annulation de la commande n'annule pas
+    la réservation (un autre worker ne peut pas recevoir le même bloc), et
+    le verrou sur la ligne de séquence n'est pas gardé jusqu'au commit de la
+    commande. SQLite n'accepte qu'un écrivain à la fois : le bloc y est
+    réservé dans la transaction de l'appelant et n'est gardé en mémoire
+    qu'après son commit.
+    """
+
+    def __init__(self, sequence_name=SEQUENCE_NAME, block_size=None):
+        self.sequence_name = sequence_name
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = 0
+        self._end = 0
+
+    def _get_block_size(self):
+        if self.block_size:
+            return self.block_size
+        return getattr(settings, 'ORDER_NUMBER_BLOCK_SIZE', DEFAULT_BLOCK_SIZE)
+
+    def _reserve_on_own_connection(self, size):
+        """Réserver un bloc [start, start + size) sur une connexion séparée, validée aussitôt"""
+        own = connections.create_connection(DEFAULT_DB_ALIAS)
+        table = own.ops.quote_name(OrderNumberSequence._meta.db_table)
+        try:
+            own.set_autocommit(False)
+            for _ in range(2):
+                now = own.ops.adapt_datetimefield_value(timezone.now())
+                try:
+                    with own.cursor() as cursor:
+                        # L'UPDATE verrouille la ligne jusqu'au commit ; on relit ensuite notre propre écriture
+                        cursor.execute(
+                            f"UPDATE {table} SET next_value = next_value + %s, updated_at = %s WHERE name = %s",
+                            [size, now, self.sequence_name]
+                        )
+                        if cursor.rowcount == 0:
+                            cursor.execute(
+                                f"INSERT INTO {table} (name, next_value, updated_at) VALUES (%s, %s, %s)",
+                                [self.sequence_name, 1 + size, now]
+                            )
+                        cursor.execute(f"SELECT next_value FROM {table} WHERE name = %s", [self.sequence_name])
+                        end = cursor.fetchone()[0]
+                    own.commit()
+                    return end - size, end
+                except IntegrityError:
+                    # Ligne de séquence créée entre-temps par un autre worker : recommencer
+                    own.rollback()
+            raise IntegrityError(f"Could not reserve a block for sequence {self.sequence_name}")
+        except Exception:
+            own.rollback()
+            raise
+        finally:
+            own.close()
+
+    def _reserve_in_transaction(self, size):
+        """Repli SQLite : réservation dans la transaction courante"""
+        OrderNumberSequence.objects.get_or_create(name=self.sequence_name)
+        with transaction.atomic():
+            OrderNumberSequence.objects.filter(name=self.sequence_name).update(
+                next_value=F('next_value') + size
+            )
+            end = OrderNumberSequence.objects.values_list(
+                'next_value', flat=True
+            ).get(name=self.sequence_name)
+        return end - size, end
+
+    def _keep(self, start, end, pid):
+        with self._lock:
+            if self._pid != pid or self._next >= self._end:
+                self._next, self._end, self._pid = start, end, pid
+
+    def allocate(self):
+        with self._lock:
+            # Un bloc hérité d'un processus parent (fork) ne doit pas être réutilisé
+            if self._pid == os.getpid() and self._next < self._end:
+                value = self._next
+                self._next += 1
+                return value
+
+            size = self._get_block_size()
+            if connection.vendor != 'sqlite':
+                start, end = self._reserve_on_own_connection(size)
+                self._next, self._end, self._pid = start + 1, end, os.getpid()
+                return start
+
+        start, end = self._reserve_in_transaction(size)
+        # Exécuté tout de suite hors transaction ; jamais si la transaction est annulée
+        pid = os.getpid()
+        transaction.on_commit(lambda: self._keep(start + 1, end, pid))
+        return start
+
+    def reset(self):
+        """Abandonner le bloc courant (tests)"""
+        with self._lock:
+            self._pid = None
+            self._next = self._end = 0
+
+
+def format_order_number(value):
+    """ORD-000000123 : 9 chiffres, distinct des anciens numéros ORD-XXXXXXXX (8 hex)"""
+    return f"ORD-{value:09d}"
+
+
+allocator = OrderNumberAllocator()
+
+
+def next_order_number():
+    return format_order_number(allocator.allocate())
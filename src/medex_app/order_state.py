@@ -0,0 +1,77 @@
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order, OrderStatusEvent
+
+
+# ===========================
+# MACHINE À ÉTATS DES COMMANDES
+# ===========================
+
+TRANSITIONS = {
+    'pending': {'pending_prescription', 'under_review', 'validated', 'cancelled'},
+    'pending_prescription': {'under_review', 'cancelled'},
+    'under_review': {'validated', 'pending_prescription', 'cancelled'},
+    'validated': {'preparing', 'cancelled'},
+    'preparing': {'ready_for_pickup', 'cancelled'},
+    'ready_for_pickup': {'in_delivery', 'cancelled'},
+    'in_delivery': {'delivered', 'ready_for_pickup'},
+    'delivered': set(),
+    'cancelled': set(),
+}
+
+TERMINAL_STATUSES = {status for status, targets in TRANSITIONS.items() if not targets}
+
+
+class InvalidTransition(Exception):
+    """Transition de statut non autorisée"""
+
+    def __init__(self, from_status, to_status):
+        self.from_status = from_status
+        self.to_status = to_status
+        super().__init__(f"Cannot change order status from '{from_status}' to '{to_status}'.")
+
+
+def allowed_transitions(status):
+    return sorted(TRANSITIONS.get(status, ()))
+
+
+def can_transition(from_status, to_status):
+    return to_status in TRANSITIONS.get(from_status, ())
+
+
+def transition(order, to_status, changed_by=None, note=None):
+    """
+    Changer le statut d'une commande et journaliser l'événement.
+    La ligne est verrouillée pour que deux changements concurrents ne
+    puissent pas partir du même statut.
+    """
+    if to_status not in TRANSITIONS:
+        raise InvalidTransition(order.status, to_status)
+
+    with transaction.atomic():
+        locked = Order.objects.select_for_update().get(pk=order.pk)
+        from_status = locked.status
+        if not can_transition(from_status, to_status):
+            raise InvalidTransition(from_status, to_status)
+
+        locked.status = to_status
+        update_fields = ['status', 'updated_at']
+        if to_status in TERMINAL_STATUSES:
+            locked.completed_at = timezone.now()
+            update_fields.append('completed_at')
+        locked.save(update_fields=update_fields)
+
+        event = OrderStatusEvent.objects.create(
+            order=locked,
+            pharmacy_id=locked.pharmacy_id,
+            from_status=from_status,
+            to_status=to_status,
+            changed_by=changed_by,
+            note=note or None
+        )
+
+    order.status = locked.status
+    order.completed_at = locked.completed_at
+    order._loaded_status = locked.status
+    return event
@@ -0,0 +1,255 @@
+import asyncio
+import json
+
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework import status
+from .models import Order, OrderStatusCounter, OrderStatusEvent, Pharmacy
+from .serializers import OrderSerializer
+from .pagination import paginate_keyset, InvalidCursor
+from .order_state import transition, allowed_transitions, InvalidTransition
+from .authentication import get_identity, stream_user
+
+
+def _order_list_queryset(**filters):
+    """Commandes avec pharmacie, paiement, livraison et articles en 2 requêtes"""
+    return Order.objects.filter(**filters).select_related(
+        'pharmacy', 'payment', 'delivery'
+    ).prefetch_related('items')
+
+
+def _order_list_response(queryset, params, scope, owner_id):
+    status_filter = params.get('status')
+    if status_filter:
+        if status_filter not in dict(Order.STATUS_CHOICES):
+            return Response({
+                'success': False,
+                'message': 'Invalid status.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        queryset = queryset.filter(status=status_filter)
+
+    try:
+        orders, pagination = paginate_keyset(queryset, params)
+    except InvalidCursor:
+        return Response({
+            'success': False,
+            'message': 'Invalid cursor.'
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({
+        'success': True,
+        'orders': OrderSerializer(orders, many=True).data,
+        'pagination': pagination,
+        'status_counts': OrderStatusCounter.counts_for(scope, owner_id)
+    }, status=status.HTTP_200_OK)
+
+
+# ===========================
+# HISTORIQUE DES COMMANDES
+# ===========================
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def customer_orders(request):
+    """Commandes du client connecté (pagination par curseur)"""
+    try:
+        user = request.user
+        queryset = _order_list_queryset(user=user)
+        return _order_list_response(queryset, request.query_params, 'user', user.id)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def pharmacy_orders(request):
+    """Commandes reçues par la pharmacie du pharmacien connecté (pagination par curseur)"""
+    try:
+        user = request.user
+
+        if user.role != 'pharmacist':
+            return Response({
+                'success': False,
+                'message': 'Only pharmacists can access this endpoint.'
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        pharmacy = get_identity(request).pharmacy
+        if pharmacy is None:
+            return Response({
+                'success': False,
+                'message': 'No pharmacy found for this user.'
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        queryset = _order_list_queryset(pharmacy=pharmacy)
+        return _order_list_response(queryset, request.query_params, 'pharmacy', pharmacy.id)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# ===========================
+# CHANGEMENT DE STATUT (Pharmacien)
+# ===========================
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def update_order_status(request, order_id):
+    """Faire avancer une commande dans son cycle de vie"""
+    try:
+        user = request.user
+
+        if user.role != 'pharmacist':
+            return Response({
+                'success': False,
+                'message': 'Only pharmacists can update orders.'
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            order = Order.objects.get(id=order_id, pharmacy__owner=user)
+        except Order.DoesNotExist:
+            return Response({
+                'success': False,
+                'message': 'Order not found.'
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        new_status = request.data.get('status')
+        try:
+            event = transition(order, new_status, changed_by=user, note=request.data.get('note'))
+        except InvalidTransition as e:
+            return Response({
+                'success': False,
+                'message': str(e),
+                'allowed_statuses': allowed_transitions(e.from_status)
+            }, status=status.HTTP_409_CONFLICT)
+
+        return Response({
+            'success': True,
+            'message': 'Order status updated successfully',
+            'status': order.status,
+            'allowed_statuses': allowed_transitions(order.status),
+            'event': event.to_payload()
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# ===========================
+# FLUX TEMPS RÉEL (SSE / LONG-POLL, servi par l'application ASGI)
+# ===========================
+
+FEED_POLL_INTERVAL = getattr(settings, 'ORDER_FEED_POLL_INTERVAL', 1.0)
+FEED_HEARTBEAT_INTERVAL = 15
+FEED_MAX_STREAM_SECONDS = 300
+LONG_POLL_MAX_TIMEOUT = 30
+
+
+async def _pharmacy_for_request(request):
+    """Pharmacie du pharmacien authentifié (en-tête Authorization ou ticket de flux)"""
+    user = await stream_user(request)
+    if user is None or user.role != 'pharmacist':
+        return None
+    return await Pharmacy.objects.filter(owner_id=user.id).only('id').afirst()
+
+
+async def _events_after(pharmacy_id, last_id, limit=100):
+    queryset = OrderStatusEvent.objects.filter(
+        pharmacy_id=pharmacy_id, id__gt=last_id
+    ).select_related('order').order_by('id')[:limit]
+    return [event async for event in queryset]
+
+
+async def _latest_event_id(pharmacy_id):
+    last = await OrderStatusEvent.objects.filter(
+        pharmacy_id=pharmacy_id
+    ).order_by('-id').values_list('id', flat=True).afirst()
+    return last or 0
+
+
+def _parse_event_id(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+async def pharmacy_order_stream(request):
+    """
+    Flux Server-Sent Events des commandes de la pharmacie connectée.
+    Reprend après Last-Event-ID (ou ?after=) ; sinon ne diffuse que les nouveaux événements.
+    """
+    pharmacy = await _pharmacy_for_request(request)
+    if pharmacy is None:
+        return JsonResponse({'success': False, 'message': 'Authentication required.'}, status=401)
+
+    last_id = _parse_event_id(request.headers.get('Last-Event-ID') or request.GET.get('after'))
+    if last_id is None:
+        last_id = await _latest_event_id(pharmacy.id)
+
+    async def stream():
+        nonlocal last_id
+        loop = asyncio.get_running_loop()
+        started = last_beat = loop.time()
+        yield 'retry: 3000\n\n'
+        while loop.time() - started < FEED_MAX_STREAM_SECONDS:
+            events = await _events_after(pharmacy.id, last_id)
+            for event in events:
+                last_id = event.id
+                yield f"id: {event.id}\nevent: order\ndata: {json.dumps(event.to_payload())}\n\n"
+            now = loop.time()
+            if events:
+                last_beat = now
+            elif now - last_beat >= FEED_HEARTBEAT_INTERVAL:
+                last_beat = now
+                yield ': keep-alive\n\n'
+            await asyncio.sleep(FEED_POLL_INTERVAL)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def pharmacy_order_events(request):
+    """
+    Long-poll : retourne les événements après ?after=<id>, en attendant
+    jusqu'à ?timeout= secondes s'il n'y en a pas encore.
+    """
+    pharmacy = await _pharmacy_for_request(request)
+    if pharmacy is None:
+        return JsonResponse({'success': False, 'message': 'Authentication required.'}, status=401)
+
+    last_id = _parse_event_id(request.GET.get('after'))
+    if last_id is None:
+        last_id = await _latest_event_id(pharmacy.id)
+
+    try:
+        timeout = min(float(request.GET.get('timeout', 25)), LONG_POLL_MAX_TIMEOUT)
+    except ValueError:
+        timeout = 25
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max(timeout, 0)
+    events = await _events_after(pharmacy.id, last_id)
+    while not events and loop.time() < deadline:
+        await asyncio.sleep(FEED_POLL_INTERVAL)
+        events = await _events_after(pharmacy.id, last_id)
+
+    return JsonResponse({
+        'success': True,
+        'events': [event.to_payload() for event in events],
+        'last_event_id': events[-1].id if events else last_id
+    })
@@ -0,0 +1,132 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import OutboundEmail
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+# Délai pendant lequel un message réservé n'est pas repris par un autre worker
+CLAIM_LEASE = timedelta(minutes=5)
+RETRY_BASE_DELAY = 30  # secondes, doublé à chaque tentative
+RETRY_MAX_DELAY = 3600
+
+# Un seul thread : les réveils successifs s'enchaînent au lieu d'ouvrir plusieurs connexions SMTP
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='email-outbox')
+
+
+# ===========================
+# OUTBOX EMAIL
+# ===========================
+
+def retry_delay(attempts):
+    """Backoff exponentiel : 30 s, 1 min, 2 min, ... plafonné à 1 h"""
+    return timedelta(seconds=min(RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0), RETRY_MAX_DELAY))
+
+
+def _claim(limit):
+    """Réserver les messages dus en repoussant leur prochaine tentative de CLAIM_LEASE"""
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            OutboundEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')
+            .values_list('id', flat=True)[:limit]
+        )
+        OutboundEmail.objects.filter(id__in=ids).update(next_attempt_at=now + CLAIM_LEASE)
+    return list(OutboundEmail.objects.filter(id__in=ids).order_by('id'))
+
+
+def _record_failure(message, error):
+    """Tentative échouée : nouvel essai après backoff, ou abandon après MAX_ATTEMPTS"""
+    message.last_error = str(error)
+    if message.attempts >= OutboundEmail.MAX_ATTEMPTS:
+        message.status = 'failed'
+        # Le contenu (code OTP) n'a plus d'usage
+        message.body = ''
+        logger.error("Email %s failed after %s attempts: %s", message.id, message.attempts, error)
+    else:
+        message.next_attempt_at = timezone.now() + retry_delay(message.attempts)
+    message.save(update_fields=['attempts', 'status', 'body', 'next_attempt_at', 'last_error'])
+
+
+def send_pending(limit=BATCH_SIZE, connection=None):
+    """
+    Envoyer les messages en attente sur une seule connexion SMTP.
+    Retourne (envoyés, en échec).
+    """
+    messages = _claim(limit)
+    if not messages:
+        return 0, 0
+
+    sent = failed = 0
+    connection = connection or get_connection()
+    remaining = list(messages)
+    try:
+        connection.open()
+        while remaining:
+            message = remaining.pop(0)
+            email = EmailMessage(
+                subject=message.subject,
+                body=message.body,
+                from_email=message.from_email or settings.DEFAULT_FROM_EMAIL,
+                to=message.to,
+                connection=connection,
+            )
+            message.attempts += 1
+            try:
+                email.send(fail_silently=False)
+            except Exception as e:
+                failed += 1
+                _record_failure(message, e)
+                # Une erreur SMTP peut laisser la connexion inutilisable : la rouvrir
+                connection.close()
+                connection.open()
+                continue
+
+            sent += 1
+            message.status = 'sent'
+            message.sent_at = timezone.now()
+            message.last_error = None
+            # Le corps contient un code OTP : il n'est pas conservé une fois envoyé
+            message.body = ''
+            message.save(update_fields=['attempts', 'status', 'body', 'sent_at', 'last_error'])
+    except Exception as e:
+        # Serveur SMTP injoignable : le reste du lot est compté comme une tentative
+        # échouée, sans quoi il serait repris à chaque expiration de la réservation
+        logger.warning("SMTP connection failed, %s emails postponed: %s", len(remaining), e)
+        for message in remaining:
+            message.attempts += 1
+            _record_failure(message, e)
+        failed += len(remaining)
+    finally:
+        connection.close()
+
+    return sent, failed
+
+
+def _drain():
+    close_old_connections()
+    try:
+        while True:
+            sent, failed = send_pending()
+            if not sent and not failed:
+                break
+    except Exception:
+        logger.exception("Email outbox worker failed")
+    finally:
+        close_old_connections()
+
+
+def wake_worker():
+    """Envoyer en arrière-plan dans ce processus (désactivable : EMAIL_OUTBOX_SEND_IN_PROCESS = False)"""
+    if getattr(settings, 'EMAIL_OUTBOX_SEND_IN_PROCESS', True):
+        _executor.submit(_drain)
@@ -0,0 +1,80 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+# ===========================
+# PAGINATION PAR CURSEUR (KEYSET)
+# ===========================
+
+def encode_cursor(values):
+    payload = json.dumps(values, default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, model, fields):
+    """Décoder un curseur en valeurs typées pour chaque champ de tri"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(values, list) or len(values) != len(fields):
+            raise InvalidCursor('Invalid cursor')
+        return [model._meta.get_field(name).to_python(value) for name, value in zip(fields, values)]
+    except (ValueError, TypeError, ValidationError) as e:
+        raise InvalidCursor('Invalid cursor') from e
+
+
+def get_page_size(params, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    try:
+        size = int(params.get('limit', default))
+    except (ValueError, TypeError):
+        size = default
+    return max(1, min(size, maximum))
+
+
+def paginate_keyset(queryset, params, fields=('order_date', 'id'), default_size=DEFAULT_PAGE_SIZE):
+    """
+    Pagination par curseur sur des champs triés en ordre décroissant.
+
+    Contrairement à OFFSET, chaque page est une recherche d'index à partir de
+    la dernière ligne vue : le coût ne dépend pas de la profondeur de la page.
+    Retourne (objets, infos de pagination).
+    """
+    page_size = get_page_size(params, default=default_size)
+    queryset = queryset.order_by(*[f'-{name}' for name in fields])
+
+    cursor = params.get('cursor')
+    if cursor:
+        values = decode_cursor(cursor, queryset.model, fields)
+        # (a, b) < (va, vb)  <=>  a < va OR (a = va AND b < vb)
+        condition = Q()
+        for index, name in enumerate(fields):
+            branch = Q(**{f'{name}__lt': values[index]})
+            for previous, previous_value in zip(fields[:index], values[:index]):
+                branch &= Q(**{previous: previous_value})
+            condition |= branch
+        queryset = queryset.filter(condition)
+
+    objects = list(queryset[:page_size + 1])
+    has_more = len(objects) > page_size
+    objects = objects[:page_size]
+
+    next_cursor = None
+    if has_more:
+        last = objects[-1]
+        next_cursor = encode_cursor([getattr(last, name) for name in fields])
+
+    return objects, {
+        'limit': page_size,
+        'has_more': has_more,
+        'next_cursor': next_cursor,
+    }
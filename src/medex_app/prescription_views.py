@@ -0,0 +1,369 @@
+import hashlib
+import io
+import os
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework import status
+from .images import release_entry
+from .models import Order, Prescription, PrescriptionUpload
+
+
+MAX_UPLOAD_SIZE = getattr(settings, 'PRESCRIPTION_UPLOAD_MAX_SIZE', 20 * 1024 * 1024)
+MAX_CHUNK_SIZE = getattr(settings, 'PRESCRIPTION_UPLOAD_MAX_CHUNK_SIZE', 2 * 1024 * 1024)
+READ_CHUNK_SIZE = 64 * 1024
+ALLOWED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.heic', '.pdf')
+
+
+class _PartsReader(io.RawIOBase):
+    """Lecture séquentielle des morceaux stockés, sans les charger en mémoire"""
+
+    def __init__(self, part_names):
+        self._names = list(part_names)
+        self._current = None
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if self._current is None:
+                if not self._names:
+                    return 0
+                self._current = default_storage.open(self._names.pop(0), 'rb')
+            data = self._current.read(len(buffer))
+            if data:
+                buffer[:len(data)] = data
+                self._hash.update(data)
+                self.size += len(data)
+                return len(data)
+            self._current.close()
+            self._current = None
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        super().close()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def _upload_payload(upload):
+    return {
+        'upload_id': str(upload.id),
+        'order_id': upload.order_id,
+        'filename': upload.filename,
+        'total_size': upload.total_size,
+        'offset': upload.received_size,
+        'status': upload.status,
+        'max_chunk_size': MAX_CHUNK_SIZE,
+        'expires_at': upload.expires_at,
+    }
+
+
+def _part_names(upload):
+    """Noms des morceaux triés par offset (les noms sont à largeur fixe)"""
+    try:
+        _, files = default_storage.listdir(upload.storage_prefix)
+    except FileNotFoundError:
+        return []
+    return [f"{upload.storage_prefix}/{name}" for name in sorted(files) if name.endswith('.part')]
+
+
+def _discard_parts(upload):
+    for name in _part_names(upload):
+        default_storage.delete(name)
+
+
+def _get_upload(request, upload_id):
+    try:
+        return PrescriptionUpload.objects.get(id=upload_id, user=request.user)
+    except (PrescriptionUpload.DoesNotExist, ValueError):
+        return None
+
+
+# ===========================
+# UPLOAD D'ORDONNANCE PAR MORCEAUX (REPRISE POSSIBLE)
+# ===========================
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def start_prescription_upload(request, order_id):
+    """
+    Ouvrir une session d'upload.
+    Body: {"filename", "total_size", "checksum" (sha256 hex du fichier complet), "content_type"}
+    """
+    try:
+        try:
+            order = Order.objects.only('id', 'user_id').get(id=order_id, user=request.user)
+        except Order.DoesNotExist:
+            return Response({
+                'success': False,
+                'message': 'Order not found.'
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        filename = os.path.basename(str(request.data.get('filename', '')).strip())
+        checksum = str(request.data.get('checksum', '')).strip().lower()
+        try:
+            total_size = int(request.data.get('total_size'))
+        except (ValueError, TypeError):
+            total_size = 0
+
+        if not filename or not filename.lower().endswith(ALLOWED_EXTENSIONS):
+            return Response({
+                'success': False,
+                'message': f'Invalid file. Allowed formats: {", ".join(ALLOWED_EXTENSIONS)}'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        if total_size <= 0 or total_size > MAX_UPLOAD_SIZE:
+            return Response({
+                'success': False,
+                'message': f'total_size must be between 1 and {MAX_UPLOAD_SIZE} bytes.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        if len(checksum) != 64:
+            return Response({
+                'success': False,
+                'message': 'checksum must be the SHA-256 hex digest of the file.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        upload = PrescriptionUpload.objects.create(
+            order=order,
+            user=request.user,
+            filename=filename,
+            content_type=request.data.get('content_type') or None,
+            total_size=total_size,
+            checksum=checksum,
+            expires_at=timezone.now() + PrescriptionUpload.TTL
+        )
+
+        return Response({
+            'success': True,
+            'upload': _upload_payload(upload)
+        }, status=status.HTTP_201_CREATED)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def prescription_upload_status(request, upload_id):
+    """GET : offset à partir duquel reprendre. DELETE : abandonner l'upload"""
+    try:
+        upload = _get_upload(request, upload_id)
+        if upload is None:
+            return Response({
+                'success': False,
+                'message': 'Upload not found.'
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        if request.method == 'DELETE':
+            if upload.status == 'uploading':
+                _discard_parts(upload)
+                upload.status = 'aborted'
+                upload.save(update_fields=['status', 'updated_at'])
+            return Response({
+                'success': True,
+                'message': 'Upload aborted.',
+                'upload': _upload_payload(upload)
+            }, status=status.HTTP_200_OK)
+
+        return Response({
+            'success': True,
+            'upload': _upload_payload(upload)
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['PUT'])
+@permission_classes([IsAuthenticated])
+def upload_prescription_chunk(request, upload_id):
+    """
+    Envoyer un morceau (corps brut, application/octet-stream).
+    En-têtes : Upload-Offset (position du morceau), Upload-Checksum (sha256 hex du morceau).
+    """
+    try:
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return Response({
+                'success': False,
+                'message': 'Upload-Offset header is required.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        content_length = int(request.headers.get('Content-Length') or 0)
+        if content_length > MAX_CHUNK_SIZE:
+            return Response({
+                'success': False,
+                'message': f'Chunks must be at most {MAX_CHUNK_SIZE} bytes.'
+            }, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        chunk = request.body
+        if not chunk:
+            return Response({
+                'success': False,
+                'message': 'Empty chunk.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        expected_checksum = request.headers.get('Upload-Checksum', '').strip().lower()
+        if expected_checksum and hashlib.sha256(chunk).hexdigest() != expected_checksum:
+            return Response({
+                'success': False,
+                'message': 'Chunk checksum mismatch.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            try:
+                upload = PrescriptionUpload.objects.select_for_update().get(
+                    id=upload_id, user=request.user
+                )
+            except (PrescriptionUpload.DoesNotExist, ValueError):
+                return Response({
+                    'success': False,
+                    'message': 'Upload not found.'
+                }, status=status.HTTP_404_NOT_FOUND)
+
+            if upload.status != 'uploading' or upload.is_expired():
+                return Response({
+                    'success': False,
+                    'message': f'Upload is {upload.status if upload.status != "uploading" else "expired"}.'
+                }, status=status.HTTP_410_GONE)
+
+            if offset != upload.received_size:
+                # Le client doit reprendre à l'offset enregistré
+                return Response({
+                    'success': False,
+                    'message': 'Offset mismatch.',
+                    'offset': upload.received_size
+                }, status=status.HTTP_409_CONFLICT)
+
+            if offset + len(chunk) > upload.total_size:
+                return Response({
+                    'success': False,
+                    'message': 'Chunk exceeds declared total_size.'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            part_name = upload.part_name(offset)
+            if default_storage.exists(part_name):
+                default_storage.delete(part_name)
+            default_storage.save(part_name, File(io.BytesIO(chunk)))
+
+            upload.received_size = offset + len(chunk)
+            upload.save(update_fields=['received_size', 'updated_at'])
+
+        return Response({
+            'success': True,
+            'offset': upload.received_size,
+            'total_size': upload.total_size
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def complete_prescription_upload(request, upload_id):
+    """Assembler les morceaux, vérifier le checksum complet et rattacher l'ordonnance à la commande"""
+    try:
+        with transaction.atomic():
+            try:
+                upload = PrescriptionUpload.objects.select_for_update().select_related('order').get(
+                    id=upload_id, user=request.user
+                )
+            except (PrescriptionUpload.DoesNotExist, ValueError):
+                return Response({
+                    'success': False,
+                    'message': 'Upload not found.'
+                }, status=status.HTTP_404_NOT_FOUND)
+
+            if upload.status != 'uploading' or upload.is_expired():
+                return Response({
+                    'success': False,
+                    'message': f'Upload is {upload.status if upload.status != "uploading" else "expired"}.'
+                }, status=status.HTTP_410_GONE)
+
+            if upload.received_size != upload.total_size:
+                return Response({
+                    'success': False,
+                    'message': 'Upload is incomplete.',
+                    'offset': upload.received_size
+                }, status=status.HTTP_409_CONFLICT)
+
+            # Assemblage en flux : la mémoire reste bornée à READ_CHUNK_SIZE
+            reader = _PartsReader(_part_names(upload))
+            content = File(io.BufferedReader(reader, buffer_size=READ_CHUNK_SIZE), name=upload.filename)
+            try:
+                saved_path = default_storage.save(f"prescriptions/{upload.filename}", content)
+            finally:
+                content.close()
+
+            if reader.size != upload.total_size or reader.hexdigest() != upload.checksum:
+                default_storage.delete(saved_path)
+                _discard_parts(upload)
+                upload.status = 'aborted'
+                upload.save(update_fields=['status', 'updated_at'])
+                return Response({
+                    'success': False,
+                    'message': 'File checksum mismatch. Please upload the file again.'
+                }, status=status.HTTP_400_BAD_REQUEST)
+
+            prescription, created = Prescription.objects.get_or_create(
+                order=upload.order,
+                defaults={'file_path': saved_path}
+            )
+            if not created:
+                # L'ancien fichier n'est supprimé qu'une fois le remplacement validé
+                old_path = prescription.file_path.name
+                if old_path and old_path != saved_path:
+                    transaction.on_commit(lambda: release_entry(old_path))
+                prescription.file_path = saved_path
+                prescription.is_validated = False
+                prescription.validated_by = None
+                prescription.validation_date = None
+                prescription.rejection_reason = None
+                prescription.save()
+
+            upload.status = 'completed'
+            upload.save(update_fields=['status', 'updated_at'])
+
+        _discard_parts(upload)
+
+        return Response({
+            'success': True,
+            'message': 'Prescription uploaded successfully',
+            'prescription': {
+                'id': prescription.id,
+                'order_id': upload.order_id,
+                'file': request.build_absolute_uri(prescription.file_path.url),
+                'upload_date': prescription.upload_date
+            }
+        }, status=status.HTTP_201_CREATED)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -0,0 +1,243 @@
+import logging
+import math
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, Max
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .dispatch import haversine_km
+from .models import DeliveryFeeBand, DeliveryZone
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DELIVERY_FEE = Decimal(str(getattr(settings, 'DEFAULT_DELIVERY_FEE', 500)))
+DEFAULT_MIN_ORDER_AMOUNT = Decimal(str(getattr(settings, 'DEFAULT_MIN_ORDER_AMOUNT', 1000)))
+CELL_DEGREES = 0.005  # ~550 m
+MAX_CELLS_PER_ZONE = 40000
+VERSION_CHECK_INTERVAL = 5  # secondes
+
+
+# ===========================
+# TARIFS DE LIVRAISON
+# ===========================
+#
+# Les zones (polygones) et tranches de distance sont compilées une fois par
+# processus en une table de consultation :
+# - chaque zone est rastérisée sur une grille fine : une cellule entièrement
+#   dans la zone donne la zone directement ; seules les cellules traversées
+#   par un bord demandent un test point-dans-polygone ;
+# - les tranches de distance sont triées par pharmacie.
+# Toutes les VERSION_CHECK_INTERVAL secondes, chaque processus relit en base la
+# signature de la configuration (nombre de lignes et dernière modification) et
+# recompile sa table si elle a changé, sans redémarrage ni cache partagé.
+# save(), delete() et QuerySet.update() (voir PricingQuerySet) la changent ;
+# une écriture SQL directe doit aussi mettre updated_at à jour.
+
+def _cell(latitude, longitude):
+    return math.floor(latitude / CELL_DEGREES), math.floor(longitude / CELL_DEGREES)
+
+
+def _point_in_polygon(latitude, longitude, polygon):
+    inside = False
+    previous_lat, previous_lng = polygon[-1]
+    for lat, lng in polygon:
+        if (lat > latitude) != (previous_lat > latitude):
+            crossing = lng + (latitude - lat) * (previous_lng - lng) / (previous_lat - lat)
+            if longitude < crossing:
+                inside = not inside
+        previous_lat, previous_lng = lat, lng
+    return inside
+
+
+def _segments_intersect(p1, p2, p3, p4):
+    def orientation(a, b, c):
+        return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    d1, d2 = orientation(p3, p4, p1), orientation(p3, p4, p2)
+    d3, d4 = orientation(p1, p2, p3), orientation(p1, p2, p4)
+    return (d1 * d2 <= 0) and (d3 * d4 <= 0)
+
+
+def _edge_touches_cell(start, end, south, west, north, east):
+    if max(start[0], end[0]) < south or min(start[0], end[0]) > north:
+        return False
+    if max(start[1], end[1]) < west or min(start[1], end[1]) > east:
+        return False
+    if south <= start[0] <= north and west <= start[1] <= east:
+        return True
+    corners = ((south, west), (south, east), (north, east), (north, west))
+    return any(_segments_intersect(start, end, corners[i], corners[(i + 1) % 4]) for i in range(4))
+
+
+class CompiledZone:
+
+    def __init__(self, zone):
+        self.id = zone.id
+        self.name = zone.name
+        self.fee = zone.fee
+        self.min_order_amount = zone.min_order_amount
+        self.polygon = [(float(lat), float(lng)) for lat, lng in zone.polygon]
+        latitudes = [lat for lat, _ in self.polygon]
+        longitudes = [lng for _, lng in self.polygon]
+        self.bounds = (min(latitudes), min(longitudes), max(latitudes), max(longitudes))
+
+    def contains(self, latitude, longitude):
+        south, west, north, east = self.bounds
+        return (south <= latitude <= north and west <= longitude <= east
+                and _point_in_polygon(latitude, longitude, self.polygon))
+
+    def rasterize(self):
+        """{cellule: True si entièrement dans la zone, False si traversée par un bord} ; None si trop grande"""
+        south, west, north, east = self.bounds
+        (row_min, col_min), (row_max, col_max) = _cell(south, west), _cell(north, east)
+        if (row_max - row_min + 1) * (col_max - col_min + 1) > MAX_CELLS_PER_ZONE:
+            return None
+        edges = list(zip(self.polygon, self.polygon[1:] + self.polygon[:1]))
+        cells = {}
+        for row in range(row_min, row_max + 1):
+            cell_south, cell_north = row * CELL_DEGREES, (row + 1) * CELL_DEGREES
+            for col in range(col_min, col_max + 1):
+                cell_west, cell_east = col * CELL_DEGREES, (col + 1) * CELL_DEGREES
+                if any(_edge_touches_cell(a, b, cell_south, cell_west, cell_north, cell_east) for a, b in edges):
+                    cells[(row, col)] = False
+                elif _point_in_polygon((cell_south + cell_north) / 2, (cell_west + cell_east) / 2, self.polygon):
+                    cells[(row, col)] = True
+        return cells
+
+
+class PricingTable:
+    """Table de tarifs compilée (une par processus)"""
+
+    def __init__(self, zones, bands):
+        # {pharmacy_id: {cellule: [(zone, exact), ...] par priorité décroissante}}
+        self.zone_cells = {}
+        # {pharmacy_id: [zones trop grandes pour la grille]}
+        self.large_zones = {}
+        for zone in zones:
+            try:
+                zone.clean()
+            except ValidationError as e:
+                # Zone saisie hors de l'admin (update(), import) : ignorée plutôt que de bloquer tous les tarifs
+                logger.warning("Delivery zone %s ignored: %s", zone.id, ' '.join(e.messages))
+                continue
+            compiled = CompiledZone(zone)
+            cells = compiled.rasterize()
+            if cells is None:
+                self.large_zones.setdefault(zone.pharmacy_id, []).append(compiled)
+                continue
+            grid = self.zone_cells.setdefault(zone.pharmacy_id, {})
+            for cell, inside in cells.items():
+                grid.setdefault(cell, []).append((compiled, inside))
+
+        # {pharmacy_id ou None: [(distance max, tarif, minimum), ...] triées}
+        self.bands = {}
+        for band in bands:
+            self.bands.setdefault(band.pharmacy_id, []).append(
+                (band.max_distance_km, band.fee, band.min_order_amount)
+            )
+        for entries in self.bands.values():
+            entries.sort(key=lambda entry: entry[0])
+
+    def zone_for(self, pharmacy_id, latitude, longitude):
+        """Les zones arrivent dans l'ordre de priorité : la première qui contient le point l'emporte"""
+        for zone, inside in self.zone_cells.get(pharmacy_id, {}).get(_cell(latitude, longitude), ()):
+            if inside or zone.contains(latitude, longitude):
+                return zone
+        for zone in self.large_zones.get(pharmacy_id, ()):
+            if zone.contains(latitude, longitude):
+                return zone
+        return None
+
+    def quote(self, pharmacy, latitude=None, longitude=None):
+        quote = quote_defaults()
+        if latitude is None or longitude is None:
+            return quote
+        latitude, longitude = float(latitude), float(longitude)
+
+        zone = self.zone_for(pharmacy.id, latitude, longitude)
+        if zone is not None:
+            quote.update(delivery_fee=zone.fee, min_order_amount=zone.min_order_amount, zone=zone.name)
+            return quote
+
+        bands = self.bands.get(pharmacy.id) or self.bands.get(None)
+        if not bands or pharmacy.latitude is None or pharmacy.longitude is None:
+            return quote
+        distance = haversine_km(float(pharmacy.latitude), float(pharmacy.longitude), latitude, longitude)
+        quote['distance_km'] = round(distance, 2)
+        for max_distance, fee, min_order_amount in bands:
+            if distance <= max_distance:
+                quote.update(delivery_fee=fee, min_order_amount=min_order_amount)
+                return quote
+        quote.update(delivery_fee=None, deliverable=False)
+        return quote
+
+
+def quote_defaults():
+    """Tarif appliqué sans adresse de livraison, ou sans zone ni tranche configurée"""
+    return {
+        'delivery_fee': DEFAULT_DELIVERY_FEE,
+        'min_order_amount': DEFAULT_MIN_ORDER_AMOUNT,
+        'deliverable': True,
+        'zone': None,
+        'distance_km': None,
+    }
+
+
+def compile_table():
+    return PricingTable(
+        DeliveryZone.objects.filter(is_active=True).order_by('pharmacy_id', '-priority', 'id'),
+        DeliveryFeeBand.objects.all(),
+    )
+
+
+_lock = threading.Lock()
+_state = {}
+
+
+def table_version():
+    """Signature de la configuration : un ajout, une suppression ou une modification par l'ORM la change"""
+    zones = DeliveryZone.objects.aggregate(count=Count('id'), changed=Max('updated_at'))
+    bands = DeliveryFeeBand.objects.aggregate(count=Count('id'), changed=Max('updated_at'))
+    return zones['count'], zones['changed'], bands['count'], bands['changed']
+
+
+def current_table():
+    """Table compilée ; recompilée quand la signature en base change"""
+    now = time.monotonic()
+    if _state and now < _state['checked_at'] + VERSION_CHECK_INTERVAL:
+        return _state['table']
+    with _lock:
+        if _state and now < _state['checked_at'] + VERSION_CHECK_INTERVAL:
+            return _state['table']
+        version = table_version()
+        if not _state or _state['version'] != version:
+            _state['table'] = compile_table()
+            _state['version'] = version
+        _state['checked_at'] = now
+        return _state['table']
+
+
+def quote(pharmacy, latitude=None, longitude=None):
+    """Frais de livraison et minimum de commande pour livrer ce point depuis cette pharmacie"""
+    return current_table().quote(pharmacy, latitude, longitude)
+
+
+@receiver(post_save, sender=DeliveryZone)
+@receiver(post_delete, sender=DeliveryZone)
+@receiver(post_save, sender=DeliveryFeeBand)
+@receiver(post_delete, sender=DeliveryFeeBand)
+def invalidate_pricing(sender, **kwargs):
+    # Ce processus recompile sans attendre la vérification suivante ; après le
+    # commit, une recompilation plus tôt lirait encore l'ancienne configuration
+    transaction.on_commit(_forget_table)
+
+
+def _forget_table():
+    with _lock:
+        _state.clear()
@@ -0,0 +1,124 @@
+import math
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.response import Response
+
+
+# Par scope : {identité: (nombre de requêtes, fenêtre en secondes)}
+# Surchargeable via settings.RATE_LIMITS
+DEFAULT_RATES = {
+    'login': {'ip': (30, 60), 'email': (10, 300)},
+    'admin_otp_request': {'ip': (10, 300), 'email': (5, 300)},
+    'admin_otp_verify': {'ip': (20, 600), 'email': (5, 600)},
+}
+
+
+# ===========================
+# LIMITEUR DE DÉBIT (FENÊTRE GLISSANTE)
+# ===========================
+
+def _cache():
+    return caches[getattr(settings, 'RATE_LIMIT_CACHE', 'default')]
+
+
+def _rates(scope):
+    return getattr(settings, 'RATE_LIMITS', {}).get(scope, DEFAULT_RATES[scope])
+
+
+def client_ip(request):
+    """
+    Adresse du client. Derrière un proxy, RATE_LIMIT_NUM_PROXIES indique combien
+    d'adresses de fin de X-Forwarded-For ont été ajoutées par nos propres proxys.
+    """
+    num_proxies = getattr(settings, 'RATE_LIMIT_NUM_PROXIES', 0)
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    if num_proxies and forwarded:
+        addresses = [address.strip() for address in forwarded.split(',')]
+        return addresses[-min(num_proxies, len(addresses))]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def _window_keys(scope, identity, value, window, now):
+    current = int(now // window)
+    prefix = f'ratelimit:{scope}:{identity}:{value}'
+    return f'{prefix}:{current}', f'{prefix}:{current - 1}'
+
+
+def check_and_count(scope, identities, now=None):
+    """
+    Compteur à fenêtre glissante : le compte de la fenêtre précédente est pondéré
+    par la part qui chevauche encore la fenêtre courante.
+    Retourne None si la requête est acceptée (et comptée), sinon le délai d'attente en secondes.
+    """
+    now = time.time() if now is None else now
+    cache = _cache()
+    rates = _rates(scope)
+
+    windows = []
+    for identity, value in identities.items():
+        if not value or identity not in rates:
+            continue
+        limit, window = rates[identity]
+        windows.append((limit, window) + _window_keys(scope, identity, value, window, now))
+
+    counts = cache.get_many([previous for *_, previous in windows])
+    retry_after = 0
+    counted = []
+    for limit, window, current, previous in windows:
+        # Compter avant de décider : l'incrément est atomique, deux requêtes
+        # simultanées ne peuvent pas lire le même compte sous la limite.
+        # La clé doit survivre à la fenêtre suivante, où elle sert de fenêtre précédente
+        cache.add(current, 0, timeout=2 * window)
+        try:
+            count = cache.incr(current)
+        except ValueError:
+            cache.set(current, 1, timeout=2 * window)
+            count = 1
+        counted.append(current)
+        elapsed = (now % window) / window
+        # Requêtes déjà acceptées, sans celle-ci
+        estimated = counts.get(previous, 0) * (1 - elapsed) + count - 1
+        if estimated >= limit:
+            retry_after = max(retry_after, math.ceil(window * (1 - elapsed)))
+    if retry_after:
+        # Une requête refusée ne consomme pas le budget
+        for key in counted:
+            try:
+                cache.decr(key)
+            except ValueError:
+                pass
+        return retry_after
+    return None
+
+
+def rate_limit(scope):
+    """
+    Décorateur pour les vues d'authentification. À placer sous @api_view / @permission_classes.
+
+    Limite par adresse IP et par email (champ "email" du corps). La requête
+    refusée ne touche ni la base ni le hachage du mot de passe.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            email = request.data.get('email') if hasattr(request.data, 'get') else None
+            identities = {
+                'ip': client_ip(request),
+                'email': str(email).strip().lower() if email else None,
+            }
+            retry_after = check_and_count(scope, identities)
+            if retry_after:
+                response = Response({
+                    'success': False,
+                    'message': 'Too many attempts. Please try again later.',
+                    'retry_after': retry_after
+                }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+                response['Retry-After'] = str(retry_after)
+                return response
+            return view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
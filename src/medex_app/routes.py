@@ -0,0 +1,151 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+
+from .dispatch import haversine_km
+from .models import Order
+
+
+ROUTE_WINDOW_MINUTES = getattr(settings, 'DELIVERY_ROUTE_WINDOW_MINUTES', 30)
+ROUTE_MAX_STOPS = getattr(settings, 'DELIVERY_ROUTE_MAX_STOPS', 20)
+TWO_OPT_MAX_PASSES = 50
+
+
+# ===========================
+# TOURNÉES MULTI-ARRÊTS
+# ===========================
+#
+# Les commandes prêtes d'une même pharmacie, devenues prêtes dans une même
+# fenêtre de temps, forment une tournée. L'ordre des arrêts part du plus
+# proche voisin puis est amélioré par 2-opt (trajet ouvert : départ fixé à
+# la pharmacie, pas de retour). Les distances sont à vol d'oiseau.
+
+def _distance_matrix(points):
+    size = len(points)
+    matrix = [[0.0] * size for _ in range(size)]
+    for i in range(size):
+        for j in range(i + 1, size):
+            matrix[i][j] = matrix[j][i] = haversine_km(*points[i], *points[j])
+    return matrix
+
+
+def _nearest_neighbour(matrix):
+    path = [0]
+    remaining = set(range(1, len(matrix)))
+    while remaining:
+        row = matrix[path[-1]]
+        nearest = min(remaining, key=row.__getitem__)
+        remaining.remove(nearest)
+        path.append(nearest)
+    return path
+
+
+def _two_opt(path, matrix):
+    """Inverser les segments qui se croisent tant que le trajet raccourcit (le départ reste fixe)"""
+    last = len(path) - 1
+    for _ in range(TWO_OPT_MAX_PASSES):
+        improved = False
+        for i in range(1, last):
+            a, b = path[i - 1], path[i]
+            for j in range(i + 1, last + 1):
+                c = path[j]
+                d = path[j + 1] if j < last else None
+                delta = matrix[a][c] - matrix[a][b]
+                if d is not None:
+                    delta += matrix[b][d] - matrix[c][d]
+                if delta < -1e-9:
+                    path[i:j + 1] = reversed(path[i:j + 1])
+                    b = path[i]
+                    improved = True
+        if not improved:
+            break
+    return path
+
+
+def path_length(path, matrix):
+    return sum(matrix[path[k]][path[k + 1]] for k in range(len(path) - 1))
+
+
+def plan_route(origin, stops):
+    """
+    origin : (latitude, longitude) ; stops : liste de (clé, latitude, longitude).
+    Retourne (arrêts ordonnés [(clé, latitude, longitude, distance du tronçon)], distance totale km).
+    """
+    points = [tuple(map(float, origin))] + [(float(lat), float(lng)) for _, lat, lng in stops]
+    matrix = _distance_matrix(points)
+    path = _two_opt(_nearest_neighbour(matrix), matrix)
+
+    ordered = []
+    for previous, current in zip(path, path[1:]):
+        key, latitude, longitude = stops[current - 1]
+        ordered.append((key, float(latitude), float(longitude), matrix[previous][current]))
+    return ordered, path_length(path, matrix)
+
+
+def _time_windows(orders, window):
+    """Découper des commandes triées par date en groupes de durée <= window et de taille <= ROUTE_MAX_STOPS"""
+    group = []
+    for order in orders:
+        if group and (order.updated_at - group[0].updated_at > window or len(group) >= ROUTE_MAX_STOPS):
+            yield group
+            group = []
+        group.append(order)
+    if group:
+        yield group
+
+
+def ready_order_batches(pharmacy_ids=None, window_minutes=ROUTE_WINDOW_MINUTES):
+    """
+    Tournées proposées pour les commandes prêtes à être récupérées.
+    La date de passage au statut "ready_for_pickup" est approchée par updated_at.
+    """
+    queryset = Order.objects.filter(
+        status='ready_for_pickup',
+        delivery_latitude__isnull=False,
+        delivery_longitude__isnull=False,
+        pharmacy__latitude__isnull=False,
+        pharmacy__longitude__isnull=False,
+    ).select_related('pharmacy').only(
+        'id', 'order_number', 'delivery_address', 'delivery_latitude', 'delivery_longitude',
+        'updated_at', 'pharmacy__id', 'pharmacy__name', 'pharmacy__latitude', 'pharmacy__longitude',
+    ).order_by('pharmacy_id', 'updated_at')
+    if pharmacy_ids is not None:
+        queryset = queryset.filter(pharmacy_id__in=pharmacy_ids)
+
+    by_pharmacy = defaultdict(list)
+    for order in queryset:
+        by_pharmacy[order.pharmacy_id].append(order)
+
+    window = timedelta(minutes=window_minutes)
+    batches = []
+    for orders in by_pharmacy.values():
+        pharmacy = orders[0].pharmacy
+        for group in _time_windows(orders, window):
+            stops, total_km = plan_route(
+                (pharmacy.latitude, pharmacy.longitude),
+                [(order, order.delivery_latitude, order.delivery_longitude) for order in group],
+            )
+            batches.append({
+                'pharmacy': {
+                    'id': pharmacy.id,
+                    'name': pharmacy.name,
+                    'latitude': float(pharmacy.latitude),
+                    'longitude': float(pharmacy.longitude),
+                },
+                'window_start': group[0].updated_at,
+                'window_end': group[-1].updated_at,
+                'total_distance_km': round(total_km, 2),
+                'stops': [
+                    {
+                        'order_id': order.id,
+                        'order_number': order.order_number,
+                        'address': order.delivery_address,
+                        'latitude': latitude,
+                        'longitude': longitude,
+                        'leg_distance_km': round(leg_km, 2),
+                    }
+                    for order, latitude, longitude, leg_km in stops
+                ],
+            })
+    return batches
@@ -1,7 +1,9 @@
 from rest_framework import serializers
+from .images import variant_url
+from .media_store import image_entries
 from .models import (
     Medicine, Category, SubCategory, Pharmacy, 
-    Cart, CartItem, AppUser, Delivery
+    Cart, CartItem, AppUser, Delivery, Order, OrderItem, Payment
 )
 
 
@@ -63,6 +65,9 @@ class MedicineSerializer(serializers.ModelSerializer):
     
     is_in_stock = serializers.SerializerMethodField()
     is_visible = serializers.SerializerMethodField()
+    image = serializers.SerializerMethodField()
+    image_detail = serializers.SerializerMethodField()
+    image_variants = serializers.JSONField(source='image', read_only=True)
     
     class Meta:
         model = Medicine
@@ -95,6 +100,8 @@ class MedicineSerializer(serializers.ModelSerializer):
             'is_in_stock',
             'is_visible',
             'image',
+            'image_detail',
+            'image_variants',
             'views_count',
             'sales_count',
             'created_at',
@@ -105,6 +112,13 @@ class MedicineSerializer(serializers.ModelSerializer):
     
     def get_is_visible(self, obj):
         return obj.is_visible_on_platform()
+    
+    def get_image(self, obj):
+        """Images au format carte (WebP) pour les grilles produits"""
+        return [variant_url(entry, 'card') for entry in image_entries(obj.image)]
+    
+    def get_image_detail(self, obj):
+        return [variant_url(entry, 'detail') for entry in image_entries(obj.image)]
 
 
 class CartItemSerializer(serializers.ModelSerializer):
@@ -136,9 +150,9 @@ class CartItemSerializer(serializers.ModelSerializer):
         return obj.subtotal()
     
     def get_product_image(self, obj):
-        if obj.medicine and obj.medicine.image:
-            if isinstance(obj.medicine.image, list) and len(obj.medicine.image) > 0:
-                return obj.medicine.image[0]
+        entries = image_entries(obj.medicine.image) if obj.medicine else []
+        if entries:
+            return variant_url(entries[0], 'thumbnail')
         return None
 
 
@@ -221,9 +235,97 @@ class AppUserSerializer(serializers.ModelSerializer):
         return value
 
 
+# Orders
+class OrderItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = OrderItem
+        fields = [
+            'id',
+            'medicine',
+            'medicine_name',
+            'quantity',
+            'unit_price',
+            'subtotal',
+            'is_package',
+            'package_details'
+        ]
+
+
+class OrderPaymentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Payment
+        fields = ['payment_method', 'payment_status', 'amount', 'transaction_id', 'payment_date']
+
+
+class OrderDeliverySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Delivery
+        fields = [
+            'delivery_status',
+            'tracking_number',
+            'estimated_delivery_time',
+            'delivery_date',
+            'current_latitude',
+            'current_longitude'
+        ]
+
+
+class OrderSerializer(serializers.ModelSerializer):
+    """Commande avec articles, paiement et livraison (à utiliser avec select_related/prefetch_related)"""
+    items = OrderItemSerializer(many=True, read_only=True)
+    pharmacy_name = serializers.CharField(source='pharmacy.name', read_only=True)
+    payment = serializers.SerializerMethodField()
+    delivery = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Order
+        fields = [
+            'id',
+            'order_number',
+            'order_date',
+            'status',
+            'pharmacy',
+            'pharmacy_name',
+            'total_amount',
+            'delivery_fee',
+            'discount_amount',
+            'final_amount',
+            'delivery_address',
+            'delivery_phone',
+            'delivery_latitude',
+            'delivery_longitude',
+            'customer_notes',
+            'pharmacy_notes',
+            'items',
+            'payment',
+            'delivery',
+            'completed_at'
+        ]
+
+    def get_payment(self, obj):
+        try:
+            return OrderPaymentSerializer(obj.payment).data
+        except Payment.DoesNotExist:
+            return None
+
+    def get_delivery(self, obj):
+        try:
+            return OrderDeliverySerializer(obj.delivery).data
+        except Delivery.DoesNotExist:
+            return None
+
+
 # Delivery Person
 class DeliveryDashboardOrderSerializer(serializers.ModelSerializer):
+    """
+    Ligne compacte du tableau de bord livreur. À utiliser avec
+    select_related('order__user') : aucune requête par ligne.
+    """
+    id = serializers.IntegerField(source="order_id")
+    delivery_id = serializers.IntegerField(source="id")
+    order_number = serializers.CharField(source="order.order_number")
     customer_name = serializers.SerializerMethodField()
+    phone = serializers.CharField(source="order.delivery_phone")
     address = serializers.CharField(source="order.delivery_address")
     total_price = serializers.DecimalField(
         source="order.final_amount", max_digits=10, decimal_places=2
@@ -234,21 +336,28 @@ class DeliveryDashboardOrderSerializer(serializers.ModelSerializer):
         model = Delivery
         fields = [
             "id",
-            "order",
+            "delivery_id",
+            "order_number",
             "customer_name",
+            "phone",
             "address",
             "total_price",
             "status",
             "tracking_number",
-            "delivery_status",
-            "current_latitude",
-            "current_longitude",
+            "estimated_delivery_time",
         ]
 
     def get_customer_name(self, obj):
         user = obj.order.user
-        return f"{user.first_name} {user.last_name}"
+        return f"{user.first_name} {user.last_name}".strip()
+
 
 class GPSUpdateSerializer(serializers.Serializer):
-    latitude = serializers.DecimalField(max_digits=10, decimal_places=6)
-    longitude = serializers.DecimalField(max_digits=10, decimal_places=6)
\ No newline at end of file
+    latitude = serializers.DecimalField(max_digits=10, decimal_places=6, min_value=-90, max_value=90)
+    longitude = serializers.DecimalField(max_digits=10, decimal_places=6, min_value=-180, max_value=180)
+    recorded_at = serializers.DateTimeField(required=False)
+
+
+class GPSBatchSerializer(serializers.Serializer):
+    """Positions envoyées par lot par l'application livreur"""
+    points = GPSUpdateSerializer(many=True, allow_empty=False, max_length=500)
@@ -1,3 +1,2026 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import itertools
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import pyotp
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core import mail
+from django.core.management import call_command
+from django.core.management.base import SystemCheckError
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.db import connection, connections, transaction
+from django.test import Client, TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+
+from .authentication import CachedTokenAuthentication, IdentityContext, TokenCache, token_cache, user_generation
+from .checks import check_shared_cache
+from .dispatch import CourierIndex, assign_pending, haversine_km, match
+from .eta import build_grid, current_grid, estimate_arrival
+from .models import (
+    AppUser, CartItem, IdempotencyKey, Medicine, Pharmacy, Order, Delivery, DeliveryTrail,
+    DeliveryFeeBand, DeliveryZone, OrderItem, OrderStatusCounter, OrderStatusEvent, OutboundEmail,
+    MediaBlob, OTPVerification, Prescription, PrescriptionUpload,
+)
+from .order_numbers import OrderNumberAllocator, allocator, format_order_number
+from .images import derivative_paths
+from .order_state import transition
+from .outbox import send_pending
+from .ratelimit import check_and_count
+from .routes import _distance_matrix, _nearest_neighbour, path_length, plan_route
+from .serializers import MedicineSerializer
+from . import dashboard_stats, live_tracking, media_store, pricing, tracking, trails
+
+
+def _create_orders(user_id, pharmacy_id, count, queue):
+    """Créer des commandes depuis un processus enfant"""
+    connections.close_all()
+    numbers = []
+    for _ in range(count):
+        order = Order.objects.create(
+            user_id=user_id,
+            pharmacy_id=pharmacy_id,
+            total_amount=1000,
+            final_amount=1000
+        )
+        numbers.append(order.order_number)
+    connections.close_all()
+    queue.put(numbers)
+
+
+@async_to_sync
+async def _read_stream(response):
+    """Lire un flux SSE (vue async) depuis un test synchrone"""
+    return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+
+class IdempotencyKeyTests(TestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        self.user = AppUser.objects.create_user(
+            username='idem@medex.test', email='idem@medex.test', password='secret123'
+        )
+        owner = AppUser.objects.create_user(
+            username='idem-owner@medex.test', email='idem-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        pharmacy = Pharmacy.objects.create(name='Idem', address='Douala', owner=owner)
+        self.medicine = Medicine.objects.create(
+            name='Doliprane', price=1000, pharmacy=pharmacy, stock_quantity=50, is_approved=True
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _add(self, quantity, key='retry-1'):
+        return self.client.post('/api/cart/add', {
+            'medicine_id': self.medicine.id, 'quantity': quantity
+        }, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_stored_response(self):
+        first = self._add(2)
+        self.assertEqual(first.status_code, 201)
+        for _ in range(2):
+            retry = self._add(2)
+            self.assertEqual(retry.status_code, first.status_code)
+            self.assertEqual(retry['Idempotent-Replayed'], 'true')
+            self.assertEqual(retry.data, first.data)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+        # Une autre clé est une autre requête
+        self._add(2, key='retry-2')
+        self.assertEqual(CartItem.objects.get().quantity, 4)
+
+    def test_key_reused_for_another_payload_is_rejected(self):
+        self._add(2)
+        response = self._add(3)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+    def test_key_in_flight_returns_conflict(self):
+        self._add(2)
+        # Même requête dont la première exécution n'a pas encore enregistré sa réponse
+        IdempotencyKey.objects.update(status_code=None, response_body=None)
+        response = self._add(2)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+    def test_expired_key_is_reused(self):
+        self._add(2)
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        response = self._add(3)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(CartItem.objects.get().quantity, 5)
+
+
+class OrderNumberAllocatorTests(TestCase):
+
+    def test_numbers_are_monotonic_and_formatted(self):
+        local = OrderNumberAllocator(sequence_name='test', block_size=3)
+        values = [local.allocate() for _ in range(10)]
+        self.assertEqual(values, sorted(values))
+        self.assertEqual(len(set(values)), 10)
+
+        self.assertEqual(format_order_number(123), 'ORD-000000123')
+        owner = AppUser.objects.create_user(
+            username='format@medex.test', email='format@medex.test', password='secret123'
+        )
+        pharmacy = Pharmacy.objects.create(name='Format', address='Douala', owner=owner)
+        order = Order.objects.create(user=owner, pharmacy=pharmacy, total_amount=1000, final_amount=1000)
+        self.assertRegex(order.order_number, r'^ORD-\d{9}$')
+
+    def test_blocks_do_not_overlap(self):
+        first = OrderNumberAllocator(sequence_name='test', block_size=5)
+        second = OrderNumberAllocator(sequence_name='test', block_size=5)
+        values = [first.allocate(), second.allocate(), first.allocate(), second.allocate()]
+        self.assertEqual(len(set(values)), 4)
+
+    def test_rolled_back_order_does_not_leak_its_block(self):
+        first = OrderNumberAllocator(sequence_name='test', block_size=5)
+        second = OrderNumberAllocator(sequence_name='test', block_size=5)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                first.allocate()
+                raise RuntimeError('order save failed')
+        values = [second.allocate(), first.allocate(), second.allocate(), first.allocate()]
+        self.assertEqual(len(set(values)), 4)
+
+
+class OrderNumberConcurrencyTests(TransactionTestCase):
+
+    PROCESSES = 4
+    ORDERS_PER_PROCESS = 25
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            raise unittest.SkipTest('Multi-process test requires a shared test database.')
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise unittest.SkipTest('Multi-process test requires fork().')
+        allocator.reset()
+        owner = AppUser.objects.create_user(
+            username='owner@medex.test', email='owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        self.client_user = AppUser.objects.create_user(
+            username='client@medex.test', email='client@medex.test', password='secret123'
+        )
+        self.pharmacy = Pharmacy.objects.create(name='Test', address='Douala', owner=owner)
+
+    def test_orders_from_multiple_processes_get_unique_numbers(self):
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        connections.close_all()
+        workers = [
+            context.Process(
+                target=_create_orders,
+                args=(self.client_user.id, self.pharmacy.id, self.ORDERS_PER_PROCESS, queue)
+            )
+            for _ in range(self.PROCESSES)
+        ]
+        for worker in workers:
+            worker.start()
+        results = [queue.get(timeout=60) for _ in workers]
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+
+        all_numbers = [number for numbers in results for number in numbers]
+        self.assertEqual(len(all_numbers), self.PROCESSES * self.ORDERS_PER_PROCESS)
+        self.assertEqual(len(set(all_numbers)), len(all_numbers))
+        for numbers in results:
+            self.assertEqual(numbers, sorted(numbers))
+        self.assertEqual(Order.objects.count(), len(all_numbers))
+
+
+class OrderHistoryQueryTests(TestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        self.customer = AppUser.objects.create_user(
+            username='history@medex.test', email='history@medex.test', password='secret123'
+        )
+        self.owner = AppUser.objects.create_user(
+            username='history-owner@medex.test', email='history-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        self.pharmacy = Pharmacy.objects.create(name='History', address='Douala', owner=self.owner)
+        self.client = APIClient()
+
+    def _create_orders(self, count):
+        for _ in range(count):
+            order = Order.objects.create(
+                user=self.customer, pharmacy=self.pharmacy, total_amount=1000, final_amount=1000
+            )
+            for index in range(2):
+                OrderItem.objects.create(
+                    order=order, medicine_name=f'Item {index}', quantity=1, unit_price=500, subtotal=500
+                )
+            Delivery.objects.create(order=order)
+
+    def _assert_constant_queries(self, user, url, expected):
+        self.client.force_authenticate(user)
+        self._create_orders(3)
+        with self.assertNumQueries(expected):
+            response = self.client.get(url, {'limit': 20})
+        self.assertEqual(len(response.data['orders']), 3)
+
+        self._create_orders(17)
+        with self.assertNumQueries(expected):
+            response = self.client.get(url, {'limit': 20})
+        self.assertEqual(len(response.data['orders']), 20)
+        self.assertEqual(response.data['status_counts']['pending'], 20)
+
+    def test_customer_history_query_count_is_constant(self):
+        # commandes (+ pharmacie, paiement, livraison), articles, compteurs
+        self._assert_constant_queries(self.customer, '/api/orders', 3)
+
+    def test_pharmacy_history_query_count_is_constant(self):
+        # + la pharmacie du pharmacien connecté
+        self._assert_constant_queries(self.owner, '/api/pharmacy/orders', 4)
+
+    def test_status_change_updates_counters_without_counting(self):
+        self._create_orders(10)
+        orders = list(Order.objects.order_by('id'))
+        for order in orders:
+            order.status = 'confirmed'
+            if order is orders[0]:
+                # Première commande confirmée : les compteurs "confirmed" sont créés
+                order.save()
+                continue
+            # Ensuite : savepoint, UPDATE de la commande, -1 / +1 pour le client et la pharmacie
+            with self.assertNumQueries(7):
+                order.save()
+        self.assertEqual(OrderStatusCounter.counts_for('user', self.customer.id)['pending'], 0)
+        self.assertEqual(OrderStatusCounter.counts_for('pharmacy', self.pharmacy.id)['confirmed'], 10)
+
+
+class OrderStatusFeedTests(TestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        customer = AppUser.objects.create_user(
+            username='feed@medex.test', email='feed@medex.test', password='secret123'
+        )
+        self.owner = AppUser.objects.create_user(
+            username='feed-owner@medex.test', email='feed-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        self.pharmacy = Pharmacy.objects.create(name='Feed', address='Douala', owner=self.owner)
+        self.order = Order.objects.create(
+            user=customer, pharmacy=self.pharmacy, total_amount=1000, final_amount=1000
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def _ticket(self):
+        response = self.client.post('/api/stream-ticket')
+        self.assertEqual(response.status_code, 200)
+        return response.data['ticket']
+
+    def test_transitions_follow_state_machine_and_are_logged(self):
+        url = f'/api/pharmacy/orders/{self.order.id}/status'
+        response = self.client.post(url, {'status': 'validated', 'note': 'OK'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['allowed_statuses'], ['cancelled', 'preparing'])
+
+        response = self.client.post(url, {'status': 'delivered'}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['allowed_statuses'], ['cancelled', 'preparing'])
+
+        response = self.client.post(url, {'status': 'cancelled'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'cancelled')
+        self.assertIsNotNone(self.order.completed_at)
+
+        events = list(OrderStatusEvent.objects.filter(order=self.order).order_by('id').values_list(
+            'from_status', 'to_status', 'changed_by_id'
+        ))
+        self.assertEqual(events, [
+            (None, 'pending', None),
+            ('pending', 'validated', self.owner.id),
+            ('validated', 'cancelled', self.owner.id),
+        ])
+
+        other = AppUser.objects.create_user(
+            username='feed-other@medex.test', email='feed-other@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        self.client.force_authenticate(other)
+        response = self.client.post(url, {'status': 'validated'}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_feed_accepts_a_stream_ticket_but_not_an_api_token(self):
+        transition(self.order, 'validated', changed_by=self.owner)
+        ticket = self._ticket()
+
+        response = Client().get('/api/pharmacy/orders/events', {'ticket': ticket, 'after': 0, 'timeout': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([event['to_status'] for event in response.json()['events']], ['pending', 'validated'])
+
+        token = Token.objects.create(user=self.owner)
+        response = Client().get('/api/pharmacy/orders/events', {'token': token.key, 'timeout': 0})
+        self.assertEqual(response.status_code, 401)
+        response = Client().get('/api/pharmacy/orders/events', {'ticket': ticket + 'x', 'timeout': 0})
+        self.assertEqual(response.status_code, 401)
+        with mock.patch('medex_app.authentication.STREAM_TICKET_MAX_AGE', -1):
+            response = Client().get('/api/pharmacy/orders/events', {'ticket': ticket, 'timeout': 0})
+        self.assertEqual(response.status_code, 401)
+
+    def test_stream_resumes_after_last_event_id(self):
+        first = OrderStatusEvent.objects.get(order=self.order)
+        transition(self.order, 'validated', changed_by=self.owner)
+        with mock.patch.multiple('medex_app.order_views', FEED_MAX_STREAM_SECONDS=0.2, FEED_POLL_INTERVAL=0.05):
+            response = Client().get(
+                '/api/pharmacy/orders/stream', {'ticket': self._ticket()}, HTTP_LAST_EVENT_ID=str(first.id)
+            )
+            body = _read_stream(response)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(body.count('event: order'), 1)
+        self.assertIn('"to_status": "validated"', body)
+
+
+class TemporaryMediaMixin:
+
+    def use_temporary_media_root(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        return media_root
+
+
+class PrescriptionUploadTests(TemporaryMediaMixin, TestCase):
+
+    CHUNK = 1000
+
+    def setUp(self):
+        self.use_temporary_media_root()
+        self.customer = AppUser.objects.create_user(
+            username='rx@medex.test', email='rx@medex.test', password='secret123'
+        )
+        owner = AppUser.objects.create_user(
+            username='rx-owner@medex.test', email='rx-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        pharmacy = Pharmacy.objects.create(name='Rx', address='Douala', owner=owner)
+        self.order = Order.objects.create(
+            user=self.customer, pharmacy=pharmacy, total_amount=1000, final_amount=1000
+        )
+        self.data = bytes(random.Random(30).getrandbits(8) for _ in range(2500))
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def _start(self, checksum=None):
+        response = self.client.post(f'/api/orders/{self.order.id}/prescription/uploads', {
+            'filename': 'ordonnance.jpg',
+            'total_size': len(self.data),
+            'checksum': checksum or hashlib.sha256(self.data).hexdigest(),
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data['upload']['upload_id']
+
+    def _put(self, upload_id, offset, chunk=None, checksum=None):
+        chunk = self.data[offset:offset + self.CHUNK] if chunk is None else chunk
+        return self.client.generic(
+            'PUT', f'/api/prescription/uploads/{upload_id}/chunk', chunk,
+            content_type='application/octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset),
+            HTTP_UPLOAD_CHECKSUM=checksum or hashlib.sha256(chunk).hexdigest(),
+        )
+
+    def _status(self, upload_id):
+        return self.client.get(f'/api/prescription/uploads/{upload_id}').data['upload']
+
+    def test_interrupted_upload_resumes_and_is_assembled(self):
+        upload_id = self._start()
+        self.assertEqual(self._put(upload_id, 0).data['offset'], 1000)
+        self.assertEqual(self._put(upload_id, 1000).data['offset'], 2000)
+
+        # Connexion coupée : le client redemande l'offset puis reprend
+        offset = self._status(upload_id)['offset']
+        self.assertEqual(offset, 2000)
+        response = self.client.post(f'/api/prescription/uploads/{upload_id}/complete')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['offset'], 2000)
+
+        self.assertEqual(self._put(upload_id, offset).data['offset'], len(self.data))
+        response = self.client.post(f'/api/prescription/uploads/{upload_id}/complete')
+        self.assertEqual(response.status_code, 201)
+
+        prescription = Prescription.objects.get(order=self.order)
+        with prescription.file_path.open('rb') as saved:
+            self.assertEqual(saved.read(), self.data)
+        self.assertEqual(self._status(upload_id)['status'], 'completed')
+        upload = PrescriptionUpload.objects.get(id=upload_id)
+        self.assertFalse(default_storage.exists(upload.part_name(0)))
+
+    def test_offset_mismatch_returns_expected_offset(self):
+        upload_id = self._start()
+        self._put(upload_id, 0)
+        # Morceau renvoyé deux fois, puis morceau en avance
+        for offset in (0, 2000):
+            response = self._put(upload_id, offset)
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.data['offset'], 1000)
+        self.assertEqual(self._status(upload_id)['offset'], 1000)
+
+    def test_corrupted_chunk_is_rejected(self):
+        upload_id = self._start()
+        response = self._put(upload_id, 0, checksum=hashlib.sha256(b'other').hexdigest())
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._status(upload_id)['offset'], 0)
+
+    def test_file_checksum_mismatch_aborts_upload(self):
+        upload_id = self._start(checksum=hashlib.sha256(b'another file').hexdigest())
+        for offset in range(0, len(self.data), self.CHUNK):
+            self.assertEqual(self._put(upload_id, offset).status_code, 200)
+        response = self.client.post(f'/api/prescription/uploads/{upload_id}/complete')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._status(upload_id)['status'], 'aborted')
+        self.assertFalse(Prescription.objects.exists())
+        self.assertEqual(self._put(upload_id, 0).status_code, 410)
+
+    def _upload_all(self):
+        upload_id = self._start()
+        for offset in range(0, len(self.data), self.CHUNK):
+            self.assertEqual(self._put(upload_id, offset).status_code, 200)
+        return upload_id
+
+    def test_expired_upload_cannot_be_completed(self):
+        upload_id = self._upload_all()
+        PrescriptionUpload.objects.filter(id=upload_id).update(expires_at=timezone.now() - timedelta(minutes=1))
+        response = self.client.post(f'/api/prescription/uploads/{upload_id}/complete')
+        self.assertEqual(response.status_code, 410)
+        self.assertFalse(Prescription.objects.exists())
+
+    def test_new_upload_replaces_the_previous_file(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/prescription/uploads/{self._upload_all()}/complete')
+        previous = Prescription.objects.get(order=self.order).file_path.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/prescription/uploads/{self._upload_all()}/complete')
+        self.assertEqual(response.status_code, 201)
+        current = Prescription.objects.get(order=self.order).file_path.name
+        self.assertNotEqual(current, previous)
+        self.assertTrue(default_storage.exists(current))
+        self.assertFalse(default_storage.exists(previous))
+
+    def test_other_users_cannot_touch_the_upload(self):
+        upload_id = self._start()
+        intruder = AppUser.objects.create_user(
+            username='rx-intruder@medex.test', email='rx-intruder@medex.test', password='secret123'
+        )
+        self.client.force_authenticate(intruder)
+        self.assertEqual(self._put(upload_id, 0).status_code, 404)
+        self.assertEqual(self.client.get(f'/api/prescription/uploads/{upload_id}').status_code, 404)
+
+
+class ContentAddressedMediaTests(TemporaryMediaMixin, TestCase):
+
+    def setUp(self):
+        self.use_temporary_media_root()
+
+    def _upload(self, content=b'same bytes', name='photo.jpg'):
+        return SimpleUploadedFile(name, content, content_type='image/jpeg')
+
+    def test_identical_uploads_share_one_file(self):
+        first = media_store.store(self._upload(name='a.jpg'))
+        second = media_store.store(self._upload(name='b.jpeg'))
+        other = media_store.store(self._upload(b'other bytes'))
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertEqual(MediaBlob.objects.get(path=first).ref_count, 2)
+        self.assertEqual(len(default_storage.listdir(os.path.dirname(first))[1]), 1)
+
+    def test_file_is_deleted_with_its_last_reference(self):
+        path = media_store.store(self._upload())
+        media_store.store(self._upload())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertFalse(media_store.release(path))
+        self.assertTrue(default_storage.exists(path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(media_store.release(path))
+        self.assertFalse(default_storage.exists(path))
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertFalse(media_store.release(path))
+
+    def test_store_during_pending_delete_keeps_the_file(self):
+        path = media_store.store(self._upload())
+        with self.captureOnCommitCallbacks(execute=True):
+            media_store.release(path)
+            # Même contenu ré-uploadé avant la suppression des fichiers
+            self.assertEqual(media_store.store(self._upload()), path)
+        self.assertTrue(default_storage.exists(path))
+        self.assertEqual(MediaBlob.objects.get(path=path).ref_count, 1)
+
+    def test_store_after_concurrent_delete_rewrites_the_file(self):
+        path = media_store.store(self._upload())
+        # _write a vu le fichier présent (rien écrit) juste avant que la libération ne le supprime
+        stale_write = media_store._write(self._upload())
+        self.assertFalse(stale_write[3])
+        with self.captureOnCommitCallbacks(execute=True):
+            media_store.release(path)
+        self.assertFalse(default_storage.exists(path))
+
+        with mock.patch.object(media_store, '_write', return_value=stale_write):
+            self.assertEqual(media_store.store(self._upload()), path)
+        with default_storage.open(path, 'rb') as saved:
+            self.assertEqual(saved.read(), b'same bytes')
+
+    def test_pharmacy_logo_reference_is_released(self):
+        owner = AppUser.objects.create_user(
+            username='logo@medex.test', email='logo@medex.test', password='secret123', role='pharmacist'
+        )
+        pharmacy = Pharmacy.objects.create(name='Logo', address='Douala', owner=owner)
+        pharmacy.logo.name = media_store.store(self._upload(b'logo v1'))
+        pharmacy.save(update_fields=['logo'])
+        first_logo = pharmacy.logo.name
+
+        pharmacy = Pharmacy.objects.get(id=pharmacy.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            pharmacy.logo.name = media_store.store(self._upload(b'logo v2'))
+            pharmacy.save()
+        self.assertFalse(default_storage.exists(first_logo))
+
+        second_logo = pharmacy.logo.name
+        with self.captureOnCommitCallbacks(execute=True):
+            Pharmacy.objects.get(id=pharmacy.id).delete()
+        self.assertFalse(default_storage.exists(second_logo))
+        self.assertFalse(MediaBlob.objects.exists())
+
+
+class ProductImageUploadTests(TemporaryMediaMixin, TestCase):
+
+    def setUp(self):
+        self.media_root = self.use_temporary_media_root()
+        token_cache.clear()
+        owner = AppUser.objects.create_user(
+            username='images@medex.test', email='images@medex.test', password='secret123', role='pharmacist'
+        )
+        Pharmacy.objects.create(name='Images', address='Douala', owner=owner)
+        self.client = APIClient()
+        self.client.force_authenticate(owner)
+
+    def _images(self, count=4):
+        return [
+            SimpleUploadedFile(f'image{index}.jpg', f'image {index}'.encode() * 1000, content_type='image/jpeg')
+            for index in range(count)
+        ]
+
+    def _stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media_root)
+            for root, _, names in os.walk(self.media_root) for name in names
+        )
+
+    def _add(self, images):
+        return self.client.post('/api/pharmacy/products/add', {
+            'name': 'Paracétamol', 'price': '1500', 'images': images
+        }, format='multipart')
+
+    def test_images_keep_the_client_order(self):
+        images = self._images()
+        expected = [
+            media_store.content_path(hashlib.sha256(f'image {index}'.encode() * 1000).hexdigest(), 'image.jpg')
+            for index in range(len(images))
+        ]
+        response = self._add(images)
+        self.assertEqual(response.status_code, 201)
+        product = Medicine.objects.get()
+        self.assertEqual([entry['path'] for entry in product.image], expected)
+        self.assertEqual(self._stored_files(), sorted(expected))
+
+    def test_failure_after_upload_leaves_no_files(self):
+        # Échec après l'écriture des fichiers et la sauvegarde du produit ;
+        # la vue affiche la trace de l'erreur : la garder hors de la sortie des tests
+        with mock.patch('medex_app.views.schedule_derivatives', side_effect=RuntimeError('pool unavailable')), \
+                redirect_stdout(io.StringIO()):
+            response = self._add(self._images())
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(Medicine.objects.exists())
+        self.assertFalse(MediaBlob.objects.exists())
+        self.assertEqual(self._stored_files(), [])
+
+    def test_failed_write_discards_the_other_images(self):
+        real_write = media_store._write
+
+        def write(file):
+            if file.name == 'image2.jpg':
+                raise OSError('disk full')
+            return real_write(file)
+
+        with mock.patch.object(media_store, '_write', side_effect=write), redirect_stdout(io.StringIO()):
+            response = self._add(self._images())
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(Medicine.objects.exists())
+        self.assertEqual(self._stored_files(), [])
+
+    def test_update_failure_keeps_previous_images(self):
+        self._add(self._images(2))
+        product = Medicine.objects.get()
+        previous = self._stored_files()
+
+        with mock.patch.object(Medicine, 'save', side_effect=RuntimeError('database unavailable')), \
+                redirect_stdout(io.StringIO()):
+            response = self.client.put(
+                f'/api/pharmacy/products/{product.id}/update', {'images': self._images(4)[2:]}, format='multipart'
+            )
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self._stored_files(), previous)
+        self.assertEqual(MediaBlob.objects.count(), 2)
+
+    def test_legacy_single_string_image(self):
+        # Anciennes lignes (databackup.json) : une chaîne seule, chemin relatif
+        default_storage.save('meds/paracetamol__AB.jpeg', io.BytesIO(b'legacy'))
+        product = Medicine.objects.create(
+            pharmacy=Pharmacy.objects.get(), name='Paracétamol', price=1500, image='meds/paracetamol__AB.jpeg'
+        )
+        self.assertEqual(MedicineSerializer(product).data['image'], ['meds/paracetamol__AB.jpeg'])
+
+        response = self.client.put(
+            f'/api/pharmacy/products/{product.id}/update', {'images': self._images(1)}, format='multipart'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(default_storage.exists('meds/paracetamol__AB.jpeg'))
+
+        self.assertEqual(
+            media_store.storage_key(f'http://testserver{settings.MEDIA_URL}products/a.jpg', f'http://testserver{settings.MEDIA_URL}'),
+            'products/a.jpg'
+        )
+        self.assertEqual(media_store.storage_key(f'{settings.MEDIA_URL}products/a.jpg'), 'products/a.jpg')
+        self.assertIsNone(media_store.storage_key('https://cdn.example.com/a.jpg'))
+
+
+class PurgeOrphanMediaTests(TemporaryMediaMixin, TestCase):
+
+    def setUp(self):
+        self.media_root = self.use_temporary_media_root()
+        owner = AppUser.objects.create_user(
+            username='purge@medex.test', email='purge@medex.test', password='secret123', role='pharmacist'
+        )
+        self.pharmacy = Pharmacy.objects.create(name='Purge', address='Douala', owner=owner)
+        order = Order.objects.create(user=owner, pharmacy=self.pharmacy, total_amount=1000, final_amount=1000)
+
+        blob_path = media_store.store(SimpleUploadedFile('photo.jpg', b'shared image'))
+        self.kept = [
+            blob_path,
+            self._file(derivative_paths(blob_path)[0]),
+            self._file('pharmacy_logos/logo.png'),
+            self._file('prescriptions/rx.pdf'),
+            self._file('products/legacy.jpg'),
+            self._file('meds/paracetamol__AB.jpeg'),
+        ]
+        self.pharmacy.logo.name = 'pharmacy_logos/logo.png'
+        self.pharmacy.save(update_fields=['logo'])
+        Prescription.objects.create(order=order, file_path='prescriptions/rx.pdf')
+        Medicine.objects.create(
+            name='Legacy', price=1000, pharmacy=self.pharmacy,
+            image=[f'http://testserver{settings.MEDIA_URL}products/legacy.jpg']
+        )
+        # Format de databackup.json : une chaîne seule, chemin relatif
+        Medicine.objects.create(
+            name='Paracétamol', price=500, pharmacy=self.pharmacy, image='meds/paracetamol__AB.jpeg'
+        )
+        self.orphans = [
+            self._file(f"cas/{'0' * 2}/{'0' * 64}.jpg"),
+            self._file('prescriptions/old.pdf'),
+            self._file('products/deleted.jpg'),
+        ]
+        self.recent_orphan = self._file('products/just-uploaded.jpg', age_hours=1)
+        self._age(blob_path, 48)
+
+    def _file(self, key, age_hours=48):
+        path = os.path.join(self.media_root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as output:
+            output.write(b'x')
+        self._age(key, age_hours)
+        return key
+
+    def _age(self, key, hours):
+        moment = time.time() - hours * 3600
+        os.utime(os.path.join(self.media_root, key), (moment, moment))
+
+    def _purge(self, *args):
+        out = io.StringIO()
+        call_command('purge_orphan_media', '--batch-size', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def test_dry_run_lists_orphans_without_deleting(self):
+        output = self._purge('--dry-run')
+        listed = sorted(line.split(' ', 1)[1] for line in output.splitlines() if line.startswith('[dry-run] ') and '/' in line)
+        self.assertEqual(listed, sorted(self.orphans))
+        for key in self.kept + self.orphans + [self.recent_orphan]:
+            self.assertTrue(default_storage.exists(key), key)
+
+    def test_only_old_unreferenced_files_are_deleted(self):
+        output = self._purge()
+        self.assertIn('3 orphaned, 3 deleted', output)
+        for key in self.orphans:
+            self.assertFalse(default_storage.exists(key), key)
+        for key in self.kept + [self.recent_orphan]:
+            self.assertTrue(default_storage.exists(key), key)
+
+    def test_batches_are_checked_with_a_bounded_number_of_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self._purge('--dry-run')
+        files = len(self.kept) + len(self.orphans) + 1
+        # 3 requêtes par lot de 2 fichiers, plus les lectures initiales
+        self.assertLessEqual(len(queries), 3 * ((files + 1) // 2) + 4)
+
+
+class ServeMediaTests(TemporaryMediaMixin, TestCase):
+
+    def setUp(self):
+        self.media_root = self.use_temporary_media_root()
+        self.data = bytes(range(256)) * 4
+        self._file('products/photo.jpg')
+        self._file('prescriptions/rx.pdf')
+        self.customer = AppUser.objects.create_user(
+            username='media@medex.test', email='media@medex.test', password='secret123'
+        )
+        self.owner = AppUser.objects.create_user(
+            username='media-owner@medex.test', email='media-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        pharmacy = Pharmacy.objects.create(name='Media', address='Douala', owner=self.owner)
+        order = Order.objects.create(user=self.customer, pharmacy=pharmacy, total_amount=1000, final_amount=1000)
+        Prescription.objects.create(order=order, file_path='prescriptions/rx.pdf')
+        self.client = Client()
+
+    def _file(self, key):
+        path = os.path.join(self.media_root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as output:
+            output.write(self.data)
+
+    def _get(self, key, user=None, **headers):
+        if user is not None:
+            token, _ = Token.objects.get_or_create(user=user)
+            headers['Authorization'] = f'Token {token.key}'
+        return self.client.get(f'{settings.MEDIA_URL}{key}', headers=headers)
+
+    def test_full_file_with_etag(self):
+        response = self._get('products/photo.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response['ETag'].startswith('"'))
+
+    def test_matching_etag_returns_not_modified(self):
+        etag = self._get('products/photo.jpg')['ETag']
+        response = self._get('products/photo.jpg', **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_range_returns_partial_content(self):
+        response = self._get('products/photo.jpg', Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.data)}')
+        self.assertEqual(b''.join(response.streaming_content), self.data[10:20])
+
+        response = self._get('products/photo.jpg', Range='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), self.data[-5:])
+
+    def test_stale_if_range_sends_the_whole_file(self):
+        response = self._get('products/photo.jpg', Range='bytes=0-9', **{'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_range_past_the_end_is_unsatisfiable(self):
+        response = self._get('products/photo.jpg', Range=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_reversed_range_is_ignored(self):
+        response = self._get('products/photo.jpg', Range='bytes=20-10')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+
+    def test_upload_chunks_are_never_served(self):
+        self._file('prescription_uploads/part')
+        self.assertEqual(self._get('prescription_uploads/part', user=self.customer).status_code, 404)
+
+    def test_prescription_requires_authentication(self):
+        response = self._get('prescriptions/rx.pdf')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'Token')
+
+    def test_prescription_is_served_to_customer_pharmacy_and_admin(self):
+        admin = AppUser.objects.create_user(
+            username='media-admin@medex.test', email='media-admin@medex.test', password='secret123', role='admin'
+        )
+        for user in (self.customer, self.owner, admin):
+            response = self._get('prescriptions/rx.pdf', user=user)
+            self.assertEqual(response.status_code, 200, user.email)
+            self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+    def test_prescription_is_hidden_from_other_users(self):
+        stranger = AppUser.objects.create_user(
+            username='media-other@medex.test', email='media-other@medex.test', password='secret123'
+        )
+        self.assertEqual(self._get('prescriptions/rx.pdf', user=stranger).status_code, 404)
+        self.assertEqual(self._get('prescriptions/missing.pdf', user=stranger).status_code, 404)
+
+
+class CachedTokenAuthenticationTests(TestCase):
+
+    REQUESTS = 50
+
+    def setUp(self):
+        token_cache.clear()
+        self.user = AppUser.objects.create_user(
+            username='cache@medex.test', email='cache@medex.test', password='secret123'
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.factory = RequestFactory()
+
+    def _authenticate(self, authenticator):
+        request = self.factory.get('/api/cart', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        return authenticator.authenticate(request)
+
+    def test_benchmark_database_round_trips(self):
+        """Requêtes SQL pour REQUESTS authentifications : une par requête sans cache, une au total avec"""
+        with CaptureQueriesContext(connection) as uncached:
+            for _ in range(self.REQUESTS):
+                self._authenticate(TokenAuthentication())
+        with CaptureQueriesContext(connection) as cached:
+            for _ in range(self.REQUESTS):
+                self._authenticate(CachedTokenAuthentication())
+
+        self.assertEqual(len(uncached), self.REQUESTS)
+        self.assertEqual(len(cached), 1)
+
+    def test_cached_user_is_a_copy(self):
+        user, _ = self._authenticate(CachedTokenAuthentication())
+        user.first_name = 'Changed'
+        again, _ = self._authenticate(CachedTokenAuthentication())
+        self.assertNotEqual(again.first_name, 'Changed')
+
+    def test_logout_invalidates_token(self):
+        self._authenticate(CachedTokenAuthentication())
+        self.user.auth_token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self._authenticate(CachedTokenAuthentication())
+
+    def test_deactivation_and_role_change_invalidate_user(self):
+        self._authenticate(CachedTokenAuthentication())
+        self.user.role = 'pharmacist'
+        self.user.save()
+        user, _ = self._authenticate(CachedTokenAuthentication())
+        self.assertEqual(user.role, 'pharmacist')
+
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self._authenticate(CachedTokenAuthentication())
+
+    def test_revocation_reaches_other_processes(self):
+        self._authenticate(CachedTokenAuthentication())
+        # Autre processus : les signaux n'y vident pas le cache local, seule la génération partagée change
+        with mock.patch.object(token_cache, 'invalidate_user'), mock.patch.object(token_cache, 'invalidate'), \
+                self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(len(token_cache), 1)
+        with self.assertRaises(AuthenticationFailed):
+            self._authenticate(CachedTokenAuthentication())
+
+        self.user.is_active = True
+        self.user.save()
+        self._authenticate(CachedTokenAuthentication())
+        with mock.patch.object(token_cache, 'invalidate'), self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self._authenticate(CachedTokenAuthentication())
+
+    def test_cache_miss_loads_the_pharmacy_in_the_same_query(self):
+        self.user.role = 'pharmacist'
+        self.user.save()
+        first = Pharmacy.objects.create(name='Première', address='Douala', owner=self.user)
+        Pharmacy.objects.create(name='Seconde', address='Douala', owner=self.user)
+        token_cache.clear()
+
+        with self.assertNumQueries(1):
+            user, token = self._authenticate(CachedTokenAuthentication())
+        self.assertEqual(user, self.user)
+        self.assertEqual(token.identity.pharmacy.id, first.id)
+
+        client = AppUser.objects.create_user(
+            username='client-cache@medex.test', email='client-cache@medex.test', password='secret123'
+        )
+        Pharmacy.objects.create(name='Client', address='Douala', owner=client)
+        self.token = Token.objects.create(user=client)
+        with self.assertNumQueries(1):
+            _, token = self._authenticate(CachedTokenAuthentication())
+        self.assertIsNone(token.identity.pharmacy)
+
+    def test_cache_is_bounded_and_expires(self):
+        cache = TokenCache(max_size=2, ttl=0)
+        cache.set(IdentityContext(self.user, self.token))
+        self.assertIsNone(cache.get(self.token.key))
+
+        cache = TokenCache(max_size=2, ttl=60)
+        for index in range(3):
+            user = AppUser.objects.create_user(
+                username=f'lru{index}@medex.test', email=f'lru{index}@medex.test', password='secret123'
+            )
+            cache.set(IdentityContext(user, Token.objects.create(user=user)))
+        self.assertEqual(len(cache), 2)
+
+    def test_pharmacist_identity_is_cached_with_pharmacy(self):
+        owner = AppUser.objects.create_user(
+            username='pharma@medex.test', email='pharma@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        client = APIClient()
+        response = client.post('/api/login', {
+            'email': 'pharma@medex.test', 'password': 'secret123'
+        }, format='json')
+        self.assertFalse(response.data['user']['has_pharmacy'])
+        client.credentials(HTTP_AUTHORIZATION=f"Token {response.data['token']}")
+
+        # La création de la pharmacie invalide le contexte mis en cache à la connexion
+        pharmacy = Pharmacy.objects.create(name='Cache', address='Douala', owner=owner)
+        response = client.get('/api/profile/status')
+        self.assertEqual(response.data['pharmacy']['id'], pharmacy.id)
+
+        # Ensuite : ni token, ni utilisateur, ni pharmacie ne sont relus
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/profile/status')
+        self.assertEqual(response.data['pharmacy']['id'], pharmacy.id)
+        self.assertEqual(len(queries), 0)
+
+
+class FailingEmailBackend(LocmemEmailBackend):
+    """Backend locmem qui refuse tout envoi (serveur SMTP indisponible)"""
+
+    def send_messages(self, messages):
+        raise ConnectionError('SMTP unavailable')
+
+
+class UnreachableEmailBackend(LocmemEmailBackend):
+    """Backend locmem dont la connexion ne s'ouvre jamais"""
+
+    def open(self):
+        raise ConnectionRefusedError('SMTP connection refused')
+
+
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    EMAIL_OUTBOX_SEND_IN_PROCESS=False
+)
+class EmailOutboxTests(TestCase):
+
+    def setUp(self):
+        self.admin = AppUser.objects.create_user(
+            username='admin@medex.test', email='admin@medex.test',
+            password='secret123', role='admin', first_name='Ada'
+        )
+
+    def test_request_otp_only_enqueues(self):
+        response = APIClient().post('/api/admin/login/request-otp', {
+            'email': 'admin@medex.test', 'password': 'secret123'
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        message = OutboundEmail.objects.get()
+        self.assertEqual(message.status, 'pending')
+        self.assertEqual(message.to, ['admin@medex.test'])
+
+        self.assertEqual(send_pending(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(self.admin.otp_codes.latest('created_at').otp_code, mail.outbox[0].body)
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'sent')
+        self.assertEqual(message.body, '')
+
+    def test_batch_is_sent_on_one_connection(self):
+        for index in range(3):
+            OutboundEmail.enqueue('Subject', f'Body {index}', ['admin@medex.test'])
+        self.assertEqual(send_pending(), (3, 0))
+        self.assertEqual([email.body for email in mail.outbox], ['Body 0', 'Body 1', 'Body 2'])
+        self.assertEqual(send_pending(), (0, 0))
+
+    def test_failures_are_retried_with_backoff(self):
+        message = OutboundEmail.enqueue('Subject', 'Body', ['admin@medex.test'])
+
+        with override_settings(EMAIL_BACKEND='medex_app.tests.FailingEmailBackend'):
+            self.assertEqual(send_pending(), (0, 1))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('pending', 1))
+        self.assertGreater(message.next_attempt_at, message.created_at)
+        # Pas encore dû : rien n'est renvoyé
+        self.assertEqual(send_pending(), (0, 0))
+
+        OutboundEmail.objects.filter(id=message.id).update(next_attempt_at=message.created_at)
+        self.assertEqual(send_pending(), (1, 0))
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('sent', 2))
+
+    def test_message_fails_after_max_attempts(self):
+        message = OutboundEmail.enqueue('Subject', 'Body', ['admin@medex.test'])
+        with override_settings(EMAIL_BACKEND='medex_app.tests.FailingEmailBackend'):
+            for _ in range(OutboundEmail.MAX_ATTEMPTS):
+                OutboundEmail.objects.filter(id=message.id).update(next_attempt_at=message.created_at)
+                send_pending()
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'failed')
+        self.assertIn('SMTP unavailable', message.last_error)
+        self.assertEqual(message.body, '')
+
+    def test_connection_failure_is_retried_with_backoff(self):
+        messages = [OutboundEmail.enqueue('Subject', f'Body {index}', ['admin@medex.test']) for index in range(2)]
+
+        with override_settings(EMAIL_BACKEND='medex_app.tests.UnreachableEmailBackend'):
+            self.assertEqual(send_pending(), (0, 2))
+        for message in messages:
+            message.refresh_from_db()
+            self.assertEqual((message.status, message.attempts), ('pending', 1))
+            self.assertIn('connection refused', message.last_error)
+            self.assertGreater(message.next_attempt_at, message.created_at)
+
+        OutboundEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(send_pending(), (2, 0))
+
+    def test_loop_survives_a_failed_pass(self):
+        passes = iter([Exception('database unavailable'), (0, 0)])
+
+        def fake_send_pending(limit):
+            result = next(passes, None)
+            if result is None:
+                raise KeyboardInterrupt
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        err = io.StringIO()
+        with mock.patch('medex_app.management.commands.send_outbox.send_pending', fake_send_pending), \
+                mock.patch('medex_app.management.commands.send_outbox.time.sleep'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('send_outbox', '--loop', stdout=io.StringIO(), stderr=err)
+        self.assertIn('database unavailable', err.getvalue())
+
+
+@override_settings(EMAIL_OUTBOX_SEND_IN_PROCESS=False)
+class AdminTotpTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.admin = AppUser.objects.create_user(
+            username='totp@medex.test', email='totp@medex.test', password='secret123', role='admin'
+        )
+        self.client = APIClient()
+
+    def _enrol(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.post('/api/admin/2fa/totp/setup')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['qr_code'].startswith('data:image/png;base64,'))
+        secret = response.data['secret']
+        # Le code de confirmation est marqué comme utilisé : repartir d'un cache vide pour le login
+        response = self.client.post('/api/admin/2fa/totp/confirm', {
+            'code': pyotp.TOTP(secret).now()
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.client.force_authenticate(None)
+        cache.clear()
+        return secret
+
+    def test_login_with_authenticator_app(self):
+        secret = self._enrol()
+
+        response = self.client.post('/api/admin/login/request-otp', {
+            'email': 'totp@medex.test', 'password': 'secret123'
+        }, format='json')
+        self.assertEqual(response.data['method'], 'totp')
+        self.assertFalse(OTPVerification.objects.exists())
+        self.assertFalse(OutboundEmail.objects.exists())
+        ticket = response.data['pre_auth_token']
+
+        code = pyotp.TOTP(secret).now()
+        response = self.client.post('/api/admin/login/verify-otp', {
+            'email': 'totp@medex.test', 'otp_code': code, 'pre_auth_token': ticket
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('token', response.data)
+
+        # Un code accepté ne peut pas être rejoué
+        response = self.client.post('/api/admin/login/verify-otp', {
+            'email': 'totp@medex.test', 'otp_code': code, 'pre_auth_token': ticket
+        }, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_email_fallback_still_works(self):
+        self._enrol()
+        response = self.client.post('/api/admin/login/request-otp', {
+            'email': 'totp@medex.test', 'password': 'secret123', 'method': 'email'
+        }, format='json')
+        self.assertEqual(response.data['method'], 'email')
+
+        otp = OTPVerification.objects.get(user=self.admin)
+        response = self.client.post('/api/admin/login/verify-otp', {
+            'email': 'totp@medex.test', 'otp_code': otp.otp_code, 'pre_auth_token': response.data['pre_auth_token']
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_second_factor_alone_does_not_log_in(self):
+        secret = self._enrol()
+        otp = OTPVerification.create_otp(self.admin)
+        for code in (pyotp.TOTP(secret).now(), otp.otp_code):
+            response = self.client.post('/api/admin/login/verify-otp', {
+                'email': 'totp@medex.test', 'otp_code': code
+            }, format='json')
+            self.assertEqual(response.status_code, 401)
+            self.assertNotIn('token', response.data)
+
+        # Ticket expiré, ou délivré pour un autre compte
+        ticket = self.client.post('/api/admin/login/request-otp', {
+            'email': 'totp@medex.test', 'password': 'secret123'
+        }, format='json').data['pre_auth_token']
+        with mock.patch('medex_app.admin_views.PRE_AUTH_MAX_AGE', -1):
+            response = self.client.post('/api/admin/login/verify-otp', {
+                'email': 'totp@medex.test', 'otp_code': otp.otp_code, 'pre_auth_token': ticket
+            }, format='json')
+        self.assertEqual(response.status_code, 401)
+        other = AppUser.objects.create_user(
+            username='other-admin@medex.test', email='other-admin@medex.test', password='secret123', role='admin'
+        )
+        response = self.client.post('/api/admin/login/verify-otp', {
+            'email': other.email, 'otp_code': OTPVerification.create_otp(other).otp_code, 'pre_auth_token': ticket
+        }, format='json')
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(Token.objects.exists())
+
+    def test_unconfirmed_secret_is_not_used_for_login(self):
+        self.client.force_authenticate(self.admin)
+        secret = self.client.post('/api/admin/2fa/totp/setup').data['secret']
+        self.client.force_authenticate(None)
+
+        ticket = self.client.post('/api/admin/login/request-otp', {
+            'email': 'totp@medex.test', 'password': 'secret123'
+        }, format='json').data['pre_auth_token']
+        response = self.client.post('/api/admin/login/verify-otp', {
+            'email': 'totp@medex.test', 'otp_code': pyotp.TOTP(secret).now(), 'pre_auth_token': ticket
+        }, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_process_local_cache_is_refused(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['medex_app.E001'])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache'}}):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+@override_settings(RATE_LIMITS={
+    'login': {'ip': (100, 60), 'email': (3, 60)},
+    'admin_otp_verify': {'ip': (2, 60), 'email': (100, 60)},
+})
+class RateLimitTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        AppUser.objects.create_user(
+            username='limit@medex.test', email='limit@medex.test', password='secret123'
+        )
+        self.client = APIClient()
+
+    def _login(self, email='limit@medex.test'):
+        return self.client.post('/api/login', {'email': email, 'password': 'wrong'}, format='json')
+
+    def test_login_is_limited_per_email_before_any_query(self):
+        for _ in range(3):
+            self.assertEqual(self._login().status_code, 401)
+        with self.assertNumQueries(0):
+            response = self._login('LIMIT@medex.test ')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        # Un autre email depuis la même IP passe encore
+        self.assertEqual(self._login('other@medex.test').status_code, 401)
+
+    def test_otp_verification_is_limited_per_ip(self):
+        for email in ('a@medex.test', 'b@medex.test'):
+            response = self.client.post('/api/admin/login/verify-otp', {
+                'email': email, 'otp_code': '000000'
+            }, format='json')
+            self.assertEqual(response.status_code, 401)
+        response = self.client.post('/api/admin/login/verify-otp', {
+            'email': 'c@medex.test', 'otp_code': '000000'
+        }, format='json')
+        self.assertEqual(response.status_code, 429)
+
+    def test_window_slides(self):
+        identities = {'email': 'slide@medex.test'}
+        start = 1_000_000 * 60
+        for _ in range(3):
+            self.assertIsNone(check_and_count('login', identities, now=start))
+        self.assertIsNotNone(check_and_count('login', identities, now=start + 30))
+        # Fenêtre suivante : les 3 requêtes précédentes pèsent au prorata du chevauchement
+        self.assertIsNone(check_and_count('login', identities, now=start + 61))
+        self.assertIsNotNone(check_and_count('login', identities, now=start + 62))
+        self.assertIsNone(check_and_count('login', identities, now=start + 119))
+
+    @override_settings(
+        CACHES={**settings.CACHES, 'ratelimit': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'ratelimit-tests'
+        }},
+        RATE_LIMIT_CACHE='ratelimit',
+    )
+    def test_concurrent_requests_cannot_exceed_the_limit(self):
+        attempts = 12
+        barrier = threading.Barrier(attempts)
+        get_many = LocMemCache.get_many
+
+        def get_many_then_wait(cache, keys, version=None):
+            # Toutes les requêtes lisent les compteurs avant qu'aucune ne compte
+            values = get_many(cache, keys, version=version)
+            barrier.wait(timeout=10)
+            return values
+
+        def attempt(_):
+            return check_and_count('login', {'email': 'race@medex.test'}, now=1_000_000 * 60)
+
+        with mock.patch.object(LocMemCache, 'get_many', get_many_then_wait), \
+                ThreadPoolExecutor(max_workers=attempts) as pool:
+            results = list(pool.map(attempt, range(attempts)))
+        self.assertEqual(results.count(None), 3)
+        # Les requêtes refusées ne sont pas comptées : la fenêtre précédente pèse 3 × 0,5
+        self.assertIsNone(check_and_count('login', {'email': 'race@medex.test'}, now=1_000_000 * 60 + 90))
+
+
+class PurgeAuthDataTests(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.user = AppUser.objects.create_user(
+            username='purge-auth@medex.test', email='purge-auth@medex.test', password='secret123'
+        )
+        OTPVerification.objects.create(user=self.user, otp_code='111111', expires_at=now - timedelta(minutes=1))
+        OTPVerification.objects.create(user=self.user, otp_code='222222', expires_at=now + timedelta(minutes=5), is_used=True)
+        self.live_otp = OTPVerification.objects.create(user=self.user, otp_code='333333', expires_at=now + timedelta(minutes=5))
+
+        IdempotencyKey.objects.create(
+            user=self.user, key='old', endpoint='cart', request_hash='x', expires_at=now - timedelta(hours=1)
+        )
+        self.live_key = IdempotencyKey.objects.create(
+            user=self.user, key='new', endpoint='cart', request_hash='x', expires_at=now + timedelta(hours=1)
+        )
+
+        # Utilisateur actif connecté aujourd'hui, avec un token ancien
+        self.old_token = Token.objects.create(user=self.user)
+        Token.objects.filter(pk=self.old_token.pk).update(created=now - timedelta(days=100))
+        self.user.last_login = now
+        self.user.save(update_fields=['last_login'])
+
+        # Jamais reconnecté depuis longtemps, mais token récent
+        recent = AppUser.objects.create_user(
+            username='recent@medex.test', email='recent@medex.test', password='secret123'
+        )
+        recent.last_login = now - timedelta(days=200)
+        recent.save(update_fields=['last_login'])
+        self.recent_token = Token.objects.create(user=recent)
+
+        inactive = AppUser.objects.create_user(
+            username='inactive@medex.test', email='inactive@medex.test', password='secret123', is_active=False
+        )
+        self.inactive_token = Token.objects.create(user=inactive)
+
+    def _purge(self, *args):
+        out = io.StringIO()
+        call_command('purge_auth_data', '--batch-size', '1', *args, stdout=out)
+        return out.getvalue()
+
+    def test_dry_run_only_counts(self):
+        output = self._purge('--dry-run')
+        self.assertIn('2 OTP codes, 1 idempotency keys, 2 tokens', output)
+        self.assertEqual(OTPVerification.objects.count(), 3)
+        self.assertEqual(IdempotencyKey.objects.count(), 2)
+        self.assertEqual(Token.objects.count(), 3)
+
+    def test_expired_data_and_old_tokens_are_deleted(self):
+        output = self._purge()
+        self.assertIn('Deleted 2 OTP codes, 1 idempotency keys, 2 tokens', output)
+        self.assertEqual(list(OTPVerification.objects.all()), [self.live_otp])
+        self.assertEqual(list(IdempotencyKey.objects.all()), [self.live_key])
+        # L'âge se compte depuis la création du token, pas depuis la dernière connexion
+        self.assertEqual(list(Token.objects.all()), [self.recent_token])
+
+    def test_purged_tokens_are_revoked_in_every_worker(self):
+        before = user_generation(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self._purge()
+        self.assertNotEqual(user_generation(self.user.pk), before)
+
+    def test_token_max_age_is_configurable(self):
+        self._purge('--token-max-age-days', '365')
+        self.assertEqual(
+            set(Token.objects.values_list('key', flat=True)),
+            {self.old_token.key, self.recent_token.key},
+        )
+
+
+@mock.patch.object(tracking.LocationBuffer, '_ensure_flusher')
+class LocationIngestTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        owner = AppUser.objects.create_user(
+            username='gps-owner@medex.test', email='gps-owner@medex.test', password='secret123', role='pharmacist'
+        )
+        customer = AppUser.objects.create_user(
+            username='gps-client@medex.test', email='gps-client@medex.test', password='secret123'
+        )
+        self.courier = AppUser.objects.create_user(
+            username='gps-courier@medex.test', email='gps-courier@medex.test', password='secret123', role='delivery'
+        )
+        pharmacy = Pharmacy.objects.create(name='GPS', address='Douala', owner=owner)
+        self.delivery = Delivery.objects.create(
+            order=Order.objects.create(user=customer, pharmacy=pharmacy, total_amount=1000, final_amount=1000),
+            delivery_person=self.courier,
+        )
+        self.buffer = tracking.LocationBuffer()
+        patcher = mock.patch.object(tracking, 'buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.client.force_authenticate(self.courier)
+
+    def _send(self, data, delivery=None):
+        delivery = delivery or self.delivery
+        return self.client.post(f'/api/delivery/{delivery.id}/locations', data, format='json')
+
+    def _points(self, count, start=None):
+        start = start or timezone.now() - timedelta(minutes=10)
+        return [
+            {'latitude': round(4.05 + i * 0.001, 6), 'longitude': 9.70, 'recorded_at': (start + timedelta(seconds=5 * i)).isoformat()}
+            for i in range(count)
+        ]
+
+    def test_batches_are_validated(self, _):
+        self.assertEqual(self._send({'points': []}).status_code, 400)
+        self.assertEqual(self._send({'points': self._points(501)}).status_code, 400)
+        self.assertEqual(self._send({'points': [{'latitude': 91, 'longitude': 9.7}]}).status_code, 400)
+
+        response = self._send({'latitude': 4.05, 'longitude': 9.70})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['accepted'], 1)
+
+    def test_flush_writes_trail_and_latest_position_in_bulk(self, _):
+        points = self._points(20)
+        # Ordre d'arrivée quelconque : la position courante reste le point le plus récent
+        response = self._send({'points': points[10:] + points[:10]})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['position']['latitude'], points[-1]['latitude'])
+        self.assertEqual(tracking.latest_position(self.delivery.id)['latitude'], points[-1]['latitude'])
+
+        with self.assertNumQueries(6):
+            self.assertEqual(self.buffer.flush(), 20)
+        self.delivery.refresh_from_db()
+        self.assertEqual(float(self.delivery.current_latitude), points[-1]['latitude'])
+        self.assertEqual(DeliveryTrail.objects.get(delivery=self.delivery).point_count, 20)
+        # Tampon vidé : rien à réécrire
+        with self.assertNumQueries(0):
+            self.assertEqual(self.buffer.flush(), 0)
+
+    def test_points_of_deleted_deliveries_are_dropped(self, _):
+        self._send({'points': self._points(3)})
+        self.delivery.delete()
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertFalse(DeliveryTrail.objects.exists())
+
+    def test_full_buffer_is_refused(self, _):
+        with mock.patch.object(tracking, 'MAX_BUFFERED_POINTS', 5):
+            self.assertEqual(self._send({'points': self._points(5)}).status_code, 202)
+            self.assertEqual(self._send({'points': self._points(1)}).status_code, 503)
+
+    def test_only_the_assigned_courier_can_send(self, _):
+        other = AppUser.objects.create_user(
+            username='gps-other@medex.test', email='gps-other@medex.test', password='secret123', role='delivery'
+        )
+        self.client.force_authenticate(other)
+        self.assertEqual(self._send({'latitude': 4.05, 'longitude': 9.70}).status_code, 404)
+
+        self.client.force_authenticate(self.delivery.order.user)
+        self.assertEqual(self._send({'latitude': 4.05, 'longitude': 9.70}).status_code, 403)
+
+    def test_newly_assigned_courier_is_accepted_at_once(self, _):
+        self.delivery.delivery_person = None
+        self.delivery.save()
+        self.assertEqual(self._send({'latitude': 4.05, 'longitude': 9.70}).status_code, 404)
+
+        self.delivery.delivery_person = self.courier
+        self.delivery.save()
+        self.assertEqual(self._send({'latitude': 4.05, 'longitude': 9.70}).status_code, 202)
+
+
+class DeliveryTrackingStreamTests(TestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        owner = AppUser.objects.create_user(
+            username='live-owner@medex.test', email='live-owner@medex.test', password='secret123', role='pharmacist'
+        )
+        self.customer = AppUser.objects.create_user(
+            username='live@medex.test', email='live@medex.test', password='secret123'
+        )
+        pharmacy = Pharmacy.objects.create(name='Live', address='Douala', owner=owner)
+        self.order = Order.objects.create(user=self.customer, pharmacy=pharmacy, total_amount=1000, final_amount=1000)
+        self.delivery = Delivery.objects.create(order=self.order, delivery_status='in_progress')
+
+    def _ticket(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post('/api/stream-ticket').data['ticket']
+
+    def _stream(self, **params):
+        return Client().get(f'/api/orders/{self.order.id}/tracking/stream', params)
+
+    def test_stream_follows_position_and_status_until_delivered(self):
+        positions = [{'latitude': 4.05, 'longitude': 9.7}, {'latitude': 4.06, 'longitude': 9.71}]
+
+        def latest_position(delivery_id):
+            # Deuxième lecture : le livreur a bougé et vient de livrer
+            if len(positions) == 1:
+                Delivery.objects.filter(id=delivery_id).update(delivery_status='delivered')
+            return positions.pop(0) if len(positions) > 1 else positions[0]
+
+        response = self._stream(ticket=self._ticket(self.customer))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        with mock.patch.object(tracking, 'latest_position', latest_position), \
+                mock.patch.multiple(live_tracking, POLL_INTERVAL=0.01, STATUS_POLL_EVERY=1):
+            body = _read_stream(response)
+
+        events = [block.split('\n') for block in body.strip().split('\n\n')]
+        self.assertEqual(events, [
+            ['retry: 3000'],
+            ['event: position', 'data: {"latitude": 4.05, "longitude": 9.7}'],
+            ['event: status', 'data: {"delivery_status": "in_progress"}'],
+            ['event: position', 'data: {"latitude": 4.06, "longitude": 9.71}'],
+            ['event: status', 'data: {"delivery_status": "delivered"}'],
+            ['event: end', 'data: {}'],
+        ])
+        # Le publieur partagé est libéré avec son dernier abonné
+        self.assertNotIn(self.delivery.id, live_tracking.hub.publishers)
+
+    def test_stream_requires_a_ticket_of_a_party_to_the_order(self):
+        token = Token.objects.create(user=self.customer)
+        self.assertEqual(self._stream(token=token.key).status_code, 401)
+        self.assertEqual(self._stream(ticket=self._ticket(self.customer) + 'x').status_code, 401)
+
+        stranger = AppUser.objects.create_user(
+            username='live-other@medex.test', email='live-other@medex.test', password='secret123'
+        )
+        self.assertEqual(self._stream(ticket=self._ticket(stranger)).status_code, 404)
+
+    def test_start_up_failure_reaches_every_waiting_subscriber(self):
+        started, release = threading.Event(), threading.Event()
+
+        def latest_position(delivery_id):
+            started.set()
+            release.wait(5)
+            raise ConnectionError('tracking cache unavailable')
+
+        async def scenario():
+            hub = live_tracking.TrackingHub()
+            first = asyncio.ensure_future(hub.subscribe(self.delivery.id))
+            await asyncio.to_thread(started.wait, 5)
+            # Deuxième abonné arrivé pendant la lecture initiale du premier
+            _, queue = await hub.subscribe(self.delivery.id)
+            release.set()
+            with self.assertRaises(ConnectionError):
+                await first
+            self.assertIsInstance(await asyncio.wait_for(queue.get(), 1), ConnectionError)
+            self.assertNotIn(self.delivery.id, hub.publishers)
+
+        with mock.patch.object(tracking, 'latest_position', latest_position):
+            async_to_sync(scenario)()
+
+
+class DispatchTests(TestCase):
+
+    def test_index_returns_nearest_couriers(self):
+        index = CourierIndex([
+            (1, 4.0500, 9.7000, 1),
+            (2, 4.0600, 9.7000, 1),
+            (3, 4.3000, 9.7000, 1),
+            (4, 4.0501, 9.7001, 0),  # saturé : non indexé
+        ])
+        self.assertEqual(len(index), 3)
+        nearest = index.nearest(4.0510, 9.7000, k=2)
+        self.assertEqual([courier_id for _, courier_id in nearest], [1, 2])
+        self.assertEqual(index.nearest(4.0510, 9.7000, max_km=0.01), [])
+
+    def test_batch_matching_respects_capacity(self):
+        index = CourierIndex([(1, 4.05, 9.70, 2), (2, 4.15, 9.70, 1)])
+        deliveries = [(10, 4.05, 9.70), (11, 4.051, 9.70), (12, 4.052, 9.70), (13, 4.053, 9.70)]
+        assigned = {delivery_id: courier_id for delivery_id, courier_id, _ in match(deliveries, index)}
+        # 13 est la plus proche du second livreur
+        self.assertEqual(assigned, {10: 1, 11: 1, 13: 2})
+
+    def test_assign_pending_writes_only_pending_deliveries(self):
+        cache.clear()
+        owner = AppUser.objects.create_user(
+            username='disp-owner@medex.test', email='disp-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        customer = AppUser.objects.create_user(
+            username='disp-client@medex.test', email='disp-client@medex.test', password='secret123'
+        )
+        courier = AppUser.objects.create_user(
+            username='courier@medex.test', email='courier@medex.test',
+            password='secret123', role='delivery'
+        )
+        pharmacy = Pharmacy.objects.create(
+            name='Dispatch', address='Douala', owner=owner, latitude='4.050000', longitude='9.700000'
+        )
+        deliveries = [
+            Delivery.objects.create(order=Order.objects.create(
+                user=customer, pharmacy=pharmacy, total_amount=1000, final_amount=1000
+            ))
+            for _ in range(2)
+        ]
+        Delivery.objects.filter(id=deliveries[1].id).update(delivery_status='failed')
+        tracking.publish_courier_position(courier.id, {'latitude': 4.06, 'longitude': 9.71, 'recorded_at': ''})
+        self.assertFalse(tracking.is_assigned_courier(courier.id, deliveries[0].id))
+
+        assigned = assign_pending()
+
+        self.assertEqual([(d, c) for d, c, _ in assigned], [(deliveries[0].id, courier.id)])
+        delivery = Delivery.objects.get(id=deliveries[0].id)
+        self.assertEqual(delivery.delivery_status, 'assigned')
+        self.assertIsNotNone(delivery.assigned_date)
+        self.assertEqual(assign_pending(), [])
+        # Le livreur assigné peut envoyer ses positions tout de suite
+        self.assertTrue(tracking.is_assigned_courier(courier.id, deliveries[0].id))
+
+    @override_settings(
+        CACHES={**settings.CACHES, 'tracking': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        DELIVERY_TRACKING_CACHE='tracking',
+    )
+    def test_dispatch_command_refuses_a_process_local_tracking_cache(self):
+        # Les positions publiées par les workers web seraient invisibles pour la commande
+        with self.assertRaisesMessage(SystemCheckError, 'medex_app.E001'):
+            call_command('dispatch_deliveries', skip_checks=False, stdout=io.StringIO())
+
+
+class RoutePlanningTests(TestCase):
+
+    def test_two_opt_improves_nearest_neighbour(self):
+        rng = random.Random(8)
+        stops = [(i, 4.0 + rng.random() * 0.05, 9.7 + rng.random() * 0.05) for i in range(6)]
+        origin = (4.0, 9.7)
+        ordered, total_km = plan_route(origin, stops)
+
+        matrix = _distance_matrix([origin] + [(lat, lng) for _, lat, lng in stops])
+        greedy_km = path_length(_nearest_neighbour(matrix), matrix)
+        best_km = min(
+            path_length([0] + list(order), matrix) for order in itertools.permutations(range(1, 7))
+        )
+        # Sur ce jeu, le plus proche voisin se croise ; 2-opt retrouve l'optimum
+        self.assertLess(best_km, greedy_km)
+        self.assertAlmostEqual(total_km, best_km)
+        self.assertAlmostEqual(total_km, sum(stop[3] for stop in ordered))
+
+    def test_twenty_stops_are_planned_quickly(self):
+        rng = random.Random(45)
+        stops = [(i, 4.0 + rng.random() * 0.1, 9.7 + rng.random() * 0.1) for i in range(20)]
+        started = time.perf_counter()
+        ordered, _ = plan_route((4.05, 9.75), stops)
+        elapsed = time.perf_counter() - started
+        self.assertEqual(sorted(key for key, *_ in ordered), list(range(20)))
+        self.assertLess(elapsed, 0.1)
+
+
+class EtaTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        owner = AppUser.objects.create_user(
+            username='eta-owner@medex.test', email='eta-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        self.customer = AppUser.objects.create_user(
+            username='eta-client@medex.test', email='eta-client@medex.test', password='secret123'
+        )
+        self.pharmacy = Pharmacy.objects.create(
+            name='ETA', address='Douala', owner=owner, latitude='4.050000', longitude='9.700000'
+        )
+        self.destination = (4.070, 9.710)
+        self.pickup = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=1)
+        for _ in range(5):
+            self._delivery(delivered_after=timedelta(minutes=15))
+
+    def _delivery(self, delivered_after=None):
+        order = Order.objects.create(
+            user=self.customer, pharmacy=self.pharmacy, total_amount=1000, final_amount=1000,
+            delivery_latitude=self.destination[0], delivery_longitude=self.destination[1]
+        )
+        if delivered_after is None:
+            return Delivery.objects.create(order=order, delivery_status='in_progress')
+        return Delivery.objects.create(
+            order=order, delivery_status='delivered',
+            pickup_date=self.pickup, delivery_date=self.pickup + delivered_after
+        )
+
+    def test_grid_learns_zone_speed_and_estimates_in_memory(self):
+        grid = build_grid()
+        self.assertEqual(grid.sample_count, 5)
+        trip_km = haversine_km(4.05, 9.70, *self.destination)
+        hour = timezone.localtime(self.pickup).hour
+        self.assertAlmostEqual(current_grid().speed(*self.destination, hour), trip_km * 4, places=1)
+
+        delivery = self._delivery()
+        at = self.pickup + timedelta(days=1)
+        estimate_arrival(delivery.id, 4.05, 9.70, at)  # met la destination en cache
+        with self.assertNumQueries(0):
+            eta = estimate_arrival(delivery.id, 4.05, 9.70, at)
+        self.assertAlmostEqual((eta - at).total_seconds(), 15 * 60, delta=60)
+
+    def test_gps_ingest_updates_estimate(self):
+        build_grid()
+        delivery = self._delivery()
+        courier = AppUser.objects.create_user(
+            username='eta-courier@medex.test', email='eta-courier@medex.test',
+            password='secret123', role='delivery'
+        )
+        Delivery.objects.filter(id=delivery.id).update(delivery_person=courier)
+        client = APIClient()
+        client.force_authenticate(courier)
+
+        response = client.post(f'/api/delivery/{delivery.id}/locations', {
+            'latitude': '4.060000', 'longitude': '9.705000'
+        }, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('estimated_delivery_time', response.data['position'])
+
+        tracking.buffer.flush()
+        delivery.refresh_from_db()
+        self.assertIsNotNone(delivery.estimated_delivery_time)
+        self.assertGreater(delivery.estimated_delivery_time, timezone.now())
+
+
+class DeliveryDashboardTests(TestCase):
+
+    def setUp(self):
+        owner = AppUser.objects.create_user(
+            username='dash-owner@medex.test', email='dash-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        self.pharmacy = Pharmacy.objects.create(name='Dash', address='Douala', owner=owner)
+        self.courier = AppUser.objects.create_user(
+            username='dash-courier@medex.test', email='dash-courier@medex.test',
+            password='secret123', role='delivery'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.courier)
+
+    def _deliveries(self, count):
+        deliveries = []
+        for _ in range(count):
+            index = AppUser.objects.count()
+            customer = AppUser.objects.create_user(
+                username=f'dash-{index}@medex.test', email=f'dash-{index}@medex.test',
+                password='secret123', first_name='Client', last_name=str(index)
+            )
+            order = Order.objects.create(
+                user=customer, pharmacy=self.pharmacy, total_amount=1000, final_amount=1000
+            )
+            deliveries.append(Delivery.objects.create(
+                order=order, delivery_person=self.courier, delivery_status='assigned'
+            ))
+        return deliveries
+
+    def test_list_query_count_does_not_grow_with_deliveries(self):
+        self._deliveries(2)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/delivery/orders')
+        self.assertEqual(len(response.data['orders']), 2)
+
+        self._deliveries(15)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/delivery/orders', {'limit': 10})
+        self.assertEqual(len(response.data['orders']), 10)
+        self.assertTrue(response.data['pagination']['has_more'])
+        self.assertTrue(response.data['orders'][0]['customer_name'].startswith('Client'))
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/delivery/orders', {
+                'limit': 10, 'cursor': response.data['pagination']['next_cursor']
+            })
+        self.assertEqual(len(response.data['orders']), 7)
+
+    def test_status_update_follows_transitions_and_syncs_order(self):
+        delivery = self._deliveries(1)[0]
+        Order.objects.filter(id=delivery.order_id).update(status='ready_for_pickup')
+        url = f'/api/delivery/orders/{delivery.order_id}/status/'
+
+        response = self.client.put(url, {'status': 'delivered'}, format='json')
+        self.assertEqual(response.status_code, 409)
+
+        response = self.client.put(url, {'status': 'picked_up'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['order_status'], 'in_delivery')
+
+        response = self.client.put(url, {'status': 'delivered'}, format='json')
+        self.assertEqual(response.data['order_status'], 'delivered')
+        delivery.refresh_from_db()
+        self.assertIsNotNone(delivery.pickup_date)
+        self.assertIsNotNone(delivery.delivery_date)
+
+        other = APIClient()
+        other.force_authenticate(AppUser.objects.create_user(
+            username='dash-other@medex.test', email='dash-other@medex.test',
+            password='secret123', role='delivery'
+        ))
+        self.assertEqual(other.put(url, {'status': 'returned'}, format='json').status_code, 404)
+
+    def test_failed_and_returned_deliveries_release_the_order(self):
+        delivery = self._deliveries(1)[0]
+        order = delivery.order
+        Order.objects.filter(id=order.id).update(status='ready_for_pickup')
+        url = f'/api/delivery/orders/{order.id}/status/'
+
+        self.client.put(url, {'status': 'picked_up'}, format='json')
+        self.client.put(url, {'status': 'in_progress'}, format='json')
+        # Échec en route : les produits sont chez le livreur jusqu'à leur retour
+        response = self.client.put(url, {'status': 'failed', 'reason': 'Customer absent'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['order_status'], 'in_delivery')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(url, {'status': 'returned'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['order_status'], 'ready_for_pickup')
+        self.assertEqual(
+            list(OrderStatusEvent.objects.filter(order=order).order_by('id').values_list('from_status', 'to_status'))[-2:],
+            [('ready_for_pickup', 'in_delivery'), ('in_delivery', 'ready_for_pickup')],
+        )
+        delivery.refresh_from_db()
+        self.assertEqual(
+            (delivery.delivery_status, delivery.delivery_person_id, delivery.assigned_date, delivery.pickup_date),
+            ('pending', None, None, None)
+        )
+        self.assertEqual(delivery.failure_reason, 'Customer absent')
+
+    def test_failed_delivery_is_dispatched_again(self):
+        cache.clear()
+        Pharmacy.objects.filter(id=self.pharmacy.id).update(latitude='4.050000', longitude='9.700000')
+        delivery = self._deliveries(1)[0]
+        Order.objects.filter(id=delivery.order_id).update(status='ready_for_pickup')
+        tracking.publish_courier_position(self.courier.id, {'latitude': 4.06, 'longitude': 9.71, 'recorded_at': ''})
+        self.assertTrue(tracking.is_assigned_courier(self.courier.id, delivery.id))
+
+        # Échec avant l'enlèvement : rien n'a quitté la pharmacie
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(
+                f'/api/delivery/orders/{delivery.order_id}/status/', {'status': 'failed'}, format='json'
+            )
+        self.assertEqual(response.data['order_status'], 'ready_for_pickup')
+        self.assertFalse(tracking.is_assigned_courier(self.courier.id, delivery.id))
+
+        other = AppUser.objects.create_user(
+            username='dash-courier2@medex.test', email='dash-courier2@medex.test',
+            password='secret123', role='delivery'
+        )
+        tracking.publish_courier_position(other.id, {'latitude': 4.05, 'longitude': 9.70, 'recorded_at': ''})
+        assigned = assign_pending()
+        self.assertEqual([delivery_id for delivery_id, _, _ in assigned], [delivery.id])
+        self.assertEqual(Delivery.objects.get(id=delivery.id).delivery_status, 'assigned')
+
+
+class DeliveryTrailTests(TestCase):
+
+    def test_polyline_matches_reference_encoding(self):
+        latitudes = [38_500_000, 40_700_000, 43_252_000]
+        longitudes = [-120_200_000, -120_950_000, -126_453_000]
+        self.assertEqual(trails.encode_polyline(latitudes, longitudes), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    def test_flushes_append_to_one_compact_trail(self):
+        owner = AppUser.objects.create_user(
+            username='trail-owner@medex.test', email='trail-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        customer = AppUser.objects.create_user(
+            username='trail-client@medex.test', email='trail-client@medex.test', password='secret123'
+        )
+        pharmacy = Pharmacy.objects.create(name='Trail', address='Douala', owner=owner)
+        delivery = Delivery.objects.create(order=Order.objects.create(
+            user=customer, pharmacy=pharmacy, total_amount=1000, final_amount=1000
+        ))
+        start = timezone.now().replace(microsecond=0)
+        pings = [
+            (4.050000 + i * 0.000150, 9.700000 - i * 0.000090, start + timedelta(seconds=5 * i))
+            for i in range(600)
+        ]
+        for batch in (pings[:300], pings[300:]):
+            tracking.buffer.add(delivery.id, batch)
+            tracking.buffer.flush()
+
+        trail = DeliveryTrail.objects.get(delivery=delivery)
+        self.assertEqual(trail.point_count, 600)
+        # Moins de 2 octets par point (contre une ligne indexée par ping auparavant)
+        self.assertLess(len(trail.data), 600 * 2)
+
+        latitudes, longitudes, timestamps = trails.points(trail)
+        self.assertEqual(latitudes[-1], trails.to_micro(pings[-1][0]))
+        self.assertEqual(longitudes[0], 9_700_000)
+        self.assertEqual(timestamps[-1] - timestamps[0], 5 * 599)
+
+        client = APIClient()
+        client.force_authenticate(customer)
+        response = client.get(f'/api/delivery/{delivery.id}/trail')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['point_count'], 600)
+        self.assertEqual(
+            response.data['polyline'], trails.encode_polyline(latitudes, longitudes)
+        )
+
+
+class DeliveryPricingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        owner = AppUser.objects.create_user(
+            username='fee-owner@medex.test', email='fee-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        self.pharmacy = Pharmacy.objects.create(
+            name='Fees', address='Douala', owner=owner, latitude='4.050000', longitude='9.700000'
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            # Zone en L (concave) autour de la pharmacie
+            DeliveryZone.objects.create(
+                pharmacy=self.pharmacy, name='Centre', fee=300, min_order_amount=500,
+                polygon=[[4.00, 9.65], [4.10, 9.65], [4.10, 9.70], [4.05, 9.70], [4.05, 9.75], [4.00, 9.75]]
+            )
+            DeliveryFeeBand.objects.create(max_distance_km=10, fee=800, min_order_amount=1500)
+            DeliveryFeeBand.objects.create(max_distance_km=20, fee=1200, min_order_amount=2000)
+
+    def test_zone_then_distance_bands(self):
+        self.assertEqual(pricing.quote(self.pharmacy, 4.02, 9.72)['zone'], 'Centre')
+        self.assertEqual(pricing.quote(self.pharmacy, 4.02, 9.72)['delivery_fee'], 300)
+        # Dans l'encoche du L : hors zone, tarif de la première tranche
+        notch = pricing.quote(self.pharmacy, 4.08, 9.72)
+        self.assertIsNone(notch['zone'])
+        self.assertEqual(notch['delivery_fee'], 800)
+        self.assertEqual(pricing.quote(self.pharmacy, 4.15, 9.80)['delivery_fee'], 1200)
+        self.assertFalse(pricing.quote(self.pharmacy, 5.0, 9.70)['deliverable'])
+        self.assertEqual(pricing.quote(self.pharmacy)['delivery_fee'], pricing.DEFAULT_DELIVERY_FEE)
+
+    def test_compiled_table_matches_exact_geometry(self):
+        table = pricing.compile_table()
+        zone = pricing.CompiledZone(DeliveryZone.objects.get(pharmacy=self.pharmacy))
+        self.assertNotIn(self.pharmacy.id, table.large_zones)
+        rng = random.Random(49)
+        for _ in range(2000):
+            latitude, longitude = 3.99 + rng.random() * 0.12, 9.64 + rng.random() * 0.12
+            expected = zone.name if zone.contains(latitude, longitude) else None
+            found = table.zone_for(self.pharmacy.id, latitude, longitude)
+            self.assertEqual(found.name if found else None, expected)
+
+    def test_changes_are_picked_up_without_restart(self):
+        self.assertEqual(pricing.quote(self.pharmacy, 4.02, 9.72)['delivery_fee'], 300)
+        with self.assertNumQueries(0):
+            pricing.quote(self.pharmacy, 4.02, 9.72)
+        with self.captureOnCommitCallbacks(execute=True):
+            zone = DeliveryZone.objects.get(pharmacy=self.pharmacy)
+            zone.fee = 400
+            zone.save()
+        self.assertEqual(pricing.quote(self.pharmacy, 4.02, 9.72)['delivery_fee'], 400)
+
+    def test_changes_from_another_process_are_picked_up(self):
+        self.assertEqual(pricing.quote(self.pharmacy, 4.02, 9.72)['delivery_fee'], 300)
+        # Aucun signal dans ce processus : seule la signature en base change, y compris par update()
+        DeliveryZone.objects.filter(pharmacy=self.pharmacy).update(fee=450)
+        self.assertEqual(pricing.quote(self.pharmacy, 4.02, 9.72)['delivery_fee'], 300)
+        with mock.patch.object(pricing, 'VERSION_CHECK_INTERVAL', 0):
+            self.assertEqual(pricing.quote(self.pharmacy, 4.02, 9.72)['delivery_fee'], 450)
+            # Une suppression change aussi la signature
+            DeliveryZone.objects.filter(pharmacy=self.pharmacy).delete()
+            self.assertIsNone(pricing.quote(self.pharmacy, 4.02, 9.72)['zone'])
+
+    def test_invalid_zone_polygon_is_rejected_and_skipped(self):
+        zone = DeliveryZone(pharmacy=self.pharmacy, name='Bad', fee=100, polygon=[[4.0, 9.6], [4.1, 'x']])
+        with self.assertRaises(ValidationError):
+            zone.full_clean()
+        zone.polygon = [[4.0, 9.6], [4.1, 9.6], [91, 9.7]]
+        with self.assertRaises(ValidationError):
+            zone.full_clean()
+
+        # Zone invalide écrite sans full_clean() : ignorée, les autres tarifs restent servis
+        with self.captureOnCommitCallbacks(execute=True):
+            DeliveryZone.objects.create(pharmacy=self.pharmacy, name='Empty', fee=100, priority=10, polygon=[])
+        with self.assertLogs('medex_app.pricing', 'WARNING'):
+            self.assertEqual(pricing.quote(self.pharmacy, 4.02, 9.72)['zone'], 'Centre')
+        response = APIClient().get('/api/order/settings', {
+            'pharmacy_id': self.pharmacy.id, 'latitude': '4.02', 'longitude': '9.72'
+        })
+        self.assertEqual(response.status_code, 200)
+
+    def test_order_settings_quotes_fee(self):
+        response = APIClient().get('/api/order/settings', {
+            'pharmacy_id': self.pharmacy.id, 'latitude': '4.02', 'longitude': '9.72'
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['settings']['delivery_fee'], 300)
+        self.assertEqual(response.data['settings']['delivery_zone'], 'Centre')
+
+        response = APIClient().get('/api/order/settings', {'pharmacy_id': self.pharmacy.id, 'latitude': 'north', 'longitude': '9.72'})
+        self.assertEqual(response.status_code, 400)
+        with mock.patch.object(pricing, 'quote', side_effect=RuntimeError('pricing unavailable')):
+            response = APIClient().get('/api/order/settings', {'pharmacy_id': self.pharmacy.id})
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(response.data['success'])
+
+
+class AdminDashboardStatsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.admin = AppUser.objects.create_user(
+            username='stats-admin@medex.test', email='stats-admin@medex.test',
+            password='secret123', role='admin'
+        )
+        owner = AppUser.objects.create_user(
+            username='stats-owner@medex.test', email='stats-owner@medex.test',
+            password='secret123', role='pharmacist'
+        )
+        pharmacy = Pharmacy.objects.create(name='Stats', address='Douala', owner=owner, is_verified=True)
+        for _ in range(3):
+            Order.objects.create(user=owner, pharmacy=pharmacy, total_amount=1000, final_amount=1500)
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_one_aggregate_query_per_model(self):
+        with self.assertNumQueries(7):
+            stats = dashboard_stats.compute_stats()
+        self.assertEqual(stats['users']['total'], 2)
+        self.assertEqual(stats['users']['pharmacists'], 1)
+        self.assertEqual(stats['pharmacies']['verified'], 1)
+        self.assertEqual(stats['orders']['pending'], 3)
+        self.assertEqual(stats['monthly_stats'][-1]['revenue'], 4500)
+        self.assertEqual(stats['top_pharmacies'][0]['order_count'], 3)
+
+    def test_dashboard_is_served_from_snapshot(self):
+        response = self.client.get('/api/admin/dashboard/stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['stats']['orders']['total'], 3)
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/admin/dashboard/stats')
+        self.assertEqual(response.data['stats']['orders']['total'], 3)
+
+    def test_stale_snapshot_is_refreshed_by_one_worker_only(self):
+        snapshot = dashboard_stats.refresh_snapshot()
+        snapshot['generated_ts'] -= dashboard_stats.REFRESH_INTERVAL + 1
+        cache.set(dashboard_stats.SNAPSHOT_KEY, snapshot)
+
+        with mock.patch.object(dashboard_stats._executor, 'submit') as submit:
+            # Recalcul déjà lancé par un autre worker : le snapshot ancien est servi
+            cache.set(dashboard_stats.REFRESH_LOCK_KEY, True)
+            self.assertEqual(dashboard_stats.get_snapshot(), snapshot)
+            submit.assert_not_called()
+
+            cache.delete(dashboard_stats.REFRESH_LOCK_KEY)
+            for _ in range(3):
+                self.assertEqual(dashboard_stats.get_snapshot(), snapshot)
+            submit.assert_called_once_with(dashboard_stats._refresh_in_background)
+
+        # Le recalcul publie le nouveau snapshot et libère le verrou
+        with mock.patch.object(dashboard_stats, 'close_old_connections'):
+            dashboard_stats._refresh_in_background()
+        self.assertIsNone(cache.get(dashboard_stats.REFRESH_LOCK_KEY))
+        self.assertGreater(cache.get(dashboard_stats.SNAPSHOT_KEY)['generated_ts'], snapshot['generated_ts'])
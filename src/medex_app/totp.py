@@ -0,0 +1,54 @@
+import base64
+import hmac
+import io
+import time
+
+import pyotp
+import qrcode
+from django.core.cache import cache
+
+
+ISSUER_NAME = 'MedEx Admin'
+# Tolérance d'une période (30 s) avant/après pour le décalage d'horloge du téléphone
+VALID_WINDOW = 1
+
+
+# ===========================
+# TOTP (APPLICATION D'AUTHENTIFICATION)
+# ===========================
+
+def new_secret():
+    return pyotp.random_base32()
+
+
+def provisioning_uri(secret, email):
+    return pyotp.TOTP(secret).provisioning_uri(name=email, issuer_name=ISSUER_NAME)
+
+
+def qr_code_data_uri(uri):
+    """QR code PNG de l'URI otpauth://, en data URI affichable directement dans un <img>"""
+    buffer = io.BytesIO()
+    qrcode.make(uri).save(buffer, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def verify(secret, code, user_id=None):
+    """
+    Vérifier un code localement (aucune écriture en base).
+    Un code déjà accepté pour cet utilisateur n'est pas rejouable : la période
+    utilisée est mémorisée dans le cache le temps de sa validité.
+    """
+    code = str(code or '').strip()
+    if not secret or not code.isdigit():
+        return False
+
+    totp = pyotp.TOTP(secret)
+    now = time.time()
+    for offset in range(-VALID_WINDOW, VALID_WINDOW + 1):
+        if hmac.compare_digest(totp.at(now, offset), code):
+            if user_id is None:
+                return True
+            counter = int(now // totp.interval) + offset
+            ttl = totp.interval * (2 * VALID_WINDOW + 1)
+            return cache.add(f'totp-used:{user_id}:{counter}', True, timeout=ttl)
+    return False
@@ -0,0 +1,259 @@
+import atexit
+import logging
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import Delivery, DeliveryTrail
+from . import trails
+
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = getattr(settings, 'DELIVERY_LOCATION_FLUSH_INTERVAL', 5)  # secondes
+MAX_BUFFERED_POINTS = getattr(settings, 'DELIVERY_LOCATION_MAX_BUFFERED_POINTS', 50000)
+POSITION_TTL = 6 * 3600
+COURIER_TTL = 300
+# Un livreur sans position depuis ce délai n'est plus proposé à l'assignation
+COURIER_POSITION_TTL = getattr(settings, 'DELIVERY_COURIER_POSITION_TTL', 900)
+BULK_BATCH_SIZE = 500
+
+
+# ===========================
+# POSITIONS DES LIVREURS
+# ===========================
+#
+# Les pings GPS ne déclenchent aucune écriture SQL :
+# - la dernière position de chaque livraison est publiée dans le cache partagé
+#   (lue par le suivi en direct et le calcul d'ETA) ;
+# - l'historique (trace compacte, une ligne par livraison) et la position
+#   courante sont écrits par lots toutes les FLUSH_INTERVAL secondes par un
+#   thread du processus.
+# Un arrêt brutal du processus perd au plus FLUSH_INTERVAL secondes de points.
+
+def _cache():
+    return caches[getattr(settings, 'DELIVERY_TRACKING_CACHE', 'default')]
+
+
+def position_key(delivery_id):
+    return f'delivery:{delivery_id}:position'
+
+
+def latest_position(delivery_id):
+    """Dernière position connue : cache partagé, sinon base"""
+    position = _cache().get(position_key(delivery_id))
+    if position is not None:
+        return position
+    row = Delivery.objects.filter(id=delivery_id).values(
+        'current_latitude', 'current_longitude', 'updated_at'
+    ).first()
+    if not row or row['current_latitude'] is None:
+        return None
+    return {
+        'latitude': float(row['current_latitude']),
+        'longitude': float(row['current_longitude']),
+        'recorded_at': row['updated_at'].isoformat(),
+    }
+
+
+def is_assigned_courier(user_id, delivery_id):
+    """Vérifier que la livraison est assignée à ce livreur (mémorisé quelques minutes)"""
+    cache = _cache()
+    key = f'delivery:{delivery_id}:courier'
+    courier_id = cache.get(key)
+    if courier_id is None:
+        courier_id = Delivery.objects.filter(id=delivery_id).values_list(
+            'delivery_person_id', flat=True
+        ).first()
+        # Seule une assignation est mémorisée : une livraison sans livreur peut être
+        # assignée à tout moment, et le livreur doit pouvoir envoyer ses positions aussitôt
+        if courier_id is not None:
+            cache.set(key, courier_id, timeout=COURIER_TTL)
+    return courier_id == user_id
+
+
+def forget_courier(delivery_id):
+    """À appeler quand l'assignation d'une livraison change"""
+    _cache().delete(f'delivery:{delivery_id}:courier')
+
+
+def delivery_destination(delivery_id):
+    """(latitude, longitude) de l'adresse de livraison géocodée, ou None (mémorisé quelques minutes)"""
+    cache = _cache()
+    key = f'delivery:{delivery_id}:destination'
+    destination = cache.get(key)
+    if destination is None:
+        row = Delivery.objects.filter(id=delivery_id).values_list(
+            'order__delivery_latitude', 'order__delivery_longitude'
+        ).first()
+        destination = (float(row[0]), float(row[1])) if row and row[0] is not None and row[1] is not None else ()
+        cache.set(key, destination, timeout=COURIER_TTL)
+    return destination or None
+
+
+def courier_position_key(user_id):
+    return f'courier:{user_id}:position'
+
+
+def publish_courier_position(user_id, position):
+    _cache().set(courier_position_key(user_id), position, timeout=COURIER_POSITION_TTL)
+
+
+def courier_positions(user_ids):
+    """{user_id: position} des livreurs ayant signalé leur position récemment"""
+    keys = {courier_position_key(user_id): user_id for user_id in user_ids}
+    found = _cache().get_many(list(keys))
+    return {keys[key]: position for key, position in found.items()}
+
+
+def append_to_trails(points):
+    """Ajouter des points (delivery_id, latitude, longitude, recorded_at) aux traces, dans la transaction courante"""
+    by_delivery = {}
+    for delivery_id, latitude, longitude, recorded_at in points:
+        by_delivery.setdefault(delivery_id, []).append((latitude, longitude, recorded_at))
+    if not by_delivery:
+        return
+
+    existing = {
+        trail.delivery_id: trail
+        for trail in DeliveryTrail.objects.select_for_update().filter(delivery_id__in=list(by_delivery))
+    }
+    created, updated = [], []
+    for delivery_id, new_points in by_delivery.items():
+        trail = existing.get(delivery_id)
+        if trail is None:
+            trail = DeliveryTrail(delivery_id=delivery_id)
+            created.append(trail)
+        else:
+            updated.append(trail)
+        trails.append(trail, new_points)
+
+    now = timezone.now()
+    for trail in created + updated:
+        trail.updated_at = now
+    DeliveryTrail.objects.bulk_create(created, batch_size=BULK_BATCH_SIZE)
+    DeliveryTrail.objects.bulk_update(
+        updated,
+        ['data', 'point_count', 'last_latitude', 'last_longitude', 'last_timestamp', 'started_at', 'updated_at'],
+        batch_size=BULK_BATCH_SIZE,
+    )
+
+
+class LocationBuffer:
+    """Points en attente d'écriture et dernière position par livraison (par processus)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._points = []
+        self._latest = {}
+        self._estimates = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def add(self, delivery_id, points, estimate=None):
+        """
+        points : liste de (latitude, longitude, recorded_at) ; retourne la dernière position.
+        estimate(latitude, longitude, recorded_at) : heure d'arrivée estimée depuis le dernier point.
+        """
+        points = sorted(points, key=lambda point: point[2])
+        with self._lock:
+            if len(self._points) + len(points) > MAX_BUFFERED_POINTS:
+                raise OverflowError('Location buffer is full.')
+            self._points.extend((delivery_id,) + tuple(point) for point in points)
+            latest = self._latest.get(delivery_id)
+            if latest is None or points[-1][2] >= latest[2]:
+                latest = self._latest[delivery_id] = points[-1]
+        self._ensure_flusher()
+
+        position = {
+            'latitude': float(latest[0]),
+            'longitude': float(latest[1]),
+            'recorded_at': latest[2].isoformat(),
+        }
+        eta = estimate(*latest) if estimate else None
+        if eta is not None:
+            with self._lock:
+                self._estimates[delivery_id] = eta
+            position['estimated_delivery_time'] = eta.isoformat()
+        _cache().set(position_key(delivery_id), position, timeout=POSITION_TTL)
+        return position
+
+    def flush(self):
+        """Écrire l'historique (traces compactes) et la position courante (bulk_update)"""
+        with self._lock:
+            points, self._points = self._points, []
+            latest, self._latest = self._latest, {}
+            estimates, self._estimates = self._estimates, {}
+        if not points and not latest and not estimates:
+            return 0
+
+        try:
+            with transaction.atomic():
+                # Ignorer les points des livraisons supprimées entre-temps
+                existing = set(Delivery.objects.filter(
+                    id__in={point[0] for point in points} | set(latest) | set(estimates)
+                ).values_list('id', flat=True))
+                append_to_trails(
+                    (delivery_id, latitude, longitude, recorded_at)
+                    for delivery_id, latitude, longitude, recorded_at in points
+                    if delivery_id in existing
+                )
+                now = timezone.now()
+                Delivery.objects.bulk_update(
+                    [
+                        Delivery(
+                            id=delivery_id,
+                            current_latitude=Decimal(str(latitude)),
+                            current_longitude=Decimal(str(longitude)),
+                            updated_at=now,
+                        )
+                        for delivery_id, (latitude, longitude, _) in latest.items()
+                        if delivery_id in existing
+                    ],
+                    ['current_latitude', 'current_longitude', 'updated_at'],
+                    batch_size=BULK_BATCH_SIZE,
+                )
+                Delivery.objects.bulk_update(
+                    [
+                        Delivery(id=delivery_id, estimated_delivery_time=eta)
+                        for delivery_id, eta in estimates.items()
+                        if delivery_id in existing
+                    ],
+                    ['estimated_delivery_time'],
+                    batch_size=BULK_BATCH_SIZE,
+                )
+        except Exception:
+            logger.exception("Delivery location flush failed; points kept for the next flush")
+            with self._lock:
+                self._points[:0] = points[:max(MAX_BUFFERED_POINTS - len(self._points), 0)]
+                for delivery_id, position in latest.items():
+                    self._latest.setdefault(delivery_id, position)
+                for delivery_id, eta in estimates.items():
+                    self._estimates.setdefault(delivery_id, eta)
+            return 0
+        return len(points)
+
+    def _ensure_flusher(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='delivery-location-flush', daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(FLUSH_INTERVAL):
+            close_old_connections()
+            self.flush()
+        close_old_connections()
+
+
+buffer = LocationBuffer()
+atexit.register(buffer.flush)
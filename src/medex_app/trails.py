@@ -0,0 +1,139 @@
+import zlib
+from array import array
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+
+MICRO = 1_000_000
+COMPRESSION_LEVEL = 6
+
+
+# ===========================
+# TRACES GPS COMPACTES
+# ===========================
+#
+# Une trace = une ligne DeliveryTrail par livraison, et non une ligne par ping.
+# Chaque point est stocké comme l'écart au point précédent :
+#   latitude, longitude (micro-degrés) et horodatage (secondes),
+#   chacun en entier zigzag + varint (1 à 3 octets pour un ping habituel),
+# puis le flux est compressé (zlib). Le dernier point absolu est gardé en
+# colonnes : ajouter des points n'exige pas de décoder les varints de la trace.
+# Le blob compressé est en revanche décompressé puis recompressé à chaque ajout,
+# un coût proportionnel à la taille de la trace (quelques Ko pour une livraison
+# d'une heure), payé une fois par livraison et par écriture groupée du thread
+# de tracking.LocationBuffer, jamais pendant la requête.
+
+def to_micro(value):
+    return int((Decimal(str(value)) * MICRO).to_integral_value())
+
+
+def to_timestamp(moment):
+    return int(moment.timestamp())
+
+
+def _write_varint(out, value):
+    value = (value << 1) ^ (value >> 63)  # zigzag : petits entiers signés -> petits entiers positifs
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varints(data):
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        yield (value >> 1) ^ -(value & 1)
+        value = shift = 0
+
+
+def encode(points, last=(0, 0, 0)):
+    """
+    points : [(latitude µ°, longitude µ°, timestamp)] ; last : dernier point déjà encodé.
+    Retourne (octets non compressés, nouveau dernier point).
+    """
+    out = bytearray()
+    last_lat, last_lng, last_ts = last
+    for latitude, longitude, timestamp in points:
+        _write_varint(out, latitude - last_lat)
+        _write_varint(out, longitude - last_lng)
+        _write_varint(out, timestamp - last_ts)
+        last_lat, last_lng, last_ts = latitude, longitude, timestamp
+    return bytes(out), (last_lat, last_lng, last_ts)
+
+
+def decode(data):
+    """Octets non compressés -> (latitudes µ°, longitudes µ°, timestamps) en tableaux d'entiers"""
+    latitudes, longitudes, timestamps = array('l'), array('l'), array('q')
+    columns = (latitudes, longitudes, timestamps)
+    current = [0, 0, 0]
+    for index, delta in enumerate(_read_varints(data)):
+        column = index % 3
+        current[column] += delta
+        columns[column].append(current[column])
+    return latitudes, longitudes, timestamps
+
+
+def append(trail, points):
+    """
+    Ajouter des points [(latitude, longitude, datetime)] à un DeliveryTrail (sans le sauvegarder).
+    Le blob entier est décompressé et recompressé : appeler une fois par lot, pas par point.
+    """
+    if not points:
+        return trail
+    encoded, last = encode(
+        [(to_micro(lat), to_micro(lng), to_timestamp(moment)) for lat, lng, moment in points],
+        last=(trail.last_latitude, trail.last_longitude, trail.last_timestamp),
+    )
+    existing = zlib.decompress(bytes(trail.data)) if trail.data else b''
+    trail.data = zlib.compress(existing + encoded, COMPRESSION_LEVEL)
+    trail.last_latitude, trail.last_longitude, trail.last_timestamp = last
+    trail.point_count += len(points)
+    if trail.started_at is None:
+        trail.started_at = min(moment for *_, moment in points)
+    return trail
+
+
+def points(trail):
+    """Points de la trace triés par horodatage (les lots reçus en retard sont remis en ordre)"""
+    if not trail.data:
+        return array('l'), array('l'), array('q')
+    latitudes, longitudes, timestamps = decode(zlib.decompress(bytes(trail.data)))
+    order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+    if order != list(range(len(order))):
+        latitudes = array('l', (latitudes[i] for i in order))
+        longitudes = array('l', (longitudes[i] for i in order))
+        timestamps = array('q', (timestamps[i] for i in order))
+    return latitudes, longitudes, timestamps
+
+
+def from_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+
+
+# ===========================
+# POLYLIGNE ENCODÉE
+# ===========================
+
+def _polyline_value(value, out):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode_polyline(latitudes, longitudes, precision=5):
+    """Format "Encoded Polyline" (Google Maps, Leaflet, Mapbox) depuis des micro-degrés"""
+    divisor = 10 ** (6 - precision)
+    out = []
+    previous_lat = previous_lng = 0
+    for latitude, longitude in zip(latitudes, longitudes):
+        lat, lng = round(latitude / divisor), round(longitude / divisor)
+        _polyline_value(lat - previous_lat, out)
+        _polyline_value(lng - previous_lng, out)
+        previous_lat, previous_lng = lat, lng
+    return ''.join(out)
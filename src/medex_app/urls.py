@@ -1,8 +1,9 @@
 from django.urls import path
 from . import views
 from . import admin_views
-from django.conf import settings
-from django.conf.urls.static import static
+from . import order_views
+from . import prescription_views
+from . import delivery_views
 
 urlpatterns = [
     # Auth endpoints
@@ -11,6 +12,7 @@ urlpatterns = [
     path('api/logout', views.logout_user, name='logout_user'),
     path('api/profile', views.get_user_profile, name='get_user_profile'),
     path('api/profile/status', views.check_user_profile_status, name='check_user_profile_status'),
+    path('api/stream-ticket', views.stream_ticket, name='stream_ticket'),
     
     # Pharmacy registration
     path('api/pharmacy/register', views.register_pharmacy, name='register_pharmacy'),
@@ -40,11 +42,27 @@ urlpatterns = [
     path('api/cart/clear', views.clear_cart, name='clear_cart'),
     path('api/cart/summary', views.cart_summary, name='cart_summary'),
     
+    # Orders
+    path('api/orders', order_views.customer_orders, name='customer_orders'),
+    path('api/pharmacy/orders', order_views.pharmacy_orders, name='pharmacy_orders'),
+    path('api/pharmacy/orders/<int:order_id>/status', order_views.update_order_status, name='update_order_status'),
+    path('api/pharmacy/orders/stream', order_views.pharmacy_order_stream, name='pharmacy_order_stream'),
+    path('api/pharmacy/orders/events', order_views.pharmacy_order_events, name='pharmacy_order_events'),
+    
+    # Prescriptions (upload par morceaux, reprise possible)
+    path('api/orders/<int:order_id>/prescription/uploads', prescription_views.start_prescription_upload, name='start_prescription_upload'),
+    path('api/prescription/uploads/<uuid:upload_id>', prescription_views.prescription_upload_status, name='prescription_upload_status'),
+    path('api/prescription/uploads/<uuid:upload_id>/chunk', prescription_views.upload_prescription_chunk, name='upload_prescription_chunk'),
+    path('api/prescription/uploads/<uuid:upload_id>/complete', prescription_views.complete_prescription_upload, name='complete_prescription_upload'),
+    
     # ===========================
     # ADMIN AUTHENTICATION (2FA)
     # ===========================
     path('api/admin/login/request-otp', admin_views.admin_login_request_otp, name='admin-request-otp'),
     path('api/admin/login/verify-otp', admin_views.admin_verify_otp, name='admin-verify-otp'),
+    path('api/admin/2fa/totp/setup', admin_views.admin_totp_setup, name='admin-totp-setup'),
+    path('api/admin/2fa/totp/confirm', admin_views.admin_totp_confirm, name='admin-totp-confirm'),
+    path('api/admin/2fa/totp/disable', admin_views.admin_totp_disable, name='admin-totp-disable'),
     
     # ===========================
     # ADMIN DASHBOARD
@@ -68,6 +86,11 @@ urlpatterns = [
     # ===========================
     # Delivery Management
     # ===========================
-    #path("api/orders/", views.delivery_orders, name="delivery-orders"),
-    #path("api/orders/<int:order_id>/status/", views.update_delivery_status, name="delivery-update-status"),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    path('api/orders/<int:order_id>/tracking/stream', delivery_views.order_tracking_stream, name='order-tracking-stream'),
+    path('api/delivery/routes', delivery_views.delivery_routes, name='delivery-routes'),
+    path('api/delivery/position', delivery_views.report_courier_position, name='delivery-report-position'),
+    path('api/delivery/<int:delivery_id>/trail', delivery_views.delivery_trail, name='delivery-trail'),
+    path('api/delivery/<int:delivery_id>/locations', delivery_views.ingest_delivery_locations, name='delivery-ingest-locations'),
+    path('api/delivery/orders', delivery_views.delivery_orders, name='delivery-orders'),
+    path('api/delivery/orders/<int:order_id>/status/', delivery_views.update_delivery_status, name='delivery-update-status'),
+]
\ No newline at end of file
@@ -6,6 +6,11 @@ from rest_framework.permissions import IsAuthenticated, AllowAny
 from .models import *
 from django.http import JsonResponse
 from .serializers import *
+from .idempotency import idempotent
+from .ratelimit import rate_limit
+from .authentication import get_identity, issue_stream_ticket, load_identity, remember_identity, STREAM_TICKET_MAX_AGE
+from .images import image_entry, release_entry, schedule_derivatives
+from . import media_store, pricing
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 import json
@@ -14,6 +19,7 @@ import pandas as pd
 from io import BytesIO
 from django.core.files.storage import default_storage
 from django.conf import settings
+from django.db import transaction
 import os
 import time
 
@@ -177,10 +183,10 @@ def register_pharmacy(request):
             is_verified=False  # Nécessite validation admin
         )
         
-        # Gérer le logo si présent
+        # Gérer le logo si présent (stocké sous son empreinte, sans doublon)
         if 'logo' in request.FILES:
-            pharmacy.logo = request.FILES['logo']
-            pharmacy.save()
+            pharmacy.logo.name = media_store.store(request.FILES['logo'])
+            pharmacy.save(update_fields=['logo'])
         
         return Response({
             'success': True,
@@ -221,11 +227,10 @@ def check_user_profile_status(request):
         }
         
         if user.role == 'pharmacist':
-            has_pharmacy = Pharmacy.objects.filter(owner=user).exists()
-            status_data['has_pharmacy'] = has_pharmacy
+            pharmacy = get_identity(request).pharmacy
+            status_data['has_pharmacy'] = pharmacy is not None
             
-            if has_pharmacy:
-                pharmacy = Pharmacy.objects.get(owner=user)
+            if pharmacy is not None:
                 status_data['pharmacy'] = {
                     'id': pharmacy.id,
                     'name': pharmacy.name,
@@ -257,6 +262,7 @@ def check_user_profile_status(request):
 @csrf_exempt
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@rate_limit('login')
 def login_user(request):
     """Connexion d'un utilisateur"""
     try:
@@ -293,13 +299,16 @@ def login_user(request):
                 'message': 'Account is disabled.'
             }, status=status.HTTP_403_FORBIDDEN)
 
-        # ✅ Récupérer ou créer le token
-        token, created = Token.objects.get_or_create(user=user)
-
         # Mettre à jour le dernier login
         user.last_login = timezone.now()
         user.save(update_fields=['last_login'])
 
+        # ✅ Récupérer ou créer le token, charger le contexte (pharmacie) et le garder en cache
+        token, created = Token.objects.get_or_create(user=user)
+        token.user = user
+        identity = load_identity(token)
+        remember_identity(identity)
+
         # ✅ Préparer les données utilisateur
         user_data = {
             'id': user.id,
@@ -313,11 +322,10 @@ def login_user(request):
 
         # ✅ Vérifier si le pharmacien a une pharmacie
         if user.role == 'pharmacist':
-            has_pharmacy = Pharmacy.objects.filter(owner=user).exists()
-            user_data['has_pharmacy'] = has_pharmacy
+            pharmacy = identity.pharmacy
+            user_data['has_pharmacy'] = pharmacy is not None
             
-            if has_pharmacy:
-                pharmacy = Pharmacy.objects.get(owner=user)
+            if pharmacy is not None:
                 user_data['pharmacy_id'] = pharmacy.id
                 user_data['pharmacy_name'] = pharmacy.name
                 user_data['pharmacy_is_verified'] = pharmacy.is_verified
@@ -384,6 +392,24 @@ def get_user_profile(request):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def stream_ticket(request):
+    """Ticket de courte durée pour ouvrir un flux temps réel (EventSource : ?ticket=)"""
+    try:
+        return Response({
+            'success': True,
+            'ticket': issue_stream_ticket(request.user),
+            'expires_in': STREAM_TICKET_MAX_AGE
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 # ===========================
 # PRODUITS
 # ===========================
@@ -491,16 +517,57 @@ def pharmacy_products(request, pharmacy_id):
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def order_settings(request):
-    """Endpoint pour les paramètres de commande"""
-    return Response({
-        "success": True,
-        "settings": {
-            "min_order_amount": 1000,
-            "delivery_fee": 500,
-            "supported_payment_methods": ["mobile_money", "paypal", "card"],
-            "max_cart_size": 20
-        }
-    })
+    """
+    Endpoint pour les paramètres de commande.
+    Avec ?pharmacy_id=&latitude=&longitude=, les frais de livraison et le
+    minimum de commande sont ceux de la zone ou de la tranche de distance.
+    """
+    try:
+        delivery = pricing.quote_defaults()
+        pharmacy_id = request.query_params.get('pharmacy_id')
+        if pharmacy_id:
+            pharmacy = Pharmacy.objects.only('id', 'latitude', 'longitude').filter(id=pharmacy_id).first()
+            if pharmacy is None:
+                return Response({
+                    "success": False,
+                    "message": "Pharmacy not found"
+                }, status=status.HTTP_404_NOT_FOUND)
+            latitude, longitude = _delivery_point(request.query_params)
+            delivery = pricing.quote(pharmacy, latitude, longitude)
+
+        return Response({
+            "success": True,
+            "settings": {
+                "min_order_amount": delivery['min_order_amount'],
+                "delivery_fee": delivery['delivery_fee'],
+                "deliverable": delivery['deliverable'],
+                "delivery_zone": delivery['zone'],
+                "supported_payment_methods": ["mobile_money", "paypal", "card"],
+                "max_cart_size": 20
+            }
+        })
+
+    except ValueError:
+        return Response({
+            "success": False,
+            "message": "Invalid pharmacy_id, latitude or longitude"
+        }, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({
+            "success": False,
+            "message": str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _delivery_point(params):
+    """(latitude, longitude) de livraison depuis les paramètres, ou (None, None)"""
+    latitude, longitude = params.get('latitude'), params.get('longitude')
+    if latitude in (None, '') or longitude in (None, ''):
+        return None, None
+    latitude, longitude = float(latitude), float(longitude)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('Invalid coordinates')
+    return latitude, longitude
 
 
 # ===========================
@@ -530,6 +597,7 @@ def get_cart(request):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def add_to_cart(request):
     """Ajouter un produit au panier"""
     try:
@@ -652,6 +720,7 @@ def add_to_cart(request):
 
 @api_view(['PUT'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def update_cart_item(request, item_id):
     """Mettre à jour la quantité d'un article du panier"""
     try:
@@ -713,6 +782,7 @@ def update_cart_item(request, item_id):
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def remove_from_cart(request, item_id):
     """Supprimer un article du panier"""
     try:
@@ -746,6 +816,7 @@ def remove_from_cart(request, item_id):
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
+@idempotent
 def clear_cart(request):
     """Vider complètement le panier"""
     try:
@@ -777,22 +848,58 @@ def clear_cart(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def cart_summary(request):
-    """Obtenir un résumé du panier"""
+    """
+    Obtenir un résumé du panier.
+    Avec ?latitude=&longitude= (adresse de livraison), les frais de livraison
+    de chaque pharmacie sont chiffrés selon sa zone ou la distance.
+    """
     try:
         cart, created = Cart.objects.get_or_create(user=request.user)
-        
+        try:
+            latitude, longitude = _delivery_point(request.query_params)
+        except ValueError:
+            return Response({
+                "success": False,
+                "error": "Invalid latitude or longitude"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        items = list(cart.items.select_related('medicine__pharmacy'))
+        subtotals = {}
+        pharmacies = {}
+        for item in items:
+            pharmacy = item.medicine.pharmacy
+            pharmacies[pharmacy.id] = pharmacy
+            subtotals[pharmacy.id] = subtotals.get(pharmacy.id, 0) + item.subtotal()
+
+        delivery = []
+        for pharmacy_id, pharmacy in pharmacies.items():
+            quote = pricing.quote(pharmacy, latitude, longitude)
+            delivery.append({
+                "pharmacy_id": pharmacy_id,
+                "delivery_fee": float(quote['delivery_fee']) if quote['delivery_fee'] is not None else None,
+                "min_order_amount": float(quote['min_order_amount']),
+                "meets_minimum": subtotals[pharmacy_id] >= quote['min_order_amount'],
+                "deliverable": quote['deliverable'],
+                "zone": quote['zone']
+            })
+        total_amount = sum(subtotals.values())
+        delivery_total = sum(entry['delivery_fee'] or 0 for entry in delivery)
+
         return Response({
             "success": True,
             "summary": {
-                "item_count": cart.item_count(),
-                "total_amount": float(cart.total_amount()),
-                "pharmacies_count": len(cart.get_pharmacies()),
+                "item_count": sum(item.quantity for item in items),
+                "total_amount": float(total_amount),
+                "delivery_fee_total": delivery_total,
+                "grand_total": float(total_amount) + delivery_total,
+                "pharmacies_count": len(pharmacies),
                 "pharmacies": [
                     {
                         "id": pharmacy.id,
                         "name": pharmacy.name
-                    } for pharmacy in cart.get_pharmacies()
-                ]
+                    } for pharmacy in pharmacies.values()
+                ],
+                "delivery": delivery
             }
         }, status=status.HTTP_200_OK)
     
@@ -824,9 +931,8 @@ def get_pharmacy_products(request):
             }, status=status.HTTP_403_FORBIDDEN)
         
         # Récupérer la pharmacie du pharmacien
-        try:
-            pharmacy = Pharmacy.objects.get(owner=user)
-        except Pharmacy.DoesNotExist:
+        pharmacy = get_identity(request).pharmacy
+        if pharmacy is None:
             return Response({
                 'success': False,
                 'message': 'No pharmacy found for this user.'
@@ -881,9 +987,8 @@ def add_product(request):
             }, status=status.HTTP_403_FORBIDDEN)
         
         # Récupérer la pharmacie
-        try:
-            pharmacy = Pharmacy.objects.get(owner=user)
-        except Pharmacy.DoesNotExist:
+        pharmacy = get_identity(request).pharmacy
+        if pharmacy is None:
             return Response({
                 'success': False,
                 'message': 'No pharmacy found for this user.'
@@ -909,47 +1014,40 @@ def add_product(request):
                 'message': 'Name and price are required.'
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Créer le produit
-        product = Medicine.objects.create(
-            pharmacy=pharmacy,
-            name=name,
-            description=description,
-            generic_name=generic_name,
-            manufacturer=manufacturer,
-            dosage=dosage,
-            price=float(price),
-            unit_price=float(price),
-            stock_quantity=int(stock_quantity) if stock_quantity else 0,
-            min_order_quantity=int(min_order_quantity) if min_order_quantity else 1,
-            category_id=int(category_id) if category_id else None,
-            subCategory_id=int(subcategory_id) if subcategory_id else None,
-            requires_prescription=requires_prescription,
-            is_active=True,
-            is_approved=True
-        )
-        
-        # ✅ Gérer les images multiples
-        image_urls = []
-        if request.FILES:
-            images = request.FILES.getlist('images')
+        images = request.FILES.getlist('images')[:5] if request.FILES else []  # Limiter à 5 images
+        media_base_url = request.build_absolute_uri(settings.MEDIA_URL)
+        
+        # Produit et images ensemble : un échec (upload ou sauvegarde) n'en laisse aucune trace
+        with media_store.atomic():
+            # Créer le produit
+            product = Medicine.objects.create(
+                pharmacy=pharmacy,
+                name=name,
+                description=description,
+                generic_name=generic_name,
+                manufacturer=manufacturer,
+                dosage=dosage,
+                price=float(price),
+                unit_price=float(price),
+                stock_quantity=int(stock_quantity) if stock_quantity else 0,
+                min_order_quantity=int(min_order_quantity) if min_order_quantity else 1,
+                category_id=int(category_id) if category_id else None,
+                subCategory_id=int(subcategory_id) if subcategory_id else None,
+                requires_prescription=requires_prescription,
+                is_active=True,
+                is_approved=True
+            )
             
-            for idx, image_file in enumerate(images[:5]):  # Limiter à 5 images
-                # Créer un nom de fichier unique
-                ext = image_file.name.split('.')[-1]
-                filename = f"product_{product.id}_{idx}_{int(time.time())}.{ext}"
-                filepath = os.path.join('products', filename)
-                
-                # Sauvegarder l'image
-                saved_path = default_storage.save(filepath, image_file)
-                
-                # Créer l'URL complète
-                image_url = request.build_absolute_uri(settings.MEDIA_URL + saved_path)
-                image_urls.append(image_url)
-        
-        # Sauvegarder les URLs des images dans le JSONField
-        if image_urls:
-            product.image = image_urls
-            product.save()
+            # ✅ Gérer les images multiples : écritures en parallèle, ordre du client conservé
+            # (stockées sous leur empreinte, les doublons ne sont pas réécrits)
+            saved_paths = media_store.store_many(images)
+            image_entries = [image_entry(media_base_url + path, path) for path in saved_paths]
+            
+            # Sauvegarder les images dans le JSONField (les dérivés sont générés en arrière-plan)
+            if image_entries:
+                product.image = image_entries
+                product.save()
+                schedule_derivatives(product.id, saved_paths, media_base_url)
         
         serializer = MedicineSerializer(product)
         
@@ -981,9 +1079,8 @@ def update_product(request, product_id):
                 'message': 'Only pharmacists can update products.'
             }, status=status.HTTP_403_FORBIDDEN)
         
-        try:
-            pharmacy = Pharmacy.objects.get(owner=user)
-        except Pharmacy.DoesNotExist:
+        pharmacy = get_identity(request).pharmacy
+        if pharmacy is None:
             return Response({
                 'success': False,
                 'message': 'No pharmacy found for this user.'
@@ -1020,33 +1117,23 @@ def update_product(request, product_id):
         product.requires_prescription = requires_prescription.lower() == 'true'
         
         # Gérer les nouvelles images
-        if request.FILES:
-            images = request.FILES.getlist('images')
-            new_image_urls = []
-            
-            for idx, image_file in enumerate(images[:5]):
-                ext = image_file.name.split('.')[-1]
-                filename = f"product_{product.id}_{idx}_{int(time.time())}.{ext}"
-                filepath = os.path.join('products', filename)
-                
-                saved_path = default_storage.save(filepath, image_file)
-                image_url = request.build_absolute_uri(settings.MEDIA_URL + saved_path)
-                new_image_urls.append(image_url)
+        images = request.FILES.getlist('images')[:5] if request.FILES else []
+        media_base_url = request.build_absolute_uri(settings.MEDIA_URL)
+        
+        # Les fichiers écrits ici sont supprimés si la sauvegarde du produit échoue
+        with media_store.atomic():
+            saved_paths = media_store.store_many(images)
             
             # Remplacer les anciennes images par les nouvelles
-            if new_image_urls:
-                # Supprimer les anciennes images du stockage (optionnel)
-                for old_url in product.image:
-                    try:
-                        old_path = old_url.replace(request.build_absolute_uri(settings.MEDIA_URL), '')
-                        if default_storage.exists(old_path):
-                            default_storage.delete(old_path)
-                    except:
-                        pass
+            if saved_paths:
+                # Libérer les anciennes images (supprimées quand plus aucun produit ne les utilise)
+                for old_entry in media_store.image_entries(product.image):
+                    release_entry(old_entry, media_base_url)
                 
-                product.image = new_image_urls
-        
-        product.save()
+                product.image = [image_entry(media_base_url + path, path) for path in saved_paths]
+            
+            product.save()
+            schedule_derivatives(product.id, saved_paths, media_base_url)
         
         serializer = MedicineSerializer(product)
         
@@ -1076,12 +1163,22 @@ def delete_product(request, product_id):
                 'message': 'Only pharmacists can delete products.'
             }, status=status.HTTP_403_FORBIDDEN)
         
-        pharmacy = Pharmacy.objects.get(owner=user)
+        pharmacy = get_identity(request).pharmacy
+        if pharmacy is None:
+            return Response({
+                'success': False,
+                'message': 'No pharmacy found for this user.'
+            }, status=status.HTTP_404_NOT_FOUND)
         
         try:
             product = Medicine.objects.get(id=product_id, pharmacy=pharmacy)
             product_name = product.name
-            product.delete()
+            media_base_url = request.build_absolute_uri(settings.MEDIA_URL)
+            with transaction.atomic():
+                # Libérer les images du produit (fichiers partagés conservés tant qu'ils sont référencés)
+                for entry in media_store.image_entries(product.image):
+                    release_entry(entry, media_base_url)
+                product.delete()
             
             return Response({
                 'success': True,
@@ -1113,7 +1210,12 @@ def import_products_excel(request):
                 'message': 'Only pharmacists can import products.'
             }, status=status.HTTP_403_FORBIDDEN)
         
-        pharmacy = Pharmacy.objects.get(owner=user)
+        pharmacy = get_identity(request).pharmacy
+        if pharmacy is None:
+            return Response({
+                'success': False,
+                'message': 'No pharmacy found for this user.'
+            }, status=status.HTTP_404_NOT_FOUND)
         
         if 'file' not in request.FILES:
             return Response({
@@ -1229,48 +1331,3 @@ def get_subcategories(request, category_id):
         'success': True,
         'subcategories': serializer.data
     })
-
-
-# ================================
-#   2. UPDATE ORDER STATUS (Livreur)
-# ================================
-"""@api_view(["PUT"])
-@permission_classes([IsAuthenticated])
-def update_delivery_status(request, order_id):
-    
-    #Frontend PUT:
-     # /api/delivery/orders/<order_id>/status/
-    #  Body: {"status": "delivered"}
-    
-
-    new_status = request.data.get("status")
-
-    if new_status not in dict(Delivery.STATUS_CHOICES).keys():
-        return Response(
-            {"success": False, "message": "Invalid status"},
-            status=status.HTTP_400_BAD_REQUEST,
-        )
-
-    # Retrieve delivery + ensure update allowed
-    delivery = get_object_or_404(Delivery, order_id=order_id)
-
-    # Optional security check:
-    # Only the assigned delivery man can update the order
-    if delivery.delivery_person != request.user:
-        return Response(
-            {"success": False, "message": "Not authorized to update this order"},
-            status=status.HTTP_403_FORBIDDEN,
-        )
-
-    # Update the status
-    delivery.delivery_status = new_status
-    delivery.save()
-
-    return Response(
-        {
-            "success": True,
-            "message": "Status updated successfully",
-            "new_status": new_status,
-        },
-        status=200,
-    )"""
\ No newline at end of file
@@ -3,6 +3,10 @@ ASGI config for medex_project project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The real-time feeds (api/pharmacy/orders/stream, .../events and the delivery
+tracking stream api/orders/<id>/tracking/stream) are async views: serve them through this application (e.g. ``uvicorn medex_project.asgi:application``)
+so that open connections wait as coroutines instead of holding WSGI workers.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -65,6 +65,9 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'idempotency-key',
+    'upload-offset',
+    'upload-checksum',
 ]
 
 CORS_ALLOW_METHODS = [
@@ -81,7 +84,7 @@ CORS_ALLOW_METHODS = [
 # Parser pour les fichiers multipart
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'medex_app.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly',
@@ -93,6 +96,25 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Cache en mémoire des tokens d'authentification (par processus)
+AUTH_TOKEN_CACHE_SIZE = 10000
+AUTH_TOKEN_CACHE_TTL = 60  # secondes
+
+# Cache partagé par tous les workers et par les commandes de gestion : limiteur
+# de débit, anti-rejeu TOTP, snapshot du dashboard admin. Un cache propre à
+# chaque processus (LocMemCache, DummyCache) est refusé au démarrage
+# (vérification medex_app.E001).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/1'),
+    }
+}
+
+# Limiteur de débit des vues de connexion (medex_app.ratelimit)
+RATE_LIMIT_CACHE = 'default'
+RATE_LIMIT_NUM_PROXIES = 0  # proxys de confiance devant Django (X-Forwarded-For)
+
 ROOT_URLCONF = 'medex_project.urls'
 
 TEMPLATES = [
@@ -151,6 +173,9 @@ USE_TZ = True
 STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Envoi des fichiers média par le serveur frontal : None, 'nginx' (X-Accel-Redirect) ou 'apache' (X-Sendfile)
+MEDIA_SENDFILE_BACKEND = None
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -166,6 +191,14 @@ EMAIL_USE_TLS= True
 #EMAIL_HOST_USER='secupharmacy@gmail.com'
 EMAIL_HOST_USER='admedex09@gmail.com'
 EMAIL_HOST_PASSWORD='joqg excp ejaj bgdp'
+# Les emails passent par l'outbox (medex_app.OutboundEmail) : envoi en arrière-plan
+# dans le processus web, relances par `python manage.py send_outbox --loop`
+EMAIL_OUTBOX_SEND_IN_PROCESS = True
+
+# Tarifs de livraison par défaut (sans zone ni tranche de distance applicable) ;
+# zones et tranches se configurent dans l'admin (DeliveryZone, DeliveryFeeBand)
+DEFAULT_DELIVERY_FEE = 500
+DEFAULT_MIN_ORDER_AMOUNT = 1000
 
 
 """ email='admedex09@gmail.com',
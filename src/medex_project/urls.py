@@ -14,12 +14,16 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
+from medex_app.media_views import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('medex_app.urls')),  # ← Inclure les routes de l'app
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    # Fichiers média : Range, ETag, cache immutable, X-Accel-Redirect / X-Sendfile
+    re_path(rf'^{re.escape(settings.MEDIA_URL.lstrip("/"))}(?P<path>.+)$', serve_media, name='media'),
+]